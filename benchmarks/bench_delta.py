@@ -0,0 +1,44 @@
+"""
+Measure the size and the time of a poll of the meters, for the full registry and for the
+meters changed since the previous poll (parameter *since* of
+:py:meth:`livemetrics.LiveMetrics.get_metrics`), with a varying number of active meters.
+
+Usage::
+
+    python benchmarks/bench_delta.py
+"""
+
+import time
+import json
+
+import livemetrics
+
+METERS = 5000
+POLLS = 20
+
+def bench(active,delta):
+    lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False)
+    for i in range(METERS):
+        lm.mark('event-%d' % (i//10),i%10)
+    version = lm.get_version('meters')
+    size = elapsed = 0
+    for poll in range(POLLS):
+        # Activity between two polls
+        for i in range(active):
+            lm.mark('event-%d' % (i//10),i%10)
+        S = time.perf_counter()
+        if delta:
+            data = lm.get_metrics(since=version)
+            version = data['version']
+        else:
+            data = lm.get_metrics()
+        body = json.dumps(data)
+        elapsed += time.perf_counter()-S
+        size += len(body)
+    return size/POLLS/1024,elapsed/POLLS*1e3
+
+if __name__=='__main__':
+    print("{:>8} {:>8} {:>12} {:>10}".format("active","mode","KB/poll","ms/poll"))
+    for active in [0,10,100,1000,METERS]:
+        for delta in [False,True]:
+            print("{:>8} {:>8} {:>12.1f} {:>10.2f}".format(active,"since" if delta else "full",*bench(active,delta)))
@@ -0,0 +1,53 @@
+"""
+Measure the time to encode the whole registry of meters and of histograms in JSON bytes with
+each available :py:class:`livemetrics.publishers.encoding.Encoder`, and the size and time of
+the compression of the response with ``gzip`` and ``br`` (if :py:mod:`brotli` is installed),
+for 10k meters and 1k histograms.
+
+Usage::
+
+    python benchmarks/bench_encoding.py
+"""
+
+import time
+
+import livemetrics
+import livemetrics.publishers.encoding as encoding
+
+REPEAT = 5
+
+def registry():
+    lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False)
+    for i in range(10000):
+        lm.mark('event-%d' % (i//10),'result-%d' % (i%10))
+    for i in range(1000):
+        for j in range(100):
+            lm.histogram('histo-%d' % i,j)
+    return lm
+
+def measure(f):
+    f()
+    S = time.perf_counter()
+    for i in range(REPEAT):
+        data = f()
+    return data,(time.perf_counter()-S)/REPEAT*1e3
+
+if __name__=='__main__':
+    lm = registry()
+    names = ['json'] + [name for name in ('orjson','msgspec') if getattr(encoding,name) is not None]
+    print("{:>12} {:>8} {:>12} {:>10}".format("kind","json","encode","size"))
+    for kind in ['meters','histograms']:
+        for name in names:
+            encoder = encoding.Encoder(name)
+            data,elapsed = measure(lambda: encoder.dumps(lm,kind))
+            print("{:>12} {:>8} {:>9.1f} ms {:>7} kB".format(kind,name,elapsed,len(data)//1024))
+
+    print()
+    print("{:>12} {:>8} {:>12} {:>10}".format("kind","encoding","compress","size"))
+    encodings = ['gzip'] + (['br'] if encoding.brotli is not None else [])
+    encoder = encoding.Encoder()
+    for kind in ['meters','histograms']:
+        data = encoder.dumps(lm,kind)
+        for name in encodings:
+            body,elapsed = measure(lambda: encoder.compress(data,name))
+            print("{:>12} {:>8} {:>9.1f} ms {:>7} kB".format(kind,name,elapsed,len(body)//1024))
@@ -0,0 +1,32 @@
+"""
+Measure the cost for the calling thread of :py:meth:`livemetrics.LiveMetrics.mark` and
+:py:meth:`livemetrics.LiveMetrics.histogram`, with and without an
+:py:class:`livemetrics.metrics.IngestQueue`, and the cost of applying the queued events.
+
+Usage::
+
+    python benchmarks/bench_ingest.py
+"""
+
+import time
+import timeit
+
+import livemetrics
+from livemetrics.metrics import IngestQueue
+
+CALLS = 200000
+
+def bench(queue):
+    lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False,queue=queue)
+    mark = timeit.timeit(lambda: lm.mark('request','ok'),number=CALLS)/CALLS*1e9
+    histogram = timeit.timeit(lambda: lm.histogram('latency',0.5),number=CALLS)/CALLS*1e9
+    S = time.perf_counter()
+    lm.flush()
+    E = time.perf_counter()
+    assert lm.get_metrics('request','ok','count')==CALLS
+    return mark,histogram,(E-S)/(2*CALLS)*1e9
+
+if __name__=='__main__':
+    print("{:>10} {:>12} {:>16} {:>16}".format("mode","ns/mark","ns/histogram","ns/apply"))
+    print("{:>10} {:>12.0f} {:>16.0f} {:>16}".format("direct",*bench(None)[:2],"-"))
+    print("{:>10} {:>12.0f} {:>16.0f} {:>16.0f}".format("queue",*bench(IngestQueue(maxsize=2*CALLS))))
@@ -0,0 +1,43 @@
+"""
+Measure the time to encode the whole registry of meters in JSON, with :py:func:`json.dumps`
+of :py:meth:`livemetrics.LiveMetrics.get_metrics` and with
+:py:meth:`livemetrics.LiveMetrics.get_metrics_json` reusing the JSON of the meters not
+changed, for 10k and 100k meters and 1% of them marked between two scrapes.
+
+Usage::
+
+    python benchmarks/bench_json.py
+"""
+
+import time
+import json
+
+import livemetrics
+from livemetrics.metrics import ManualClock
+
+SCRAPES = 5
+
+def bench(meters,columnar,fragments):
+    clock = ManualClock(10**12)
+    lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False,clock=clock,columnar=columnar)
+    for i in range(meters):
+        lm.mark('event-%d' % (i//10),'result-%d' % (i%10))
+    encode = lm.get_metrics_json if fragments else lambda: json.dumps(lm.get_metrics())
+    encode()
+    elapsed = 0
+    for scrape in range(SCRAPES):
+        # 1% of the meters marked, without tick of the rates
+        for i in range(0,meters,100):
+            lm.mark('event-%d' % (i//10),'result-%d' % (i%10))
+        clock.advance(1)
+        S = time.perf_counter()
+        encode()
+        elapsed += time.perf_counter()-S
+    return elapsed/SCRAPES*1e3
+
+if __name__=='__main__':
+    print("{:>8} {:>10} {:>14} {:>14}".format("meters","registry","json.dumps","fragments"))
+    for meters in [10000,100000]:
+        for columnar in [False,True]:
+            print("{:>8} {:>10} {:>11.1f} ms {:>11.1f} ms".format(meters,"columnar" if columnar else "meters",
+                bench(meters,columnar,False),bench(meters,columnar,True)))
@@ -0,0 +1,43 @@
+"""
+Measure the memory used by each type of metric, in bytes per object, as reported by
+:py:mod:`tracemalloc`. Histograms are measured empty and with 100 values.
+
+Usage::
+
+    python benchmarks/bench_memory.py
+"""
+
+import tracemalloc
+
+from livemetrics.metrics import Gauge, EWMA, Meter, StripedMeter, WeightedSample, Reservoir, Histogram
+
+NB_OBJECTS = 10000
+
+def filled(histogram):
+    for i in range(100):
+        histogram.update(i)
+    return histogram
+
+TYPES = [
+    ("Gauge",lambda: Gauge(0)),
+    ("EWMA",EWMA),
+    ("Meter",Meter),
+    ("StripedMeter",StripedMeter),
+    ("WeightedSample",lambda: WeightedSample(1.0,1.0)),
+    ("Reservoir",Reservoir),
+    ("Histogram",Histogram),
+    ("Histogram (100 values)",lambda: filled(Histogram())),
+]
+
+def bench(factory):
+    tracemalloc.start()
+    objects = [factory() for i in range(NB_OBJECTS)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return size/NB_OBJECTS
+
+if __name__=='__main__':
+    print("{:<24} {:>12}".format("type","bytes/object"))
+    for name,factory in TYPES:
+        print("{:<24} {:>12.0f}".format(name,bench(factory)))
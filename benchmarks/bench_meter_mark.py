@@ -0,0 +1,23 @@
+"""
+Measure the cost of :py:meth:`livemetrics.metrics.Meter.mark` and
+:py:meth:`livemetrics.metrics.Histogram.update` on a single thread.
+
+Usage::
+
+    python benchmarks/bench_meter_mark.py
+"""
+
+import timeit
+
+from livemetrics.metrics import Meter, StripedMeter, Histogram
+
+CALLS = 500000
+
+def bench(f):
+    return timeit.timeit(f, number=CALLS)/CALLS*1e9
+
+if __name__=='__main__':
+    print("{:>24} {:>10.0f} ns".format("Meter.mark",bench(Meter().mark)))
+    print("{:>24} {:>10.0f} ns".format("StripedMeter.mark",bench(StripedMeter().mark)))
+    his = Histogram()
+    print("{:>24} {:>10.0f} ns".format("Histogram.update",bench(lambda: his.update(42))))
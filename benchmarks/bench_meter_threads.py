@@ -0,0 +1,41 @@
+"""
+Measure the throughput of :py:meth:`livemetrics.metrics.Meter.mark` when many threads
+mark the same meter, for :py:class:`livemetrics.metrics.Meter` and
+:py:class:`livemetrics.metrics.StripedMeter`.
+
+Usage::
+
+    python benchmarks/bench_meter_threads.py
+"""
+
+import time
+import threading
+
+from livemetrics.metrics import Meter, StripedMeter
+
+THREADS = [1, 2, 4, 8, 16, 64]
+MARKS = 400000
+
+def bench(meter_class,nb_threads):
+    meter = meter_class()
+    marks = MARKS//nb_threads
+    barrier = threading.Barrier(nb_threads+1)
+    def run():
+        barrier.wait()
+        for i in range(marks):
+            meter.mark()
+    threads = [threading.Thread(target=run) for i in range(nb_threads)]
+    for t in threads:
+        t.start()
+    S = time.perf_counter()
+    barrier.wait()
+    for t in threads:
+        t.join()
+    E = time.perf_counter()
+    assert meter.count==marks*nb_threads
+    return marks*nb_threads/(E-S)
+
+if __name__=='__main__':
+    print("{:>8} {:>16} {:>16}".format("threads","Meter marks/s","Striped marks/s"))
+    for nb_threads in THREADS:
+        print("{:>8} {:>16.0f} {:>16.0f}".format(nb_threads,bench(Meter,nb_threads),bench(StripedMeter,nb_threads)))
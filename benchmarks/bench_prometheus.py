@@ -0,0 +1,55 @@
+"""
+Measure the time to render the whole registry in the text format of Prometheus with
+:py:meth:`livemetrics.LiveMetrics.get_prometheus`, against a translation of the dictionaries
+of :py:meth:`livemetrics.LiveMetrics.get_metrics` and :py:meth:`livemetrics.LiveMetrics.get_histograms`
+formatting the names and the labels of each line at each scrape, for 10k and 100k meters
+and 1k histograms.
+
+Usage::
+
+    python benchmarks/bench_prometheus.py
+"""
+
+import time
+
+import livemetrics
+
+SCRAPES = 5
+
+def translate(lm):
+    # What an adapter of the JSON responses would do
+    lines = ['# TYPE livemetrics_meter_total counter\n']
+    metrics = lm.get_metrics()
+    for event,results in metrics.items():
+        for result,data in results.items():
+            lines.append('livemetrics_meter_total{event="%s",result="%s"} %s\n' % (event,result,data['count']))
+    lines.append('# TYPE livemetrics_meter_rate gauge\n')
+    for event,results in metrics.items():
+        for result,data in results.items():
+            for window in ('1','5','15'):
+                lines.append('livemetrics_meter_rate{event="%s",result="%s",window="%sm"} %r\n' % (event,result,window,data['rate'+window]))
+    lines.append('# TYPE livemetrics_histogram summary\n')
+    for event,data in lm.get_histograms().items():
+        for quantile,value in data['quantiles'].items():
+            lines.append('livemetrics_histogram{event="%s",quantile="%s"} %r\n' % (event,quantile,value))
+        lines.append('livemetrics_histogram_count{event="%s"} %d\n' % (event,data['count']))
+    return ''.join(lines)
+
+def bench(meters,render):
+    lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False)
+    for i in range(meters):
+        lm.mark('event-%d' % (i//10),'result-%d' % (i%10))
+    for i in range(1000):
+        for j in range(10):
+            lm.histogram('histo-%d' % i,j)
+    render(lm)
+    S = time.perf_counter()
+    for scrape in range(SCRAPES):
+        render(lm)
+    return (time.perf_counter()-S)/SCRAPES*1e3
+
+if __name__=='__main__':
+    print("{:>8} {:>14} {:>16}".format("meters","translation","get_prometheus"))
+    for meters in [10000,100000]:
+        print("{:>8} {:>11.1f} ms {:>13.1f} ms".format(meters,
+            bench(meters,translate),bench(meters,lambda lm: ''.join(lm.get_prometheus()))))
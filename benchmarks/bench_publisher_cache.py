@@ -0,0 +1,49 @@
+"""
+Measure the CPU used to publish the metrics to many pollers (dashboards, scrapers, probes)
+requesting the same response at the same time, with and without a
+:py:class:`livemetrics.publishers.cache.ResponseCache`.
+
+Usage::
+
+    python benchmarks/bench_publisher_cache.py
+"""
+
+import time
+import json
+import threading
+
+import livemetrics
+from livemetrics.publishers.cache import ResponseCache, cached
+
+METERS = 5000
+POLLS = 20
+
+def bench(pollers,cache):
+    lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False)
+    for i in range(METERS):
+        lm.mark('event-%d' % (i//10),i%10)
+    computed = [0]
+    def compute():
+        computed[0] += 1
+        return json.dumps(lm.get_metrics())
+    barrier = threading.Barrier(pollers)
+    def poll():
+        for i in range(POLLS):
+            # All the pollers request the response at the same time
+            barrier.wait()
+            cached(cache,'/monitoring/v1/metrics/meters',compute)
+    threads = [threading.Thread(target=poll) for i in range(pollers)]
+    S = time.process_time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    E = time.process_time()
+    return (E-S)*1e3,computed[0]
+
+if __name__=='__main__':
+    print("{:>8} {:>8} {:>12} {:>10}".format("pollers","cache","cpu (ms)","computed"))
+    for pollers in [1,10,50]:
+        for cache in [None,ResponseCache(ttl=0),ResponseCache(ttl=1.0)]:
+            name = "none" if cache is None else "ttl=%g" % cache.ttl
+            print("{:>8} {:>8} {:>12.0f} {:>10}".format(pollers,name,*bench(pollers,cache)))
@@ -0,0 +1,44 @@
+"""
+Compare the memory used per meter and the time to scrape all the meters with
+:py:meth:`livemetrics.LiveMetrics.get_metrics`, for the default registry of
+:py:class:`livemetrics.metrics.Meter` objects and the columnar
+:py:class:`livemetrics.metrics.MeterTable` (``LiveMetrics(columnar=True)``).
+
+Usage::
+
+    python benchmarks/bench_registry.py
+
+The scrape includes a tick of all the meters.
+"""
+
+import time
+import tracemalloc
+
+import livemetrics
+from livemetrics.metrics import Meter, ManualClock
+
+SIZES = [1000, 10000, 100000]
+
+def bench(nb_meters,columnar):
+    clock = ManualClock(10**12)
+    tracemalloc.start()
+    lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock,columnar=columnar)
+    for i in range(nb_meters):
+        lm.mark('event%d' % (i//10),'result%d' % (i%10))
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    scrapes = []
+    for i in range(3):
+        clock.advance(Meter.TICK_INTERVAL+1)
+        S = time.perf_counter()
+        lm.get_metrics()
+        scrapes.append(time.perf_counter()-S)
+    return memory/nb_meters,min(scrapes)*1000
+
+if __name__=='__main__':
+    print("{:>8} {:>14} {:>14} {:>14} {:>14}".format("meters","bytes/meter","columnar","scrape ms","columnar"))
+    for size in SIZES:
+        memory,scrape = bench(size,False)
+        cmemory,cscrape = bench(size,True)
+        print("{:>8} {:>14.0f} {:>14.0f} {:>14.1f} {:>14.1f}".format(size,memory,cmemory,scrape,cscrape))
@@ -0,0 +1,42 @@
+"""
+Measure the cost of :py:meth:`livemetrics.metrics.Reservoir.update` once the reservoir
+is full, for increasing reservoir sizes, with values recorded at 1M updates/s.
+
+Usage::
+
+    python benchmarks/bench_reservoir.py
+
+The cost per update must stay (almost) flat as the size of the reservoir grows.
+"""
+
+import time
+
+from livemetrics.metrics import Reservoir, ManualClock
+
+SIZES = [1028, 10000, 100000]
+RATE = 1000000
+WARMUP = 2000000
+UPDATES = 2000000
+BATCH = 1000
+
+def record(r,clock,updates):
+    # The clock moves every BATCH updates, at RATE updates/s
+    update = r.update
+    for i in range(updates//BATCH):
+        for j in range(BATCH):
+            update(42)
+        clock.advance(BATCH/RATE)
+
+def bench(size):
+    clock = ManualClock()
+    r = Reservoir(size,clock)
+    record(r,clock,WARMUP)
+    S = time.perf_counter()
+    record(r,clock,UPDATES)
+    E = time.perf_counter()
+    return (E-S)/UPDATES*1e9
+
+if __name__=='__main__':
+    print("{:>10} {:>14}".format("size","ns/update"))
+    for size in SIZES:
+        print("{:>10} {:>14.0f}".format(size,bench(size)))
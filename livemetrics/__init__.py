@@ -158,12 +158,20 @@ True
 """
 
 import os
+import json
+import math
 import time
+import threading
 import collections
+import itertools
 from functools import wraps
 import asyncio
 
 from livemetrics.metrics import *
+from livemetrics.multiprocess import MmapStore, MmapMeter, MmapGauge, MmapHistogram, aggregate
+
+#: Name of the result, event or histogram counting the metrics over the limits of :py:class:`LiveMetrics`
+OTHER = '__other__'
 
 __version__ = '0.9a'
 __author__ = "Olivier Heurtier"
@@ -184,6 +192,8 @@ if os.name=='posix':
 
     __CPU = None
     __CPU_RESULT = 0
+    # Protects the 2 previous values, the gauge can be read by several threads
+    __CPU_LOCK = threading.Lock()
     def get_cpu():
         # Retrieve CPU usage from /proc/self/stat
         global __CPU
@@ -192,8 +202,9 @@ if os.name=='posix':
             with open('/proc/self/stat','r') as f:
                 # 14th value is the user time, 16th value is the user time for children
                 parts = f.read().split(' ')
-                utime = (float(parts[14-1])+float(parts[16-1])) / os.sysconf('SC_CLK_TCK')
-                now = time.time()
+            utime = (float(parts[14-1])+float(parts[16-1])) / os.sysconf('SC_CLK_TCK')
+            with __CPU_LOCK:
+                now = time.monotonic()
                 if __CPU is None:
                     __CPU = (now,utime)
                     __CPU_RESULT = 0
@@ -236,13 +247,73 @@ class LiveMetrics(object):
     
     *memory_and_cpu*: a flag to activate gauges to report the memory (``memory``),
     number of threads (``num_threads``) and CPU usage (``cpu``) on Linux only. Default is True.
+
+    *striped*: a flag to use :py:class:`livemetrics.metrics.StripedMeter` for the meters,
+    so that threads marking the same event do not contend on a lock. Default is False.
+
+    *clock*: the :py:class:`livemetrics.metrics.Clock` used by the metrics and the timers.
+    Default is :py:data:`livemetrics.metrics.CLOCK`.
+
+    *ticker*: a :py:class:`livemetrics.metrics.Ticker` ticking the meters and histograms
+    of this object, so that recording a value does not check the time. The ticker can be
+    shared by several objects. It must be started by the application, for example with
+    :py:func:`livemetrics.publishers.aiohttp.ticker_context` for ``aiohttp``.
+
+    *window*: the length in seconds of a sliding window attached to every meter and histogram
+    (:py:class:`livemetrics.metrics.MeterWindow` and :py:class:`livemetrics.metrics.HistogramWindow`).
+    The meters then report ``window_count`` and ``window_rate``, and the histograms a ``window``
+    with the statistics of the values recorded during the window. Default is None (no window).
+
+    *window_buckets*: the number of buckets of the sliding windows, i.e. their resolution.
+    Default is 12.
+
+    *columnar*: a flag to store the meters in a :py:class:`livemetrics.metrics.MeterTable`,
+    column by column, so that ticking and reading all the meters is one pass over arrays.
+    For applications with many thousands of meters. The meters then have no sliding window,
+    and *striped* is ignored. Default is False.
+
+    *max_results*: the maximum number of results of an event. The next results are counted
+    in the result :py:data:`OTHER`. Default is None (no limit).
+
+    *max_metrics*: the maximum number of meters and histograms. The next ones are counted
+    in the meter ``(event,OTHER)``, ``(OTHER,OTHER)`` for a new event, or in the histogram
+    :py:data:`OTHER`. Default is None (no limit).
+
+    *ttl*: the time in seconds after which a meter or a histogram that did not record any
+    value is removed. The metrics are checked in the order of their last check, so only the
+    metrics not checked for *ttl* seconds are visited, when a metric is created or read.
+    A metric is removed between *ttl* and twice *ttl* seconds after its last value.
+    The meters of a *columnar* registry are not removed. A handle kept by the caller
+    (see :py:meth:`meter`) is detached from the registry once removed.
+    Default is None (metrics are never removed).
+
+    *multiprocess*: a directory shared by the worker processes of a pre-fork server, to store
+    the metrics of each process in a memory-mapped file (see :py:mod:`livemetrics.multiprocess`).
+    The metrics read are then aggregated over all the processes. The histograms are
+    :py:class:`livemetrics.metrics.HdrHistogram` objects, and *striped*, *window*
+    and *columnar* are ignored. The metrics which do not fit in the file anymore are only kept
+    in their process, and counted in the gauge ``multiprocess_dropped``. Default is None
+    (metrics of the current process).
+
+    *queue*: a :py:class:`livemetrics.metrics.IngestQueue`, so that :py:meth:`mark` and
+    :py:meth:`histogram` only append a tuple to the queue: the metrics are updated in batches
+    by the queue, which must be started by the application like a *ticker*. The queue is
+    flushed before the metrics are read. The items dropped when the queue is full are counted
+    in the gauge ``queue_dropped``. Default is None (metrics updated by the calling thread).
     
     .. versionadded:: 0.7
         *is_healthy* and *is_ready* can be coroutine if the publisher is ``aiohttp``.
 
+    .. versionadded:: 0.9
+        *striped*, *clock*, *ticker*, *window*, *window_buckets*, *columnar*,
+        *max_results*, *max_metrics*, *ttl*, *multiprocess*, *queue*
+
     """
+    #: Maximum number of keys rejected by *max_results* or *max_metrics* whose metric
+    #: :py:data:`OTHER` is kept, so that their next lookups do not take the lock
+    MAX_OVERFLOW = 4096
 
-    def __init__(self,version,about,is_healthy,is_ready=None,memory_and_cpu=True):
+    def __init__(self,version,about,is_healthy,is_ready=None,memory_and_cpu=True,striped=False,clock=None,ticker=None,window=None,window_buckets=12,columnar=False,max_results=None,max_metrics=None,ttl=None,multiprocess=None,queue=None):
         """
         Contructor.
         """
@@ -258,48 +329,578 @@ class LiveMetrics(object):
         if not callable(self.is_ready):
             self.is_ready = lambda: is_ready
 
+        self.clock = clock or CLOCK
+        self.ticker = ticker
+        self.queue = queue
+        # The metrics of all the processes are in memory-mapped files
+        self._store = None
+        if multiprocess is not None:
+            self._store = MmapStore(multiprocess)
+            striped = False
+            window = None
+            columnar = False
+        self.window = window
+        self.window_buckets = window_buckets
+        self.max_results = max_results
+        self.max_metrics = max_metrics
+        self.ttl = ttl
+
         # Init the structure to receive the metrics
-        self._meters = collections.defaultdict( lambda: collections.defaultdict(Meter) )
+        # Counters of the versions of the metrics of each kind (see get_version)
+        self._versions = dict(meters=itertools.count(1),gauges=itertools.count(1),histograms=itertools.count(1))
+        if columnar:
+            self._table = MeterTable(self.clock)
+            self._table.versions = self._versions['meters']
+            self._meters = self._table.meters
+            if self.ticker is not None:
+                self.ticker.register(self._table)
+        else:
+            self._table = None
+            meter = StripedMeter if striped else Meter
+            self._meters = collections.defaultdict( lambda: collections.defaultdict(lambda: self._register(meter(self.clock))) )
         self._gauges = collections.defaultdict( Gauge )
-        self._histograms = collections.defaultdict( Histogram )
+        self._histograms = collections.defaultdict( lambda: self._register(Histogram(self.clock)) )
+
+        # Protects the creation and the removal of the meters and histograms
+        self._lock = threading.RLock()
+        self._nb_metrics = 0
+        # Meter or histogram OTHER of the keys rejected by max_results or max_metrics,
+        # forgotten when a metric is removed
+        self._overflow = dict(meters={},histograms={})
+        # Keys of the meters and histograms, from the least recently checked,
+        # with the time of the check and the count of the metric at that time
+        self._idle = collections.OrderedDict()
+        # Number of metrics removed, to rebind the timers
+        self._evictions = 0
+        # Indexes of the labels of the metrics
+        self._labels = dict(meters=LabelIndex(),gauges=LabelIndex(),histograms=LabelIndex())
+        # For each kind of metrics, its version with the last version drawn by get_version,
+        # and the time of the next decay of the meters and histograms (see _decay)
+        self._kind_versions = dict(meters=(0,0),gauges=(0,0),histograms=(0,0))
+        self._next_decay = dict(meters=0,histograms=0)
+        # Gauges whose value is a callable, read at each check of the versions
+        self._callables = set()
+        # With multiprocess, the signature and the version of each metric at the last check
+        # (see _scan)
+        self._signatures = dict(meters={},gauges={},histograms={})
+        # Last JSON of each metric, with the signature of the metric when it was encoded
+        # (see get_metrics_json)
+        self._fragments = dict(meters={},gauges={},histograms={})
+        # Text before the values of the lines of each metric in the format of Prometheus
+        # (see get_prometheus)
+        self._exposition = dict(meters={},gauges={},histograms={})
 
         if memory_and_cpu and os.name=='posix':
             self.gauge('memory',get_memory)
             self.gauge('cpu',get_cpu)
             self.gauge('num_threads',get_num_threads)
+        if queue is not None:
+            self.gauge('queue_dropped',lambda: queue.dropped)
+        if self._store is not None:
+            store = self._store
+            self.gauge('multiprocess_dropped',lambda: store.dropped)
+
+    def _register(self,metric):
+        # A new metric is a change of its kind
+        metric.versions = self._versions['meters' if isinstance(metric,Meter) else 'histograms']
+        metric.version = next(metric.versions)
+        if self.ticker is not None:
+            self.ticker.register(metric)
+        if self.window is not None:
+            if isinstance(metric,Meter):
+                metric.window = MeterWindow(self.window,self.window_buckets,self.clock)
+            else:
+                metric.window = HistogramWindow(self.window,self.window_buckets,self.clock,lock=metric.lock)
+        return metric
+
+    def meter(self,event,result,**labels):
+        """
+        Return the :py:class:`livemetrics.metrics.Meter` of the **event** with the **result**,
+        creating it if needed. The meter can be kept by the caller to mark the events with
+        a single method call, without looking up the metric each time:
+
+        >>> lm = LiveMetrics("version","about",True,memory_and_cpu=False)
+        >>> m = lm.meter('event','ok')
+        >>> m.mark()
+        >>> lm.get_metrics('event','ok','count')
+        1
+
+        *labels*: additional labels of the meter. A labelled meter is reported as a result
+        of the event named with its labels (see :py:meth:`livemetrics.metrics.LabelIndex.format`):
+
+        >>> lm.meter('event','ok',tenant='A').mark()
+        >>> lm.get_metrics('event','ok{tenant="A"}','count')
+        1
+        >>> list(lm.get_metrics(labels={'tenant':'A'})['event'])
+        ['ok{tenant="A"}']
+
+        .. versionadded:: 0.9
+        """
+        if labels:
+            key = LabelIndex.key(event=event,result=result,**labels)
+            meter = self._labels['meters'].metrics.get(key)
+            if meter is None:
+                meter = self._overflow['meters'].get(key)
+                if meter is None:
+                    meter = self._new_meter(event,LabelIndex.format(result,labels),key)
+            return meter
+        results = self._meters.get(event)
+        if results is not None:
+            meter = results.get(result)
+            if meter is not None:
+                return meter
+        meter = self._overflow['meters'].get((event,result))
+        if meter is not None:
+            return meter
+        return self._new_meter(event,result)
+
+    def _new_meter(self,event,result,key=None):
+        with self._lock:
+            requested = key or (event,result)
+            overflow = False
+            if self.max_metrics is not None and self._nb_metrics>=self.max_metrics:
+                if event not in self._meters:
+                    event = OTHER
+                result = OTHER
+                key = None
+                overflow = True
+            results = self._meters[event]
+            if result not in results:
+                if self.max_results is not None and len(results)>=self.max_results:
+                    result = OTHER
+                    key = None
+                    overflow = True
+            if result not in results:
+                self._nb_metrics += 1
+                if self._table is None:
+                    self._track(('meter',event,result))
+                if self._store is not None:
+                    results[result] = self._register(MmapMeter(self._store,event,result,self.clock))
+                key = key or LabelIndex.key(event=event,result=result)
+                self._labels['meters'].add(key,results[result],(event,result))
+            if overflow:
+                self._keep_overflow('meters',requested,results[result])
+            return results[result]
+
+    def _new_histogram(self,name,factory,key=None):
+        with self._lock:
+            requested = key or name
+            overflow = False
+            if name not in self._histograms and self.max_metrics is not None and self._nb_metrics>=self.max_metrics:
+                name = OTHER
+                key = None
+                overflow = True
+            if name not in self._histograms:
+                self._nb_metrics += 1
+                self._track(('histogram',name))
+                if self._store is not None:
+                    self._histograms[name] = self._register(MmapHistogram(self._store,name,self.clock))
+                elif factory is not None:
+                    self._histograms[name] = self._register(factory(self.clock))
+                key = key or LabelIndex.key(event=name)
+                self._labels['histograms'].add(key,self._histograms[name],name)
+            if overflow:
+                self._keep_overflow('histograms',requested,self._histograms[name])
+            return self._histograms[name]
+
+    def _keep_overflow(self,kind,key,metric):
+        # Keep the metric OTHER counting the key rejected, with the lock
+        overflow = self._overflow[kind]
+        while len(overflow)>=self.MAX_OVERFLOW:
+            del overflow[next(iter(overflow))]
+        overflow[key] = metric
+
+    def _new_gauge(self,name,key=None):
+        with self._lock:
+            if name not in self._gauges:
+                if self._store is not None:
+                    self._gauges[name] = MmapGauge(self._store,name)
+                gauge = self._gauges[name]
+                gauge.versions = self._versions['gauges']
+                gauge.version = next(gauge.versions)
+                key = key or LabelIndex.key(name=name)
+                self._labels['gauges'].add(key,self._gauges[name],name)
+            return self._gauges[name]
+
+    def select(self,kind,**labels):
+        """
+        Return the metrics of *kind* (``meters``, ``gauges`` or ``histograms``) having all
+        the *labels*, as a dictionary indexed by their key in the registry: ``(event,result)``
+        for the meters, the name for the gauges and histograms.
+
+        The metrics are found with an index per label name, without scanning the registry.
+        Each metric has the labels given when it was created, and:
+
+        - ``event`` and ``result`` for a meter
+        - ``name`` for a gauge
+        - ``event`` for an histogram
+
+        >>> lm = LiveMetrics("version","about",True,memory_and_cpu=False)
+        >>> lm.mark('request','ok',tenant='A',route='/a')
+        >>> lm.mark('request','ok',tenant='B',route='/a')
+        >>> list(lm.select('meters',tenant='A'))
+        [('request', 'ok{route="/a",tenant="A"}')]
+
+        .. versionadded:: 0.9
+        """
+        with self._lock:
+            return self._labels[kind].select(**labels)
+
+    def _items(self,registry):
+        # Copy of the items of a registry, while other threads may add or remove metrics
+        with self._lock:
+            return list(registry.items())
+
+    def get_version(self,kind,name=None,result=None):
+        """
+        Return the version of the metrics of *kind* (``meters``, ``gauges`` or ``histograms``),
+        not to be confused with the :py:attr:`version` of the application.
+
+        *name*: the event of a meter or of an histogram, or the name of a gauge, to return
+        the version of this metric only. For the meters, the greatest version of the results
+        of the event, or of its *result* if provided. The version of a missing metric is 0.
+
+        Each metric has a version, drawn from a counter of its kind when the metric changes:
+        when it records a value, and at each tick decaying the rates of a meter or the values
+        of an histogram. The version of a kind changes if versions were drawn since the
+        previous call, by its metrics or by a removal: reading the version does not depend
+        on the number of metrics. The meters and the histograms are ticked when the first
+        of them is due, as by a :py:class:`livemetrics.metrics.Ticker`, and the gauges whose
+        value is a callable are read.
+
+        The metrics changed after a version are read with the parameter *since* of
+        :py:meth:`get_metrics`, :py:meth:`get_gauges` and :py:meth:`get_histograms`:
+
+        >>> lm = LiveMetrics("version","about",True,memory_and_cpu=False)
+        >>> lm.mark('event','ok')
+        >>> lm.mark('event','error')
+        >>> v = lm.get_version('meters')
+        >>> lm.get_version('meters')==v
+        True
+        >>> error = lm.get_version('meters','event','error')
+        >>> lm.mark('event','ok')
+        >>> data = lm.get_metrics(since=v)
+        >>> data['version']>v, list(data['metrics']['event'])
+        (True, ['ok'])
+        >>> lm.get_version('meters','event','error')==error
+        True
+
+        With *multiprocess*, the metrics are written by other processes: their values are
+        compared to the ones of the previous call.
+
+        .. versionadded:: 0.9
+        """
+        self.flush()
+        if self._store is not None:
+            registry = self._collect()[('meters','gauges','histograms').index(kind)]
+            version = self._scan(kind,registry,0)[0]
+            if name is None:
+                return version
+            signatures = self._signatures[kind]
+            keys = [name] if kind!='meters' else [(name,result)] if result is not None else [k for k in signatures if k[0]==name]
+            return max([signatures[k][1] for k in keys if k in signatures],default=0)
+        version = self._version(kind)
+        if name is None:
+            return version
+        if kind=='meters':
+            results = self._meters.get(name)
+            if results is None:
+                return 0
+            metrics = [results.get(result)] if result is not None else [v for k,v in self._items(results)]
+        else:
+            metrics = [(self._gauges if kind=='gauges' else self._histograms).get(name)]
+        return max([metric.version for metric in metrics if metric is not None],default=0)
+
+    def _version(self,kind):
+        # The version of kind changes if versions were drawn since the last version drawn
+        # here: the new version is greater than the versions of all the changes before it
+        self._decay(kind)
+        with self._lock:
+            version,drawn = self._kind_versions[kind]
+            last = next(self._versions[kind])
+            if last!=drawn+1:
+                version = last
+            self._kind_versions[kind] = (version,last)
+            return version
+
+    def _decay(self,kind):
+        # Tick the meters or the histograms when the first of them is due, so that the decay
+        # of their rates or of their values gives them a new version: this costs one pass
+        # over the metrics per tick interval, as a Ticker. The count of a sliding window
+        # decreases without any new value: the metrics counting values in their window get
+        # a new version at each bucket of the window
+        if kind=='gauges':
+            # Reading the value of a callable marks the gauge
+            for gauge in list(self._callables):
+                gauge.count
+            return
+        now = self.clock.now()
+        if now<self._next_decay[kind]:
+            return
+        if kind=='meters' and self._table is not None:
+            table = self._table
+            table.tick()
+            self._next_decay[kind] = table.last_tick+table._interval+1
+            return
+        interval = int((Meter.TICK_INTERVAL if kind=='meters' else Reservoir.TICK_INTERVAL)*1e9)
+        next_decay = now+interval
+        if self.window is not None:
+            next_decay = min(next_decay,now+int(self.window*1e9)//self.window_buckets)
+        with self._lock:
+            if kind=='meters':
+                metrics = [v for V in self._meters.values() for v in V.values()]
+            else:
+                metrics = list(self._histograms.values())
+        versions = self._versions[kind]
+        for metric in metrics:
+            metric.tick()
+            if metric.last_tick:
+                # 0 for the histograms whose values do not decay
+                next_decay = min(next_decay,metric.last_tick+interval+1)
+            if metric.window is not None and metric.window.count:
+                metric.version = next(versions)
+        self._next_decay[kind] = next_decay
+
+    def _changes(self,kind,metrics,since):
+        # Return the version of kind with the keys of the metrics changed after since
+        if self._store is not None:
+            return self._scan(kind,metrics,since)
+        version = self._version(kind)
+        if kind=='meters':
+            with self._lock:
+                items = [((K,k),v) for K,V in metrics.items() for k,v in V.items()]
+        else:
+            items = self._items(metrics)
+        return version,set(key for key,v in items if v.version>since)
+
+    def _scan(self,kind,metrics,since):
+        # With multiprocess, give a new version to the metrics whose signature changed since
+        # the last check, and return the version of the kind with the keys of the metrics
+        # changed after since
+        if kind=='meters':
+            with self._lock:
+                meters = [((K,k),v) for K,V in metrics.items() for k,v in V.items()]
+            # The meters aggregated over the processes are already decayed
+            items = [(key,(v.count,v.rate1,v.rate5,v.rate15)) for key,v in meters]
+        elif kind=='gauges':
+            # The callables of the gauges are called without the lock
+            items = [(k,(v.count,v.min,v.max)) for k,v in self._items(metrics)]
+        else:
+            items = []
+            for k,v in self._items(metrics):
+                v.tick()
+                items.append((k,(v.count,v.last_tick)))
+        with self._lock:
+            signatures = self._signatures[kind]
+            # All the metrics changed since the last check get the same new version
+            version = None
+            changed = set()
+            for key,signature in items:
+                entry = signatures.get(key)
+                if entry is None or entry[0]!=signature:
+                    if version is None:
+                        version = next(self._versions[kind])
+                    entry = signatures[key] = (signature,version)
+                if entry[1]>since:
+                    changed.add(key)
+            if len(signatures)>len(items):
+                # Removed metrics
+                present = set(key for key,signature in items)
+                for key in [key for key in signatures if key not in present]:
+                    del signatures[key]
+                if version is None:
+                    version = next(self._versions[kind])
+            if version is not None:
+                self._kind_versions[kind] = (version,version)
+            return self._kind_versions[kind][0],changed
+
+    def _track(self,key):
+        if self.ttl is not None:
+            self.evict()
+            self._idle[key] = (self.clock.now(),0)
+
+    def flush(self):
+        """
+        Apply the events waiting in the *queue*, and remove the idle metrics (see :py:meth:`evict`).
+        This is done automatically before the metrics are read.
+
+        .. versionadded:: 0.9
+        """
+        if self.queue is not None:
+            self.queue.flush()
+        self.evict()
 
-    def mark(self,event,result):
+    def evict(self):
+        """
+        Remove the meters and histograms that did not record any value during *ttl* seconds.
+        Only the metrics that were not checked since *ttl* seconds are checked.
+        This is done automatically when a metric is created or read.
+
+        .. versionadded:: 0.9
+        """
+        if self.ttl is None:
+            return
+        with self._lock:
+            now = self.clock.now()
+            limit = now-int(self.ttl*1e9)
+            idle = self._idle
+            while idle:
+                key = next(iter(idle))
+                checked,count = idle[key]
+                if checked>limit:
+                    break
+                if key[0]=='meter':
+                    results = self._meters[key[1]]
+                    metric = results[key[2]]
+                else:
+                    metric = self._histograms[key[1]]
+                if metric.count!=count:
+                    # Used since the last check: check it again in ttl seconds
+                    idle.move_to_end(key)
+                    idle[key] = (now,metric.count)
+                    continue
+                del idle[key]
+                if key[0]=='meter':
+                    del results[key[2]]
+                    if not results:
+                        del self._meters[key[1]]
+                    self._labels['meters'].remove(key[1:])
+                    self._fragments['meters'].pop(key[1:],None)
+                    self._exposition['meters'].pop(key[1:],None)
+                else:
+                    del self._histograms[key[1]]
+                    self._labels['histograms'].remove(key[1])
+                    self._fragments['histograms'].pop(key[1],None)
+                    self._exposition['histograms'].pop(key[1],None)
+                if self.ticker is not None:
+                    self.ticker.unregister(metric)
+                if self._store is not None:
+                    self._store.unbind(metric)
+                self._nb_metrics -= 1
+                self._evictions += 1
+                # A removal is a change of the kind
+                next(self._versions['meters' if key[0]=='meter' else 'histograms'])
+                # The keys rejected may now be accepted, and the metric may be OTHER
+                self._overflow = dict(meters={},histograms={})
+
+    def gauge_handle(self,name,**labels):
+        """
+        Return the :py:class:`livemetrics.metrics.Gauge` for this **name**, creating it if needed.
+
+        *labels*: additional labels of the gauge, as for :py:meth:`meter`.
+
+        .. versionadded:: 0.9
+        """
+        if labels:
+            key = LabelIndex.key(name=name,**labels)
+            gauge = self._labels['gauges'].metrics.get(key)
+            if gauge is None:
+                gauge = self._new_gauge(LabelIndex.format(name,labels),key)
+            return gauge
+        gauge = self._gauges.get(name)
+        if gauge is None:
+            gauge = self._new_gauge(name)
+        return gauge
+
+    def histogram_handle(self,name,factory=None,**labels):
+        """
+        Return the :py:class:`livemetrics.metrics.Histogram` for this **name**, creating it if needed.
+
+        *factory*: a callable creating the histogram from the clock, for example
+        :py:class:`livemetrics.metrics.SketchHistogram`. It is used only if the histogram
+        does not exist yet. Default is :py:class:`livemetrics.metrics.Histogram`.
+
+        *labels*: additional labels of the histogram, as for :py:meth:`meter`.
+
+        >>> lm = LiveMetrics("version","about",True,memory_and_cpu=False)
+        >>> h = lm.histogram_handle('latency',SketchHistogram)
+        >>> type(lm.histogram('latency',0.1)).__name__
+        'SketchHistogram'
+
+        .. versionadded:: 0.9
+        """
+        if labels:
+            key = LabelIndex.key(event=name,**labels)
+            his = self._labels['histograms'].metrics.get(key)
+            if his is None:
+                his = self._overflow['histograms'].get(key)
+                if his is None:
+                    his = self._new_histogram(LabelIndex.format(name,labels),factory,key)
+            return his
+        his = self._histograms.get(name)
+        if his is None:
+            his = self._overflow['histograms'].get(name)
+            if his is None:
+                his = self._new_histogram(name,factory)
+        return his
+
+    def mark(self,event,result,n=1,**labels):
         """
         Mark the execution of an event **event** with the **result**.
+        *n* specifies the number of events, to report them in bulk.
+        *labels* are the additional labels of the meter, see :py:meth:`meter`.
+
+        With a *queue*, the event is queued and the meter is marked later.
+
+        .. versionadded:: 0.9
+            *n*, *labels*, *queue*
         """
-        self._meters[event][result].mark()
+        if self.queue is not None:
+            self.queue.put((self._mark,event,result,n,labels))
+            return
+        self.meter(event,result,**labels).mark(n)
+
+    def _mark(self,event,result,n,labels):
+        self.meter(event,result,**labels).mark(n)
 
-    def gauge(self,name,value):
+    def gauge(self,name,value,**labels):
         """
         Register a new gauge for this **name**. If **value** is a callable,
         it will be called everytime the gauge value is accessed.
+        *labels* are the additional labels of the gauge, see :py:meth:`meter`.
 
         Return the Gauge object.
 
         .. versionadded:: 0.7
             The Gauge object is returned.
+
+        .. versionadded:: 0.9
+            *labels*
         """
-        g = self._gauges.setdefault(name, Gauge())
+        g = self.gauge_handle(name,**labels)
         g.mark(value)
+        if callable(value):
+            self._callables.add(g)
         return g
 
-    def histogram(self,name,value):
+    def histogram(self,name,value,factory=None,**labels):
         """
         Register a new value in a histogram and return the Histogram object.
 
+        *factory*: the type of histogram to create if it does not exist yet,
+        see :py:meth:`histogram_handle`.
+
+        *labels* are the additional labels of the histogram, see :py:meth:`meter`.
+
         .. versionadded:: 0.7
             The Histogram object is returned.
+
+        With a *queue*, the value is queued, recorded later, and None is returned.
+
+        .. versionadded:: 0.9
+            *factory*, *labels*, *queue*
         """
-        h = self._histograms.setdefault(name, Histogram())
+        if self.queue is not None:
+            self.queue.put((self._histogram,name,value,factory,labels))
+            return None
+        return self._histogram(name,value,factory,labels)
+
+    def _histogram(self,name,value,factory,labels):
+        h = self.histogram_handle(name,factory,**labels)
         h.update(value)
         return h
 
-    def timer(self,event,ok,error):
+    def timer(self,event,ok,error,factory=None):
         """
         Decorator to automate meter and histogram on one event.
 
@@ -309,72 +910,111 @@ class LiveMetrics(object):
 
         *error*: value when the function decorated terminates with an exception
 
+        *factory*: the type of histogram measuring the processing time,
+        see :py:meth:`histogram_handle`. Default is :py:class:`livemetrics.metrics.Histogram`.
+
         For each call of the decorated function, a call to :py:meth:`mark` is done for
         the *event* and result (*ok* or *error*), and a call to :py:meth:`histogram` is
         made to measure the processing time.
 
         *ok* and *error* can be callables that return a string compatible with json dictionary key
 
+        When *ok* and *error* are constants, the meters and the histogram are bound on the
+        first call, so the next calls do not look them up. With a *queue*, the events
+        and the processing times are queued as by :py:meth:`mark` and :py:meth:`histogram`.
+
         .. warning::
 
             If applied on an async function decorated with aiohttp :py:meth:`web.RouteTableDef`, it must be
             placed between the aiohttp annotation and the async function. Otherwise the aiohttp route
             will be decorated and not the actual function.
+
+        .. versionadded:: 0.9
+            *factory*
         """
 
         def _f(f,event=event,ok=ok,error=error):
+            # The metrics are bound on the first call and kept for the next ones
+            # (the meters only when ok/error are constants)
+            ok_meter = None
+            error_meter = None
+            his = None
+            evictions = self._evictions
+
+            def _check():
+                # Bind again the metrics if some were removed from the registry
+                nonlocal ok_meter,error_meter,his,evictions
+                if evictions!=self._evictions:
+                    ok_meter = error_meter = his = None
+                    evictions = self._evictions
+
+            def _mark_ok(ret):
+                nonlocal ok_meter
+                _check()
+                try:
+                    if callable(ok):
+                        self.mark(event,ok(ret))
+                    elif self.queue is not None:
+                        if ok is not None:
+                            self.mark(event,ok)
+                    elif ok is not None:
+                        if ok_meter is None:
+                            ok_meter = self.meter(event,ok)
+                        ok_meter.mark()
+                except:
+                    pass
+
+            def _mark_error(exc):
+                nonlocal error_meter
+                _check()
+                try:
+                    if callable(error):
+                        self.mark(event,error(exc))
+                    elif self.queue is not None:
+                        if error is not None:
+                            self.mark(event,error)
+                    elif error is not None:
+                        if error_meter is None:
+                            error_meter = self.meter(event,error)
+                        error_meter.mark()
+                except:
+                    pass
+
+            def _time(S):
+                nonlocal his
+                E = self.clock.counter()
+                if self.queue is not None:
+                    # Queued as the other events, recorded when the queue is flushed
+                    self.histogram(event,(E-S)/1e9,factory)
+                    return
+                if his is None:
+                    his = self.histogram_handle(event,factory)
+                his.update((E-S)/1e9)
+
             @wraps(f)
             async def __asyncf(*args,**kw):
-                S = time.time()
+                S = self.clock.counter()
                 try:
                     ret = await f(*args,**kw)
-                    try:
-                        if callable(ok):
-                            self.mark(event,ok(ret))
-                        elif ok is not None:
-                            self.mark(event,ok)
-                    except:
-                        pass
-                    E = time.time()
-                    self.histogram(event,E-S)
+                    _mark_ok(ret)
+                    _time(S)
                     return ret
                 except Exception as exc:
-                    try:
-                        if callable(error):
-                            self.mark(event,error(exc))
-                        elif error is not None:
-                            self.mark(event,error)
-                    except:
-                        pass   
-                    E = time.time()
-                    self.histogram(event,E-S)
+                    _mark_error(exc)
+                    _time(S)
                     raise
 
             @wraps(f)
             def __f(*args,**kw):
-                S = time.time()
+                S = self.clock.counter()
                 try:
                     ret = f(*args,**kw)
-                    try:
-                        if callable(ok):
-                            self.mark(event,ok(ret))
-                        elif ok is not None:
-                            self.mark(event,ok)
-                    except:
-                        pass
-                    E = time.time()
-                    self.histogram(event,E-S)
+                    _mark_ok(ret)
+                    _time(S)
                     return ret
                 except Exception as exc:
-                    try:
-                        if callable(error):
-                            self.mark(event,error(exc))
-                        elif error is not None:
-                            self.mark(event,error)
-                    except:
-                        pass   
-                    E = time.time()
-                    self.histogram(event,E-S)
+                    _mark_error(exc)
+                    _time(S)
                     raise
             if asyncio.iscoroutinefunction(f):
                 return __asyncf
@@ -385,7 +1025,7 @@ class LiveMetrics(object):
     #
     # Access to the metrics
     #
-    def get_metrics(self,event=None,result=None,metric=None):
+    def get_metrics(self,event=None,result=None,metric=None,labels=None,since=None):
         """
         Return a structure of dictionaries with the requested metrics.
 
@@ -393,37 +1033,85 @@ class LiveMetrics(object):
 
         *result*: the result of the event, as used in the call to :py:meth:`mark`
 
-        *metric*: the name of the metric, one of ``mean``, ``count``, ``rate1``, ``rate5``, ``rate15``.
+        *metric*: the name of the metric, one of ``mean``, ``count``, ``rate1``, ``rate5``, ``rate15``,
+        and ``window_count``, ``window_rate`` with a sliding window.
 
         If *metric* is not provided, all metrics are returned.
 
         If *result* is not provided, all results are returned.
 
         If *event* is not provided, all events are returned.
+
+        *labels*: a dictionary of labels, to return only the meters having these labels
+        (and the *event* and *result* if provided). The meters are found with the indexes
+        of :py:meth:`select`.
+
+        *since*: a version returned by :py:meth:`get_version`, to return only the meters
+        changed after this version (of the *event* if provided). The result is then a
+        dictionary with the current ``version`` of the meters, and the ``metrics``.
+
+        .. versionadded:: 0.9
+            *labels*, *since*
         """
+        self.flush()
+        meters = self._meters if self._store is None else self._collect()[0]
+        if since is not None:
+            if metric or result:
+                raise SyntaxError('if since is specified, result and metric must not be specified')
+            version,changed = self._changes('meters',meters,since)
+            if labels:
+                changed &= set(self.select('meters',**labels))
+            with self._lock:
+                items = [(K,list(V.items())) for K,V in meters.items() if not event or K==event]
+            data = {}
+            for K,V in items:
+                for k,meter in V:
+                    if (K,k) in changed:
+                        data.setdefault(K,{})[k] = meter.to_dict()
+            if event:
+                data = data.get(event,{})
+            return dict(version=version,metrics=data)
+        if labels:
+            labels = dict(labels)
+            if event:
+                labels['event'] = event
+            if result:
+                labels['result'] = result
+            data = {}
+            for (event,result),meter in self.select('meters',**labels).items():
+                if self._store is not None:
+                    meter = meters[event][result]
+                data.setdefault(event,{})[result] = getattr(meter,metric) if metric else meter.to_dict()
+            return data
         if event:
             # if event has not yet marked anything, it is not an error
             # we may request metrics, they will be null
-            if event in self._meters:
-                meters_dict = self._meters[event]
-            else:
+            meters_dict = meters.get(event)
+            if meters_dict is None:
                 # Build a temporary empty object (do not fail - maybe the meter will exist later)
-                meters_dict = collections.defaultdict(Meter)
+                meters_dict = {}
             if result:
+                meter = meters_dict.get(result)
+                if meter is None:
+                    meter = Meter(self.clock)
                 if metric:
-                    return getattr(meters_dict[result],metric)
+                    return getattr(meter,metric)
                 else:
-                    return meters_dict[result].to_dict()
+                    return meter.to_dict()
             else:
                 if metric:
                     raise SyntaxError('if metric is specified, result must also be specified')
-                return { k:v.to_dict() for k,v in meters_dict.items() }
+                return { k:v.to_dict() for k,v in self._items(meters_dict) }
         else:
             if metric or result:
                 raise SyntaxError('if metric/result is specified, event must also be specified')
-            return {K:{ k:v.to_dict() for k,v in V.items()} for K,V in self._meters.items()}
+            if self._table is not None:
+                return self._table.to_dict()
+            with self._lock:
+                items = [(K,list(V.items())) for K,V in meters.items()]
+            return {K:{ k:v.to_dict() for k,v in V} for K,V in items}
 
-    def get_gauges(self,name=None,metric=None):
+    def get_gauges(self,name=None,metric=None,labels=None,since=None):
         """
         Return a structure of dictionaries with the gauge metrics.
 
@@ -434,10 +1122,36 @@ class LiveMetrics(object):
         If *metric* is not provided, all metrics are returned.
 
         If *name* is not provided, all gauges are returned.
+
+        *labels*: a dictionary of labels, to return only the gauges having these labels,
+        see :py:meth:`get_metrics`.
+
+        *since*: a version, to return only the gauges changed after it, see :py:meth:`get_metrics`.
+
+        .. versionadded:: 0.9
+            *labels*, *since*
         """
+        self.flush()
+        gauges = self._gauges if self._store is None else self._collect()[1]
+        if since is not None:
+            if name or metric:
+                raise SyntaxError('if since is specified, name and metric must not be specified')
+            version,changed = self._changes('gauges',gauges,since)
+            if labels:
+                changed &= set(self.select('gauges',**labels))
+            data = { k:v.to_dict() for k,v in self._items(gauges) if k in changed }
+            return dict(version=version,metrics=data)
+        if labels:
+            labels = dict(labels)
+            if name:
+                labels['name'] = name
+            selected = self.select('gauges',**labels)
+            if self._store is not None:
+                selected = { k:gauges[k] for k in selected if k in gauges }
+            return { k:getattr(v,metric) if metric else v.to_dict() for k,v in selected.items() }
         if name:
-            if name in self._gauges:
-                gauge = self._gauges[name]
+            if name in gauges:
+                gauge = gauges[name]
             else:
                 # Build a temporary empty object (do not fail - maybe the gauge will exist later)
                 gauge = Gauge(0)
@@ -445,15 +1159,16 @@ class LiveMetrics(object):
                 return getattr(gauge,metric)
             return gauge.to_dict()
         else:
-            return { k:v.to_dict() for k,v in self._gauges.items() }
+            return { k:v.to_dict() for k,v in self._items(gauges) }
 
-    def get_histograms(self,event=None,metric=None,percentiles=[0.05, 0.25, 0.50, 0.75, 0.95],scale=10):
+    def get_histograms(self,event=None,metric=None,percentiles=[0.05, 0.25, 0.50, 0.75, 0.95],scale=10,labels=None,since=None):
         """
         Return a structure of dictionaries with the histograms metrics.
 
         *event*: the name of the event
 
-        *metric*: the name of the metric, one of ``count``, ``min``, ``max``, ``mean``, ``stddev``, ``quantiles``, ``distribution``
+        *metric*: the name of the metric, one of ``count``, ``min``, ``max``, ``mean``, ``stddev``, ``quantiles``, ``distribution``,
+        ``window`` (None without sliding window)
 
         *percentiles*: the list of percentiles for which the quantiles are returned
 
@@ -462,38 +1177,368 @@ class LiveMetrics(object):
         If *metric* is not provided, all metrics are returned.
 
         If *event* is not provided, all histograms are returned.
+
+        *labels*: a dictionary of labels, to return only the histograms having these labels,
+        see :py:meth:`get_metrics`.
+
+        *since*: a version, to return only the histograms changed after it, see :py:meth:`get_metrics`.
+
+        .. versionadded:: 0.9
+            *labels*, *since*
         """
+        self.flush()
+        histograms = self._histograms if self._store is None else self._collect()[2]
+        if since is not None:
+            if event or metric:
+                raise SyntaxError('if since is specified, event and metric must not be specified')
+            version,changed = self._changes('histograms',histograms,since)
+            if labels:
+                changed &= set(self.select('histograms',**labels))
+            data = { k:self._histogram_data(v,percentiles,scale) for k,v in self._items(histograms) if k in changed }
+            return dict(version=version,metrics=data)
+        if labels:
+            labels = dict(labels)
+            if event:
+                labels['event'] = event
+            selected = self.select('histograms',**labels)
+            if self._store is not None:
+                selected = { k:histograms[k] for k in selected }
+            return { k:self._histogram_metric(v,metric,percentiles,scale) for k,v in selected.items() }
         if event:
-            if event in self._histograms:
-                his = self._histograms[event]
-            else:
+            his = histograms.get(event)
+            if his is None:
                 # Build a temporary empty object (do not fail - maybe the histogram will exist later)
-                his = Histogram()
-            data = {}
-            if not metric:
-                data.update(his.to_dict())
-                snapshot = his.snapshot
-                data['quantiles'] = {p:snapshot.get_value(p) for p in percentiles}
-                data['distribution'] = snapshot.get_distribution(scale)
-                return data
-            elif metric=='quantiles':
-                snapshot = his.snapshot
-                data = {p:snapshot.get_value(p) for p in percentiles}
-            elif metric=='distribution':
-                snapshot = his.snapshot
-                data = snapshot.get_distribution(scale)
-            else:
-                data = his.to_dict()[metric]
+                his = Histogram(self.clock)
+            data = self._histogram_metric(his,metric,percentiles,scale)
         else:
             D = {}
-            for event in self._histograms.keys():
-                his = self._histograms[event]
-                data = {}
-                data.update(his.to_dict())
-                snapshot = his.snapshot
-                data['quantiles'] = {p:snapshot.get_value(p) for p in percentiles}
-                data['distribution'] = snapshot.get_distribution(scale)
-                D[event] = data
+            for event,his in self._items(histograms):
+                D[event] = self._histogram_data(his,percentiles,scale)
             data = D
         return data
 
+    def get_metrics_json(self,event=None,result=None,metric=None,labels=None,since=None):
+        """
+        Return the result of :py:meth:`get_metrics` encoded in JSON, as :py:func:`json.dumps`.
+
+        The lists of meters (without *result*, *metric* and *labels*) are assembled from the
+        last JSON of each meter, encoded again only if the meter changed: new events or a tick
+        of its rates. Only the ``mean``, changing all the time, is encoded for each meter.
+        The meters with a sliding window and the meters of a *multiprocess* registry are
+        always encoded.
+
+        >>> lm = LiveMetrics("version","about",True,memory_and_cpu=False)
+        >>> lm.mark('event','ok')
+        >>> lm.get_metrics_json()==json.dumps(lm.get_metrics())
+        True
+
+        .. versionadded:: 0.9
+        """
+        if result or metric or labels or self._store is not None:
+            return json.dumps(self.get_metrics(event,result,metric,labels,since))
+        self.flush()
+        meters = self._meters
+        if since is not None:
+            version,changed = self._changes('meters',meters,since)
+        with self._lock:
+            items = [(K,list(V.items())) for K,V in meters.items() if not event or K==event]
+        if self._table is not None and self._table.auto_tick:
+            # The meters of a table tick together
+            self._table.tick()
+        fragments = self._fragments['meters']
+        now = self.clock.now()
+        parts = []
+        for K,V in items:
+            results = []
+            for k,meter in V:
+                key = (K,k)
+                if since is not None and key not in changed:
+                    continue
+                if meter.window is not None:
+                    results.append(_json_key(k)+': '+json.dumps(meter.to_dict()))
+                    continue
+                if self._table is None and now-meter.last_tick>meter._interval:
+                    meter.tick()
+                count = meter.count
+                signature = (count,meter.last_tick)
+                entry = fragments.get(key)
+                if entry is None or entry[0]!=signature:
+                    data = meter.to_dict()
+                    del data['mean']
+                    entry = fragments[key] = (signature,_json_key(k)+': {"mean": ',', '+json.dumps(data)[1:],meter.start)
+                # The mean as computed by the meter
+                period = (now-entry[3])/1e9
+                mean = count/period if count and period>0.1 else 0.0
+                results.append(entry[1]+float.__repr__(mean)+entry[2])
+            if results or since is None:
+                parts.append((K,_json_object(results)))
+        if event:
+            data = parts[0][1] if parts else '{}'
+        else:
+            data = _json_object([_json_key(K)+': '+results for K,results in parts])
+        if since is not None:
+            return '{"version": %d, "metrics": %s}' % (version,data)
+        return data
+
+    def get_gauges_json(self,name=None,metric=None,labels=None,since=None):
+        """
+        Return the result of :py:meth:`get_gauges` encoded in JSON, as :py:func:`json.dumps`.
+        The list of gauges is assembled from the last JSON of each gauge, encoded again only if
+        its value changed, see :py:meth:`get_metrics_json`.
+
+        .. versionadded:: 0.9
+        """
+        if name or metric or labels or self._store is not None:
+            return json.dumps(self.get_gauges(name,metric,labels,since))
+        self.flush()
+        if since is not None:
+            version,changed = self._changes('gauges',self._gauges,since)
+        fragments = self._fragments['gauges']
+        parts = []
+        for k,gauge in self._items(self._gauges):
+            if since is not None and k not in changed:
+                continue
+            # In the order of Gauge.to_dict: the count may change the min and max
+            signature = (gauge.min,gauge.max,gauge.count)
+            entry = fragments.get(k)
+            if entry is None or entry[0]!=signature:
+                data = dict(zip(('min','max','count'),signature))
+                entry = fragments[k] = (signature,_json_key(k)+': '+json.dumps(data))
+            parts.append(entry[1])
+        data = _json_object(parts)
+        if since is not None:
+            return '{"version": %d, "metrics": %s}' % (version,data)
+        return data
+
+    def get_histograms_json(self,event=None,metric=None,percentiles=[0.05, 0.25, 0.50, 0.75, 0.95],scale=10,labels=None,since=None):
+        """
+        Return the result of :py:meth:`get_histograms` encoded in JSON, as :py:func:`json.dumps`.
+        The list of histograms is assembled from the last JSON of each histogram, encoded again
+        only if its count or its snapshot changed, or for other *percentiles* and *scale*,
+        see :py:meth:`get_metrics_json`.
+
+        .. versionadded:: 0.9
+        """
+        if event or metric or labels or self._store is not None:
+            return json.dumps(self.get_histograms(event,metric,percentiles,scale,labels,since))
+        self.flush()
+        if since is not None:
+            version,changed = self._changes('histograms',self._histograms,since)
+        fragments = self._fragments['histograms']
+        params = (tuple(percentiles),scale)
+        parts = []
+        for k,his in self._items(self._histograms):
+            if since is not None and k not in changed:
+                continue
+            if his.window is not None:
+                parts.append(_json_key(k)+': '+json.dumps(self._histogram_data(his,percentiles,scale)))
+                continue
+            signature = (his.count,params)
+            snapshot = his.snapshot
+            entry = fragments.get(k)
+            if entry is None or entry[0]!=signature or entry[1] is not snapshot:
+                data = self._histogram_data(his,percentiles,scale,snapshot)
+                entry = fragments[k] = (signature,snapshot,_json_key(k)+': '+json.dumps(data))
+            parts.append(entry[2])
+        data = _json_object(parts)
+        if since is not None:
+            return '{"version": %d, "metrics": %s}' % (version,data)
+        return data
+
+    def get_prometheus(self,percentiles=[0.05, 0.25, 0.50, 0.75, 0.95],buckets=None):
+        """
+        Return an iterator on the text of all the metrics in the format of Prometheus
+        (version 0.0.4), one or a few lines at a time. The lines are rendered one metric after
+        the other while iterating, without building the structure of :py:meth:`get_metrics`:
+
+        - the meters are the counter ``livemetrics_meter_total``, and the gauge
+          ``livemetrics_meter_rate`` with the moving average rates in the label ``window``
+          (``1m``, ``5m`` and ``15m``)
+        - the gauges are the gauges ``livemetrics_gauge``, ``livemetrics_gauge_min``
+          and ``livemetrics_gauge_max``
+        - the histograms are the summary ``livemetrics_histogram`` with the quantiles of
+          the *percentiles*, or an histogram with the cumulative counts of the upper bounds
+          *buckets* if provided, estimated from the values kept by the histograms. As the
+          histograms do not keep all the values, there is no ``_sum``.
+
+        The labels are ``event`` and ``result`` for the meters, ``name`` for the gauges,
+        ``event`` for the histograms, and the labels of the metric. The text before the value
+        of each line is kept for each metric: only the values are formatted at each call.
+
+        >>> lm = LiveMetrics("version","about",True,memory_and_cpu=False)
+        >>> lm.mark('request','ok',tenant='A')
+        >>> lm.gauge_handle('size').mark(10)
+        >>> print(''.join(lm.get_prometheus()),end='')
+        # HELP livemetrics_meter_total Number of events.
+        # TYPE livemetrics_meter_total counter
+        livemetrics_meter_total{event="request",result="ok",tenant="A"} 1
+        # HELP livemetrics_meter_rate Moving average rate of events per second.
+        # TYPE livemetrics_meter_rate gauge
+        livemetrics_meter_rate{event="request",result="ok",tenant="A",window="1m"} 0.0
+        livemetrics_meter_rate{event="request",result="ok",tenant="A",window="5m"} 0.0
+        livemetrics_meter_rate{event="request",result="ok",tenant="A",window="15m"} 0.0
+        # HELP livemetrics_gauge Current value.
+        # TYPE livemetrics_gauge gauge
+        livemetrics_gauge{name="size"} 10
+        # HELP livemetrics_gauge_min Minimum value.
+        # TYPE livemetrics_gauge_min gauge
+        livemetrics_gauge_min{name="size"} 10
+        # HELP livemetrics_gauge_max Maximum value.
+        # TYPE livemetrics_gauge_max gauge
+        livemetrics_gauge_max{name="size"} 10
+
+        .. versionadded:: 0.9
+        """
+        self.flush()
+        if self._store is None:
+            meters,gauges,histograms = self._meters,self._gauges,self._histograms
+        else:
+            meters,gauges,histograms = self._collect()
+
+        # Meters: all the counters, then all the rates
+        cache = self._exposition['meters']
+        refs = self._labels['meters'].refs
+        with self._lock:
+            items = [((K,k),meter) for K,V in meters.items() for k,meter in V.items()]
+        if self._table is not None and self._table.auto_tick:
+            # The meters of a table tick together
+            self._table.tick()
+        entries = []
+        for key,meter in items:
+            entry = cache.get(key)
+            if entry is None:
+                labels = _prometheus_labels(refs.get(key) or LabelIndex.key(event=key[0],result=key[1]))
+                # The 3 lines of the rates are formatted at once
+                rates = labels.replace('%','%%')
+                entry = cache[key] = ('livemetrics_meter_total{'+labels+'} ',
+                    ''.join('livemetrics_meter_rate{'+rates+',window="'+window+'"} %r\n' for window in ('1m','5m','15m')))
+            if not entries:
+                yield '# HELP livemetrics_meter_total Number of events.\n'
+                yield '# TYPE livemetrics_meter_total counter\n'
+            entries.append(entry)
+            yield entry[0]+str(meter.count)+'\n'
+        if entries:
+            yield '# HELP livemetrics_meter_rate Moving average rate of events per second.\n'
+            yield '# TYPE livemetrics_meter_rate gauge\n'
+        for entry,(key,meter) in zip(entries,items):
+            if self._store is None:
+                rates = meter.rates
+            else:
+                rates = (meter.rate1,meter.rate5,meter.rate15)
+            yield entry[1] % rates
+
+        # Gauges: read once, as their callables may be called
+        cache = self._exposition['gauges']
+        refs = self._labels['gauges'].refs
+        values = []
+        for k,gauge in self._items(gauges):
+            value = _prometheus_value(gauge.count)
+            if value is None:
+                continue
+            entry = cache.get(k)
+            if entry is None:
+                labels = _prometheus_labels(refs.get(k) or LabelIndex.key(name=k))
+                entry = cache[k] = tuple(name+'{'+labels+'} ' for name in ('livemetrics_gauge','livemetrics_gauge_min','livemetrics_gauge_max'))
+            values.append((entry,value,_prometheus_value(gauge.min),_prometheus_value(gauge.max)))
+        if values:
+            for i,help in enumerate(['Current value.','Minimum value.','Maximum value.']):
+                name = values[0][0][i].partition('{')[0]
+                yield '# HELP '+name+' '+help+'\n'
+                yield '# TYPE '+name+' gauge\n'
+                for entry,*value in values:
+                    yield entry[i]+value[i]+'\n'
+
+        # Histograms: summaries or histograms
+        cache = self._exposition['histograms']
+        refs = self._labels['histograms'].refs
+        if buckets is None:
+            params = ('summary',tuple(percentiles))
+        else:
+            buckets = sorted(buckets)
+            params = ('histogram',tuple(buckets))
+        first = True
+        for k,his in self._items(histograms):
+            entry = cache.get(k)
+            if entry is None or entry[0]!=params:
+                labels = _prometheus_labels(refs.get(k) or LabelIndex.key(event=k))
+                if buckets is None:
+                    prefixes = tuple('livemetrics_histogram{'+labels+',quantile="'+_prometheus_value(float(q))+'"} ' for q in percentiles)
+                else:
+                    prefixes = tuple('livemetrics_histogram_bucket{'+labels+',le="'+_prometheus_value(float(b))+'"} ' for b in buckets+[math.inf])
+                entry = cache[k] = (params,prefixes,'livemetrics_histogram_count{'+labels+'} ')
+            if first:
+                first = False
+                yield '# HELP livemetrics_histogram Distribution of the values.\n'
+                yield '# TYPE livemetrics_histogram '+params[0]+'\n'
+            count = his.count
+            snapshot = his.snapshot
+            if buckets is None:
+                values = snapshot.get_values(percentiles)
+            else:
+                values = [round(fraction*count) for fraction in snapshot.get_cumulative(buckets)]
+                values.append(count)
+            for prefix,value in zip(entry[1],values):
+                yield prefix+_prometheus_value(value)+'\n'
+            yield entry[2]+str(count)+'\n'
+
+    def _collect(self):
+        # The gauges with a callable are updated in the file before reading all the files
+        for name,gauge in self._items(self._gauges):
+            if gauge._callable:
+                gauge.count
+        return aggregate(self._store.collect(),self.clock)
+
+    def _histogram_metric(self,his,metric,percentiles,scale):
+        if not metric:
+            return self._histogram_data(his,percentiles,scale)
+        elif metric=='quantiles':
+            snapshot = his.snapshot
+            return dict(zip(percentiles,snapshot.get_values(percentiles)))
+        elif metric=='distribution':
+            snapshot = his.snapshot
+            return snapshot.get_distribution(scale)
+        elif metric=='window':
+            return self._window_data(his,percentiles)
+        else:
+            return his.to_dict()[metric]
+
+    def _histogram_data(self,his,percentiles,scale,snapshot=None):
+        # All the statistics come from the same snapshot
+        if snapshot is None:
+            snapshot = his.snapshot
+        data = his.to_dict(snapshot)
+        data['quantiles'] = dict(zip(percentiles,snapshot.get_values(percentiles)))
+        data['distribution'] = snapshot.get_distribution(scale)
+        if his.window is not None:
+            data['window'] = self._window_data(his,percentiles)
+        return data
+
+    def _window_data(self,his,percentiles):
+        if his.window is None:
+            return None
+        with his.lock:
+            return his.window.to_dict(percentiles)
+
+def _json_key(key):
+    # A key of a dictionary encoded as by json.dumps: the keys that are not strings are converted
+    return json.dumps(key if isinstance(key,str) else json.dumps(key))
+
+def _json_object(items):
+    # A JSON object from its encoded items
+    return '{'+', '.join(items)+'}'
+
+def _prometheus_labels(key):
+    # The labels of a metric in the format of Prometheus, from its labels in the LabelIndex
+    return ','.join(name+'="'+str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')+'"' for name,value in key)
+
+def _prometheus_value(value):
+    # A value in the format of Prometheus, None if it is not a number
+    if isinstance(value,float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value>0 else '-Inf'
+        return float.__repr__(value)
+    if isinstance(value,int):
+        return str(int(value))
+    return None
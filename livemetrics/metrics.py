@@ -1,11 +1,98 @@
 
 # Inspired by https://metrics.dropwizard.io/4.0.0/
 
+import abc
 import math
+import time
 import threading
-import datetime
+import weakref
+import asyncio
 import random
 import bisect
+import array
+import itertools
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#______________________________________________________________________________
+class Clock(object):
+    """
+    The source of time of the metrics.
+
+    Times are integers in nanoseconds, from an arbitrary origin. The default clock is
+    monotonic: it is not affected by the changes of the system time (NTP corrections,
+    daylight saving time, etc.).
+
+    *now* is used to tick the meters and decay the histograms, *counter* is used to measure
+    durations in :py:meth:`livemetrics.LiveMetrics.timer`.
+    """
+    now = staticmethod(time.monotonic_ns)
+    counter = staticmethod(time.perf_counter_ns)
+
+class ManualClock(Clock):
+    """
+    A :py:class:`Clock` moving only when requested, to control the time in tests.
+
+    >>> clock = ManualClock()
+    >>> clock.advance(1.5)
+    >>> clock.now(),clock.counter()
+    (1500000000, 1500000000)
+    """
+    def __init__(self,ns=0):
+        self.ns = ns
+
+    def now(self):
+        return self.ns
+
+    def counter(self):
+        return self.ns
+
+    def advance(self,seconds):
+        """
+        Move the clock forward by *seconds*.
+        """
+        self.ns += int(seconds*1e9)
+
+#: The default clock of the metrics
+CLOCK = Clock()
+
+#______________________________________________________________________________
+class LockPool(object):
+    """
+    A bounded set of re-entrant locks shared by the metrics. Each call to :py:meth:`get`
+    returns the next lock of the pool, so that tens of thousands of metrics use *size* locks.
+
+    Since two metrics may share a lock, a metric never calls another metric while it holds
+    its lock (the sliding windows of histograms use the lock of their histogram).
+
+    >>> pool = LockPool(2)
+    >>> pool.get() is pool.get()
+    False
+    >>> pool.get() is pool.locks[0]
+    True
+    """
+    __slots__ = ('locks','_next')
+
+    def __init__(self,size=64):
+        self.locks = [threading.RLock() for i in range(size)]
+        self._next = itertools.count()
+
+    def get(self):
+        """
+        Return a lock of the pool.
+        """
+        return self.locks[next(self._next)%len(self.locks)]
+
+#: The pool of locks used by the metrics
+LOCKS = LockPool()
+
+#: The versions of the metrics which are not in a :py:class:`livemetrics.LiveMetrics`,
+#: see :py:attr:`Meter.version`
+VERSIONS = itertools.count(1)
 
 #______________________________________________________________________________
 class Gauge(object):
@@ -59,8 +146,14 @@ class Gauge(object):
 
     """
 
+    __slots__ = ('lock','_callable','_value','_min','_max','version','versions')
+
     def __init__(self,value=None):
-        self.lock = threading.RLock()
+        self.lock = LOCKS.get()
+        #: Version of the gauge, drawn from *versions* each time its value or its statistics
+        #: change, see :py:attr:`Meter.version`
+        self.version = 0
+        self.versions = VERSIONS
         self._callable = None
         if callable(value):
             self._callable = value
@@ -73,13 +166,18 @@ class Gauge(object):
         """
         Register a new value in the gauge and update the statistics.
         """
+        # The callable is called without the lock: it may read other metrics
+        if callable(value):
+            self._callable = value
+            value = value()
         with self.lock:
-            if callable(value):
-                self._callable = value
-                value = self._callable()
+            min_ = min(self._min,value) if self._min else value
+            max_ = max(self._max,value) if self._max else value
+            if value!=self._value or min_!=self._min or max_!=self._max:
+                self.version = next(self.versions)
             self._value = value
-            self._min = min(self._min,value) if self._min else value
-            self._max = max(self._max,value) if self._max else value
+            self._min = min_
+            self._max = max_
 
     @property
     def count(self):
@@ -137,13 +235,27 @@ class EWMA(object):
     >>> e._tick()
     >>> e.rate  #doctest: +ELLIPSIS
     0.368017...
+
+    Events can also be reported in bulk. They are accumulated in a single counter until the
+    next tick, so the memory used does not depend on the rate of events:
+
+    >>> e.update(1000)
+    >>> e.update(1000)
+    >>> e.uncounted
+    2000
+
+    *lock*: the lock protecting the counter. A :py:class:`Meter` gives its own lock
+    to its moving averages. Default is a new lock.
     """
 
-    def __init__(self,nb_minutes=1,interval=5):
+    __slots__ = ('lock','initialized','_rate','uncounted','alpha','interval')
+
+    def __init__(self,nb_minutes=1,interval=5,lock=None):
+        self.lock = lock or threading.Lock()
         self.initialized = False
         self._rate = 0.0
 
-        self.uncounted = []
+        self.uncounted = 0
         self.alpha = 0.0
         self.interval = float(interval)*1000000.    # convert to microseconds
         self.alpha = 1.0 - math.exp(-interval / 60.0 / nb_minutes)
@@ -152,18 +264,24 @@ class EWMA(object):
         """
         Indicate an event has happened. *n* specifies the number of events.
         """
-        self.uncounted.append(n)
+        with self.lock:
+            self.uncounted += n
 
-    def _tick(self):
+    def _tick(self,ticks=1):
         # Mark the passage of time and decay the current rate accordingly.
-        count = sum(self.uncounted)
-        self.uncounted = []
-        instantRate = count/self.interval
-        if self.initialized:
-            self._rate = self._rate + (self.alpha*(instantRate-self._rate))
-        else:
-            self._rate = instantRate
-            self.initialized = True
+        # Only the first tick has events: the next ones decay the rate by (1-alpha) each,
+        # computed in one step.
+        with self.lock:
+            count = self.uncounted
+            self.uncounted = 0
+            instantRate = count/self.interval
+            if self.initialized:
+                self._rate = self._rate + (self.alpha*(instantRate-self._rate))
+            else:
+                self._rate = instantRate
+                self.initialized = True
+            if ticks>1:
+                self._rate *= (1.0-self.alpha)**(ticks-1)
 
     @property
     def rate(self):
@@ -176,6 +294,8 @@ class Meter(object):
     Each event is reported with a call to :py:meth:`mark`. The rates are decayed as time
     goes by.
 
+    *clock*: the :py:class:`Clock` giving the time. Default is :py:data:`CLOCK`.
+
     For testing, we will reduce the tick interval managing the decaying of values.
 
     >>> Meter.TICK_INTERVAL = 0.1
@@ -225,38 +345,81 @@ class Meter(object):
 
     >>> round(mtr.mean,1)
     1.9
+
+    Several events can be marked at once:
+
+    >>> mtr.mark(100)
+    >>> mtr.count
+    103
     """
     TICK_INTERVAL = 5
 
-    def __init__(self):
-        self.lock = threading.RLock()
-        self.ewma1 = EWMA(1,self.TICK_INTERVAL)
-        self.ewma5 = EWMA(5,self.TICK_INTERVAL)
-        self.ewma15 = EWMA(15,self.TICK_INTERVAL)
-        self._count = 0
-        self.start = datetime.datetime.now()
-        self.last_tick = datetime.datetime.now()
+    __slots__ = ('lock','clock','ewma1','ewma5','ewma15','_count','_merged','_interval','start',
+                 'last_tick','auto_tick','window','version','versions','__weakref__')
 
-    def mark(self):
+    def __init__(self,clock=None):
+        self.lock = LOCKS.get()
+        self.clock = clock or CLOCK
+        # The moving averages share the lock of the meter
+        self.ewma1 = EWMA(1,self.TICK_INTERVAL,self.lock)
+        self.ewma5 = EWMA(5,self.TICK_INTERVAL,self.lock)
+        self.ewma15 = EWMA(15,self.TICK_INTERVAL,self.lock)
+        self._count = 0
+        self._merged = 0
+        self._interval = int(self.TICK_INTERVAL*1e9)
+        self.start = self.clock.now()
+        self.last_tick = self.start
+        # False when ticked by a Ticker
+        self.auto_tick = True
+        #: Optional :py:class:`MeterWindow` counting the events of a sliding window
+        self.window = None
+        #: Version of the meter, drawn from the counter *versions* after each change: events
+        #: or a tick of the rates. The versions of the metrics sharing a counter are ordered
+        #: by their last change (see :py:meth:`livemetrics.LiveMetrics.get_version`)
+        self.version = 0
+        self.versions = VERSIONS
+
+    def mark(self,n=1):
+        """
+        Indicate an event has just occurred. *n* specifies the number of events.
+        """
+        with self.lock:
+            if self.auto_tick:
+                self._tick_if_necessary()
+            self._count += n
+            if self.window is not None:
+                self.window.mark(n)
+            self.version = next(self.versions)
+
+    def tick(self):
         """
-        Indicate an event has just occurred.
+        Decay the rates if the tick interval has elapsed. This is done automatically
+        when the meter is used, unless it is registered in a :py:class:`Ticker`.
         """
         with self.lock:
             self._tick_if_necessary()
-            self._count += 1
-            self.ewma1.update()
-            self.ewma5.update()
-            self.ewma15.update()
+
+    def _merge(self):
+        # Report the events counted since the last tick to the moving averages
+        count = self.count
+        n = count-self._merged
+        self._merged = count
+        if n:
+            self.ewma1.update(n)
+            self.ewma5.update(n)
+            self.ewma15.update(n)
 
     def _tick_if_necessary(self):
-        new_tick = datetime.datetime.now()
-        age = new_tick - self.last_tick
-        while age.seconds*1000.+age.microseconds/1000.>self.TICK_INTERVAL*1000.:
-            self.last_tick += datetime.timedelta(seconds=self.TICK_INTERVAL)
-            age = new_tick - self.last_tick
-            self.ewma1._tick()
-            self.ewma5._tick()
-            self.ewma15._tick()
+        age = self.clock.now() - self.last_tick
+        if age>self._interval:
+            self._merge()
+            # Number of whole intervals elapsed, whatever the duration of the idle period
+            ticks = (age-1)//self._interval
+            self.last_tick += self._interval*ticks
+            self.ewma1._tick(ticks)
+            self.ewma5._tick(ticks)
+            self.ewma15._tick(ticks)
+            self.version = next(self.versions)
 
     @property
     def mean(self):
@@ -265,13 +428,13 @@ class Meter(object):
         This gives a very rough estimation of the average number of events
         per seconds.
         """
-        if self._count==0:
+        count = self.count
+        if count==0:
             return 0.0
-        period = datetime.datetime.now()-self.start
-        period = period.seconds*1.0 + period.microseconds/1000000.
+        period = (self.clock.now()-self.start)/1e9
         if period<=0.1:
             return 0.0            
-        return self._count/period
+        return count/period
 
     @property
     def count(self):
@@ -307,6 +470,435 @@ class Meter(object):
             self._tick_if_necessary()
             return self.ewma15.rate
 
+    @property
+    def rates(self):
+        """
+        Return the 1-, 5- and 15-minute moving average rates, read together.
+
+        .. versionadded:: 0.9
+        """
+        with self.lock:
+            self._tick_if_necessary()
+            return (self.ewma1.rate,self.ewma5.rate,self.ewma15.rate)
+
+    @property
+    def window_count(self):
+        """
+        Return the exact number of events of the sliding window, None without window.
+        """
+        if self.window is None:
+            return None
+        with self.lock:
+            return self.window.count
+
+    @property
+    def window_rate(self):
+        """
+        Return the average rate of the sliding window, None without window.
+        """
+        if self.window is None:
+            return None
+        with self.lock:
+            return self.window.rate
+
+    def to_dict(self):
+        data = dict(
+            mean=self.mean,
+            count=self.count,
+            rate1=self.rate1,
+            rate5=self.rate5,
+            rate15=self.rate15
+        )
+        if self.window is not None:
+            data['window_count'] = self.window_count
+            data['window_rate'] = self.window_rate
+        return data
+
+#______________________________________________________________________________
+class StripedMeter(Meter):
+    """
+    A :py:class:`Meter` for events marked concurrently by many threads.
+
+    Each thread counts its events in its own cell, without taking the lock of the meter.
+    The cells are merged into the moving averages when the meter ticks, so the rates
+    and the count are the same as for a :py:class:`Meter`.
+
+    >>> mtr = StripedMeter()
+    >>> import threading
+    >>> def run():
+    ...     for i in range(1000):
+    ...         mtr.mark()
+    >>> threads = [threading.Thread(target=run) for i in range(8)]
+    >>> for t in threads: t.start()
+    >>> for t in threads: t.join()
+    >>> mtr.count
+    8000
+
+    When a thread ends, its cell is folded into the first cell of the meter, so that the
+    number of cells stays bounded with short-lived threads:
+
+    >>> len(mtr._cells)
+    1
+    """
+
+    __slots__ = ('_local','_cells','_next_tick')
+
+    def __init__(self,clock=None):
+        super().__init__(clock)
+        self._local = threading.local()
+        # The first cell counts the events of the threads which ended
+        self._cells = [[0]]
+        self._next_tick = self.last_tick + self._interval
+
+    def _new_cell(self):
+        cell = [0]
+        with self.lock:
+            self._cells.append(cell)
+        # The owner is only referenced by the storage of the thread, released when the
+        # thread ends
+        owner = _CellOwner()
+        finalizer = weakref.finalize(owner,_release_cell,weakref.ref(self),cell)
+        finalizer.atexit = False
+        self._local.owner = owner
+        self._local.cell = cell
+        return cell
+
+    def _release(self,cell):
+        # The counts are read without the lock: the list of the cells is replaced at once,
+        # with the cell folded into the first cell
+        with self.lock:
+            cells = [c for c in self._cells if c is not cell]
+            cells[0] = [cells[0][0]+cell[0]]
+            self._cells = cells
+
+    def mark(self,n=1):
+        """
+        Indicate an event has just occurred. *n* specifies the number of events.
+        """
+        if self.auto_tick and self.clock.now()>self._next_tick:
+            with self.lock:
+                self._tick_if_necessary()
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._new_cell()
+        # Only the owner thread writes in its cell
+        cell[0] += n
+        if self.window is not None:
+            with self.lock:
+                self.window.mark(n)
+        self.version = next(self.versions)
+
+    def _tick_if_necessary(self):
+        super()._tick_if_necessary()
+        self._next_tick = self.last_tick + self._interval
+
+    @property
+    def count(self):
+        """
+        Return the number of events reported to this object since it was created.
+        """
+        return sum([cell[0] for cell in self._cells])
+
+class _CellOwner(object):
+    # Object of the storage of a thread, whose finalization releases the cell of the thread
+    __slots__ = ('__weakref__',)
+
+def _release_cell(ref,cell):
+    # Called when a thread ends: the meter may have been deleted before
+    meter = ref()
+    if meter is not None:
+        meter._release(cell)
+
+#______________________________________________________________________________
+class MeterTable(object):
+    """
+    A registry of meters stored column by column: the counters and the states of the moving
+    averages of all the meters are kept in arrays, indexed by the id of the pair
+    ``(event,result)``. All the meters tick together, in one pass over the arrays, vectorized
+    with :py:mod:`numpy` when installed and the table has more than :py:attr:`NUMPY_THRESHOLD`
+    meters. The rates are the same as with :py:class:`Meter` objects created at the same time
+    as the table.
+
+    *clock*: the :py:class:`Clock` giving the time. Default is :py:data:`CLOCK`.
+
+    *locks*: the number of locks protecting the counters. A meter uses the lock of its id
+    modulo *locks*, so that threads marking different meters rarely contend.
+
+    The meters are accessed with :py:meth:`meter`, or with the nested dictionaries
+    :py:attr:`meters` (created on access):
+
+    >>> table = MeterTable()
+    >>> m = table.meter('event','ok')
+    >>> m.mark()
+    >>> table.meters['event']['ok'].mark(2)
+    >>> m.count
+    3
+    >>> table.to_dict()['event']['ok']['count']
+    3
+
+    This table is used by :py:class:`livemetrics.LiveMetrics` with *columnar*.
+
+    .. versionadded:: 0.9
+    """
+    #: Minimum number of meters to use :py:mod:`numpy`, when installed
+    NUMPY_THRESHOLD = 256
+
+    def __init__(self,clock=None,locks=16):
+        self.clock = clock or CLOCK
+        # Protects the creation of the meters and the ticks
+        self.lock = threading.RLock()
+        self._locks = [threading.Lock() for i in range(locks)]
+        self._ids = {}
+        self.keys = []
+        self.handles = []
+        self.counts = array.array('q')
+        self.merged = array.array('q')
+        self.starts = array.array('q')
+        self.initialized = array.array('b')
+        # Rates of the 1, 5 and 15 minutes moving averages, per microsecond as in EWMA
+        self.rates = [array.array('d'),array.array('d'),array.array('d')]
+        self.alphas = [1.0-math.exp(-Meter.TICK_INTERVAL/60.0/m) for m in (1,5,15)]
+        self._interval = int(Meter.TICK_INTERVAL*1e9)
+        self._interval_us = Meter.TICK_INTERVAL*1000000.
+        self.last_tick = self.clock.now()
+        self._next_tick = self.last_tick + self._interval
+        # False when ticked by a Ticker
+        self.auto_tick = True
+        self.meters = _TableEvents(self)
+        # Versions of the last events of each meter, and of the last tick, drawn from
+        # versions (see Meter.version)
+        self.versions = VERSIONS
+        self.marked = array.array('q')
+        self.tick_version = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def meter(self,event,result):
+        """
+        Return the :py:class:`TableMeter` of the **event** with the **result**, creating it if needed.
+        """
+        key = (event,result)
+        index = self._ids.get(key)
+        if index is None:
+            with self.lock:
+                index = self._ids.get(key)
+                if index is None:
+                    index = len(self.keys)
+                    self.keys.append(key)
+                    self.handles.append(TableMeter(self,index))
+                    # Growing the array may move it: no thread must be marking a meter
+                    for lock in self._locks:
+                        lock.acquire()
+                    try:
+                        self.counts.append(0)
+                        self.marked.append(next(self.versions))
+                    finally:
+                        for lock in self._locks:
+                            lock.release()
+                    self.merged.append(0)
+                    self.starts.append(self.clock.now())
+                    self.initialized.append(0)
+                    for rates in self.rates:
+                        rates.append(0.0)
+                    self._ids[key] = index
+        return self.handles[index]
+
+    def mark(self,index,n=1):
+        """
+        Indicate *n* events of the meter *index*.
+        """
+        if self.auto_tick and self.clock.now()>self._next_tick:
+            self.tick()
+        with self._locks[index%len(self._locks)]:
+            self.counts[index] += n
+            self.marked[index] = next(self.versions)
+
+    def tick(self):
+        """
+        Decay the rates of all the meters if the tick interval has elapsed. This is done
+        automatically when the table is used, unless it is registered in a :py:class:`Ticker`.
+        """
+        with self.lock:
+            self._tick_if_necessary()
+
+    def _tick_if_necessary(self):
+        age = self.clock.now() - self.last_tick
+        if age>self._interval:
+            ticks = (age-1)//self._interval
+            self.last_tick += self._interval*ticks
+            self._next_tick = self.last_tick + self._interval
+            if numpy is not None and len(self.keys)>=self.NUMPY_THRESHOLD:
+                self._tick_numpy(ticks)
+            else:
+                self._tick_python(ticks)
+            self.tick_version = next(self.versions)
+
+    def _tick_python(self,ticks):
+        counts = self.counts
+        merged = self.merged
+        initialized = self.initialized
+        decays = [(1.0-alpha)**(ticks-1) for alpha in self.alphas]
+        for i in range(len(self.keys)):
+            count = counts[i]
+            instant_rate = (count-merged[i])/self._interval_us
+            merged[i] = count
+            for rates,alpha,decay in zip(self.rates,self.alphas,decays):
+                if initialized[i]:
+                    rates[i] = (rates[i]+alpha*(instant_rate-rates[i]))*decay
+                else:
+                    rates[i] = instant_rate*decay
+            initialized[i] = 1
+
+    def _tick_numpy(self,ticks):
+        # Views on the arrays: they must be released before any meter is added
+        counts = numpy.frombuffer(self.counts,dtype=numpy.int64).copy()
+        merged = numpy.frombuffer(self.merged,dtype=numpy.int64)
+        initialized = numpy.frombuffer(self.initialized,dtype=numpy.int8)
+        instant_rate = (counts-merged)/self._interval_us
+        merged[:] = counts
+        first = initialized==0
+        for rates,alpha in zip(self.rates,self.alphas):
+            rates = numpy.frombuffer(rates,dtype=numpy.float64)
+            rates += alpha*(instant_rate-rates)
+            rates[first] = instant_rate[first]
+            if ticks>1:
+                rates *= (1.0-alpha)**(ticks-1)
+        initialized[:] = 1
+        del counts,merged,initialized,rates
+
+    def to_dict(self):
+        """
+        Return the metrics of all the meters, as :py:meth:`livemetrics.LiveMetrics.get_metrics`.
+        """
+        with self.lock:
+            if self.auto_tick:
+                self._tick_if_necessary()
+            now = self.clock.now()
+            if numpy is not None and len(self.keys)>=self.NUMPY_THRESHOLD:
+                counts = numpy.frombuffer(self.counts,dtype=numpy.int64).copy()
+                periods = (now-numpy.frombuffer(self.starts,dtype=numpy.int64))/1e9
+                means = numpy.where((counts>0)&(periods>0.1),counts/numpy.maximum(periods,0.1),0.0)
+                columns = [means.tolist(),counts.tolist()]
+                for rates in self.rates:
+                    columns.append((numpy.frombuffer(rates,dtype=numpy.float64)*1000000.).tolist())
+                del counts,periods,means
+            else:
+                counts = self.counts.tolist()
+                means = [_mean(count,(now-start)/1e9) for count,start in zip(counts,self.starts)]
+                columns = [means,counts]+[[rate*1000000. for rate in rates] for rates in self.rates]
+            keys = list(self.keys)
+        data = {}
+        for (event,result),mean,count,rate1,rate5,rate15 in zip(keys,*columns):
+            data.setdefault(event,{})[result] = dict(mean=mean,count=count,rate1=rate1,rate5=rate5,rate15=rate15)
+        return data
+
+def _mean(count,period):
+    if count==0 or period<=0.1:
+        return 0.0
+    return count/period
+
+class TableMeter(object):
+    """
+    A meter of a :py:class:`MeterTable`, with the same interface as :py:class:`Meter`.
+
+    .. versionadded:: 0.9
+    """
+    __slots__ = ('table','index')
+
+    #: Meters of a table have no sliding window
+    window = None
+
+    def __init__(self,table,index):
+        self.table = table
+        self.index = index
+
+    def mark(self,n=1):
+        """
+        Indicate an event has just occurred. *n* specifies the number of events.
+        """
+        self.table.mark(self.index,n)
+
+    @property
+    def count(self):
+        """
+        Return the number of events reported to this object since it was created.
+        """
+        return self.table.counts[self.index]
+
+    @property
+    def mean(self):
+        """
+        The number of events divided by the time the meter exists.
+        """
+        table = self.table
+        return _mean(self.count,(table.clock.now()-table.starts[self.index])/1e9)
+
+    @property
+    def start(self):
+        """
+        The time the meter was created.
+        """
+        return self.table.starts[self.index]
+
+    @property
+    def last_tick(self):
+        """
+        The time of the last tick of the table.
+        """
+        return self.table.last_tick
+
+    @property
+    def version(self):
+        """
+        The version of the meter, see :py:attr:`Meter.version`: all the meters of the table
+        change when it ticks.
+        """
+        table = self.table
+        return max(table.marked[self.index],table.tick_version)
+
+    def _rate(self,i):
+        table = self.table
+        with table.lock:
+            if table.auto_tick:
+                table._tick_if_necessary()
+            return table.rates[i][self.index]*1000000.
+
+    @property
+    def rate1(self):
+        """
+        Return the 1-minute moving average rate.
+        """
+        return self._rate(0)
+
+    @property
+    def rate5(self):
+        """
+        Return the 5-minute moving average rate.
+        """
+        return self._rate(1)
+
+    @property
+    def rate15(self):
+        """
+        Return the 15-minute moving average rate.
+        """
+        return self._rate(2)
+
+    @property
+    def rates(self):
+        """
+        Return the 1-, 5- and 15-minute moving average rates, read together.
+        """
+        table = self.table
+        i = self.index
+        with table.lock:
+            if table.auto_tick:
+                table._tick_if_necessary()
+            rates = table.rates
+            return (rates[0][i]*1000000.,rates[1][i]*1000000.,rates[2][i]*1000000.)
+
     def to_dict(self):
         return dict(
             mean=self.mean,
@@ -316,8 +908,26 @@ class Meter(object):
             rate15=self.rate15
         )
 
+class _TableEvents(dict):
+    # {event:{result:TableMeter}}, created on access like the defaultdict of LiveMetrics
+    def __init__(self,table):
+        self.table = table
+
+    def __missing__(self,event):
+        return self.setdefault(event,_TableResults(self.table,event))
+
+class _TableResults(dict):
+    def __init__(self,table,event):
+        self.table = table
+        self.event = event
+
+    def __missing__(self,result):
+        return self.setdefault(result,self.table.meter(self.event,result))
+
 #______________________________________________________________________________
 class WeightedSample(object):
+    __slots__ = ('value','weight')
+
     def __init__(self,value,weight):
         self.value = value
         self.weight = weight
@@ -369,17 +979,90 @@ class WeightedSnapshot(object):
     >>> print(snapshot.get_value(0.5))
     0.0
 
+    The values and their weights can also be given as two parallel sequences:
+
+    >>> snapshot = WeightedSnapshot(list(range(10)),list(range(10)))
+    >>> print((snapshot.min,snapshot.max,round(snapshot.mean,1),round(snapshot.stddev,1)))
+    (0, 9, 6.3, 2.2)
+
+    Several quantiles can be accessed at once:
+
+    >>> print(snapshot.get_values([0.5,0.25,0.75]))
+    [7.5, 5.5, 8.5]
+
+    And the weighted fraction of the values lower or equal to some bounds:
+
+    >>> print([round(x,2) for x in snapshot.get_cumulative([4,8.5,20])])
+    [0.22, 0.8, 1.0]
+
+    The statistics are computed once, when the snapshot is built. When :py:mod:`numpy` is
+    installed, it is used for the snapshots of more than :py:attr:`NUMPY_THRESHOLD` values.
     """
-    def __init__(self,values):
-        copy = [v for v in values.values()]
-        copy.sort(key=lambda x: x.value)
+    __slots__ = ('values','norm_weights','quantiles','_mean','_stddev')
+
+    #: Minimum number of values to use :py:mod:`numpy`, when installed
+    NUMPY_THRESHOLD = 256
+
+    def __init__(self,values,weights=None):
+        if weights is None:
+            # values is a dictionary of WeightedSample
+            samples = list(values.values())
+            values = [x.value for x in samples]
+            weights = [x.weight for x in samples]
+        if numpy is not None and len(values)>=self.NUMPY_THRESHOLD:
+            self._build_numpy(values,weights)
+            return
+        order = sorted(range(len(values)),key=values.__getitem__)
+
+        sum_weight = sum(weights)
+        self.values = [values[i] for i in order]
+        self.norm_weights = array.array('d',[weights[i]/sum_weight if sum_weight!=0 else 0 for i in order])
+        self.quantiles = array.array('d',bytes(8*len(order)))
+
+        # One pass for the quantiles, the mean and the variance (West's weighted algorithm)
+        quantile = 0.0
+        mean = 0.0
+        m2 = 0.0
+        i = 0
+        for value,weight in zip(self.values,self.norm_weights):
+            self.quantiles[i] = quantile
+            i += 1
+            if weight:
+                quantile += weight
+                delta = value-mean
+                mean += delta*weight/quantile
+                m2 += weight*delta*(value-mean)
+        self._mean = mean if order else 0
+        self._stddev = math.sqrt(m2/quantile) if len(order)>1 and quantile else 0
+
+    def _build_numpy(self,values,weights):
+        order = numpy.argsort(numpy.asarray(values),kind='stable')
+        self.values = [values[i] for i in order.tolist()]
+        weights = numpy.asarray(weights,dtype=float)[order]
+        sum_weight = weights.sum()
+        norm_weights = weights/sum_weight if sum_weight!=0 else numpy.zeros(len(weights))
+        quantiles = numpy.zeros(len(weights))
+        numpy.cumsum(norm_weights[:-1],out=quantiles[1:])
+        self.norm_weights = array.array('d',norm_weights.tobytes())
+        self.quantiles = array.array('d',quantiles.tobytes())
+        sorted_values = numpy.asarray(self.values,dtype=float)
+        mean = float(numpy.dot(sorted_values,norm_weights))
+        diff = sorted_values-mean
+        self._mean = mean
+        self._stddev = math.sqrt(float(numpy.dot(norm_weights,diff*diff)))
+
+    def _check(self,quantile):
+        if quantile < 0.0 or quantile > 1.0 or quantile is None:
+            raise Exception("argument %s is not in [0..1]" % quantile)
+
+    def _value_at(self,posx):
+        if posx<1:
+            return self.values[0]
+
+        if posx >= len(self.values):
+            return self.values[-1]
 
-        sum_weight = sum([x.weight for x in copy])
-        self.values = [x.value for x in copy]
-        self.norm_weights = [x.weight/sum_weight if sum_weight!=0 else 0 for x in copy]
-        self.quantiles = [0.0]*len(copy)
-        for i in range(1,len(copy)):
-            self.quantiles[i] = self.quantiles[i-1] + self.norm_weights[i-1]
+        return (self.values[posx]+self.values[posx-1])/2
 
     def get_value(self,quantile):
         """
@@ -389,23 +1072,50 @@ class WeightedSnapshot(object):
         The percentile must be between 0 and 1.
 
         """
-        if quantile < 0.0 or quantile > 1.0 or quantile is None:
-            raise Exception("argument %s is not in [0..1]" % quantile)
+        self._check(quantile)
 
         if len(self.values)==0:
             return 0.0
 
-        posx = bisect.bisect_left(self.quantiles,quantile)
-        if posx<0:
-            posx = ((-posx) - 1) - 1
+        return self._value_at(bisect.bisect_left(self.quantiles,quantile))
 
-        if posx<1:
-            return self.values[0]
+    def get_values(self,quantiles):
+        """
+        Access the values for a list of percentiles, in one walk through the snapshot.
+        Equivalent to ``[get_value(q) for q in quantiles]``.
+        """
+        for quantile in quantiles:
+            self._check(quantile)
 
-        if posx >= len(self.values):
-            return self.values[-1]
+        if len(self.values)==0:
+            return [0.0]*len(quantiles)
+
+        result = [None]*len(quantiles)
+        positions = self.quantiles
+        n = len(positions)
+        posx = 0
+        for i in sorted(range(len(quantiles)),key=quantiles.__getitem__):
+            quantile = quantiles[i]
+            while posx<n and positions[posx]<quantile:
+                posx += 1
+            result[i] = self._value_at(posx)
+        return result
+
+    def get_cumulative(self,bounds):
+        """
+        Return for each of the *bounds* the weighted fraction of the values lower or equal
+        to the bound, between 0 and 1.
 
-        return (self.values[posx]+self.values[posx-1])/2
+        .. versionadded:: 0.9
+        """
+        values = self.values
+        positions = self.quantiles
+        n = len(values)
+        result = []
+        for bound in bounds:
+            posx = bisect.bisect_right(values,bound)
+            result.append(positions[posx] if posx<n else 1.0 if n else 0.0)
+        return result
 
     def get_distribution(self,range_value=10):
         """
@@ -454,110 +1164,298 @@ class WeightedSnapshot(object):
         """
         Weighted average of the values in this snapshot.
         """
-        if len(self.values)==0:
-            return 0
-        return sum( [self.values[i]*self.norm_weights[i] for i in range(len(self.values)) ] )
+        return self._mean
 
     @property
     def stddev(self):
         """
         Standard deviation of the weighted values in this snapshot.
         """
-        if len(self.values)<=1:
-            return 0
-        mean = self.mean
-        variance = 0.0
-        for i in range(len(self.values)):
-            diff = self.values[i] - mean
-            variance += self.norm_weights[i]*diff*diff
-        return math.sqrt(variance)
+        return self._stddev
 
 class Reservoir(object):
     """
     A reservoir holds the data of an :py:class:`Histogram`.
     It records values and decays them as time passes.
     It keeps only a statistical representative set of values.
+
+    The samples are stored in parallel arrays (priority, value, weight). Until the reservoir
+    is full, they are kept in insertion order. Once it is full, the arrays are organized as a
+    min-heap on the priority so that the sample with the lowest priority is always the first one
+    and can be replaced in O(log n).
+
+    Once the reservoir is full, a value is kept only if its priority ``weight/random()`` is higher
+    than the lowest priority, i.e. with probability ``p=weight/lowest``. Rather than drawing a
+    priority for each value, the reservoir draws the number of values to skip before the next
+    one is kept, from the geometric distribution of parameter ``p``, and the priority of the kept
+    value conditionally to be higher than the lowest priority. The rejected values only decrement
+    a counter. The weight of the values grows during a skip (by ``alpha`` per second), so their
+    probability to be kept is slightly underestimated: by about 0.1% with the default size,
+    for which a value is kept every 65ms in average when values are skipped. A skip older than
+    :py:attr:`SKIP_MAX_AGE` seconds, after an idle period, is drawn again with the weight of
+    the current value.
+
+    >>> r = Reservoir(10)
+    >>> for i in range(100):
+    ...    kept = r.update(i)
+    >>> r.size,len(r.values),r.count
+    (10, 10, 100)
+    >>> all(r._priorities[0]<=p for p in r._priorities)
+    True
     """
     TICK_INTERVAL = 1.0*60*60     # 1 hour expressed in seconds
+    #: Maximum age in seconds of the number of values to skip: the weight of the values grows
+    #: by 1.5% per second
+    SKIP_MAX_AGE = 1.0
 
-    def __init__(self):
-        self.values = {}
+    __slots__ = ('clock','alpha','_size','count','_priorities','_values','_weights','_interval',
+                 'start','last_tick','_skip','_skip_end')
+
+    def __init__(self,size=1028,clock=None):
+        self.clock = clock or CLOCK
         self.alpha = 0.015
-        self._size = 1028
+        self._size = size
         self.count = 0
-        self.start = datetime.datetime.now()
-        self.last_tick = datetime.datetime.now()
+        # Priorities and weights are stored unboxed
+        self._priorities = array.array('d')
+        self._values = []
+        self._weights = array.array('d')
+        self._interval = int(self.TICK_INTERVAL*1e9)
+        self.start = self.clock.now()
+        self.last_tick = self.start
+        # Number of next values to reject, until the time _skip_end
+        self._skip = 0
+        self._skip_end = 0
 
     @property
     def size(self):
         return min(self._size,self.count)
 
+    @property
+    def values(self):
+        """
+        The samples of the reservoir, as a dictionary of :py:class:`WeightedSample` indexed
+        by their priority.
+        """
+        return {p:WeightedSample(v,w) for p,v,w in zip(self._priorities,self._values,self._weights)}
+
     def update(self,value):
-        self._tick_if_necessary()
-        period = datetime.datetime.now()-self.start
-        period = period.seconds*1.0 + period.microseconds/1000000.
-        item_weight = math.exp(self.alpha*period)
-        sample = WeightedSample(value, item_weight)
-        priority = item_weight / random.random()
+        """
+        Record *value*, and return True if it is kept in the reservoir.
+        """
         self.count += 1
-        if self.count<=self.size:
-            self.values[priority] = sample
+        now = self.clock.now()
+        stale = False
+        if self._skip:
+            if now<=self._skip_end:
+                self._skip -= 1
+                return False
+            # Drawn before an idle period: the weight of the values grew since
+            self._skip = 0
+            stale = True
+        if now-self.last_tick>self._interval:
+            self._tick_if_necessary()
+        period = (now-self.start)/1e9
+        item_weight = math.exp(self.alpha*period)
+        priorities = self._priorities
+        if len(priorities)<self._size:
+            priorities.append(item_weight/(1.0-random.random()))
+            self._values.append(value)
+            self._weights.append(item_weight)
+            if len(priorities)>=self._size:
+                self._heapify()
+                self._draw_skip(item_weight,now)
         else:
-            first = min(self.values.keys())
-            if first<priority:
-                if not priority in self.values:
-                    self.values[priority] = sample
-                    del self.values[first]
-                else:
-                    self.values[priority] = sample
+            if stale:
+                # This value is the first one of the skip drawn again
+                self._draw_skip(item_weight,now)
+                if self._skip:
+                    self._skip -= 1
+                    return False
+            # The value was drawn to be kept: its priority is higher than the lowest one
+            priority = max(item_weight,priorities[0])/(1.0-random.random())
+            self._replace_first(priority,value,item_weight)
+            self._draw_skip(item_weight,now)
+        return True
+
+    def _draw_skip(self,weight,now):
+        # Number of values rejected before the next one is kept, each one being kept
+        # with the probability p that weight/random() is higher than the lowest priority
+        p = weight/self._priorities[0]
+        if p>=1.0:
+            self._skip = 0
+        else:
+            self._skip = int(math.log(1.0-random.random())/math.log1p(-p))
+        self._skip_end = now+int(self.SKIP_MAX_AGE*1e9)
+
+    def _heapify(self):
+        # A sorted array is a valid heap
+        order = sorted(range(len(self._priorities)),key=self._priorities.__getitem__)
+        self._priorities = array.array('d',[self._priorities[i] for i in order])
+        self._values = [self._values[i] for i in order]
+        self._weights = array.array('d',[self._weights[i] for i in order])
+
+    def _replace_first(self,priority,value,weight):
+        # Replace the sample with the lowest priority and sift the new one down the heap
+        priorities = self._priorities
+        values = self._values
+        weights = self._weights
+        n = len(priorities)
+        pos = 0
+        child = 1
+        while child<n:
+            if child+1<n and priorities[child+1]<priorities[child]:
+                child += 1
+            if priority<=priorities[child]:
+                break
+            priorities[pos] = priorities[child]
+            values[pos] = values[child]
+            weights[pos] = weights[child]
+            pos = child
+            child = 2*pos+1
+        priorities[pos] = priority
+        values[pos] = value
+        weights[pos] = weight
 
     def _tick_if_necessary(self):
-        new_tick = datetime.datetime.now()
-        age = new_tick - self.last_tick
-        while age.seconds+age.microseconds/1000000.>self.TICK_INTERVAL:
-            self.last_tick += datetime.timedelta(seconds=self.TICK_INTERVAL)
-            age = new_tick - self.last_tick
-            self.rescale()
-
-    def rescale(self):
-        period = self.TICK_INTERVAL
+        age = self.clock.now() - self.last_tick
+        if age>self._interval:
+            ticks = (age-1)//self._interval
+            self.last_tick += self._interval*ticks
+            self.rescale(ticks)
+
+    def rescale(self,ticks=1):
+        """
+        Decay the samples by *ticks* intervals at once.
+        """
+        period = self._interval*ticks/1e9
         scaling_factor = math.exp(-self.alpha * period)
+        # The weights and the priorities are scaled together: the probability to keep a value
+        # does not change, unless samples are removed and the reservoir is not full anymore
+        if math.isclose(scaling_factor,0.0) or any(math.isclose(w*scaling_factor,0.0) for w in self._weights):
+            self._skip = 0
         if math.isclose(scaling_factor,0.0):
-            self.values = {}
+            self._priorities = array.array('d')
+            self._values = []
+            self._weights = array.array('d')
         else:
-            values = {}
-            for k,v in self.values.items():
-                new_sample = WeightedSample(v.value, v.weight * scaling_factor)
-                if math.isclose(new_sample.weight,0.0):
-                    continue
-                values[k*scaling_factor] = new_sample
-            self.values = values
-        self.count = len(self.values)
-        self.start += datetime.timedelta(seconds=self.TICK_INTERVAL)
+            # Scaling all the priorities by the same factor keeps the heap ordered
+            self._priorities = array.array('d',[p*scaling_factor for p in self._priorities])
+            self._weights = array.array('d',[w*scaling_factor for w in self._weights])
+            if any(math.isclose(w,0.0) for w in self._weights):
+                kept = [i for i,w in enumerate(self._weights) if not math.isclose(w,0.0)]
+                self._priorities = array.array('d',[self._priorities[i] for i in kept])
+                self._values = [self._values[i] for i in kept]
+                self._weights = array.array('d',[self._weights[i] for i in kept])
+        self.count = len(self._priorities)
+        self.start += self._interval*ticks
 
 
     @property
     def snapshot(self):
         self._tick_if_necessary()
-        return WeightedSnapshot(self.values)
+        return WeightedSnapshot(self._values,self._weights)
 
 
-class Histogram(object):
+class BaseHistogram(abc.ABC):
     """
-    An histogram represents the distribution of a set of values.
-    Values are exponentially decayed so that more recent values have more weight than old values.
-
-    For testing, we will reduce the tick interval managing the decaying of values.
+    The interface shared by all the histograms: :py:meth:`update`, :py:attr:`count`,
+    :py:attr:`last_tick`, :py:attr:`snapshot`, :py:meth:`tick` and :py:meth:`to_dict`,
+    with the attributes ``lock``, ``auto_tick`` and ``window``.
 
-    >>> Reservoir.TICK_INTERVAL = 0.1
+    The base class does not decay the values: :py:meth:`tick` does nothing and
+    :py:attr:`last_tick` is always 0. A subclass must implement :py:meth:`update`,
+    incrementing ``_count``, and ``_version`` when its snapshot changes, drawing
+    ``version`` from ``versions``, and :py:attr:`snapshot`:
 
-    Usage:
+    >>> BaseHistogram()  #doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    TypeError: Can't instantiate abstract class BaseHistogram...
 
-    >>> his = Histogram()
+    .. versionadded:: 0.9
+    """
 
-    A new object has no value yet:
+    __slots__ = ('lock','_count','_version','auto_tick','window','version','versions','__weakref__')
 
-    >>> his.count
+    def __init__(self):
+        self.lock = LOCKS.get()
+        self._count = 0
+        self._version = 0
+        #: Version of the histogram, drawn from *versions* after each value recorded and
+        #: each rescale, see :py:attr:`Meter.version`
+        self.version = 0
+        self.versions = VERSIONS
+        # The time is needed anyway to weight the values, so the histogram always
+        # rescales them when needed, even if registered in a Ticker
+        self.auto_tick = True
+        #: Optional :py:class:`HistogramWindow` recording the values of a sliding window
+        self.window = None
+
+    @abc.abstractmethod
+    def update(self,value):
+        """
+        Register a new value in the histogram.
+        """
+
+    def tick(self):
+        """
+        Nothing to do: the values are not decayed.
+        """
+
+    @property
+    def count(self):
+        """
+        Get the number of values recorded by this histogram.
+        """
+        return self._count
+
+    @property
+    def last_tick(self):
+        """
+        The time of the last rescale of the values, 0 if the values are not decayed.
+        """
+        return 0
+
+    @property
+    @abc.abstractmethod
+    def snapshot(self):
+        """
+        Get the snapshot of the values, giving access to quantiles and to the distribution.
+        """
+
+    def to_dict(self,snapshot=None):
+        """
+        Return the statistics of the histogram, from *snapshot* if provided.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot
+        return dict(
+            count=self.count,
+            min=snapshot.min,
+            max=snapshot.max,
+            mean=snapshot.mean,
+            stddev=snapshot.stddev,
+        )
+
+class Histogram(BaseHistogram):
+    """
+    An histogram represents the distribution of a set of values.
+    Values are exponentially decayed so that more recent values have more weight than old values.
+
+    *clock*: the :py:class:`Clock` giving the time. Default is :py:data:`CLOCK`.
+
+    For testing, we will reduce the tick interval managing the decaying of values.
+
+    >>> Reservoir.TICK_INTERVAL = 0.1
+
+    Usage:
+
+    >>> his = Histogram()
+
+    A new object has no value yet:
+
+    >>> his.count
     0
 
     For the test, we 
@@ -617,12 +1515,24 @@ class Histogram(object):
     >>> his.snapshot.stddev!=his50.snapshot.stddev
     True
 
+    The snapshot is cached: it is built again only when values are recorded or rescaled.
+
+    >>> his.snapshot is his.snapshot
+    True
+
     """
+    #: Maximum age in seconds of the cached snapshot when values are recorded.
+    #: With the default 0, a new snapshot is built as soon as a value is recorded.
+    SNAPSHOT_MAX_AGE = 0.0
 
-    def __init__(self):
-        self.lock = threading.RLock()
-        self._count = 0
-        self._reservoir = Reservoir()
+    __slots__ = ('_reservoir','_snapshot','_snapshot_key','_snapshot_time')
+
+    def __init__(self,clock=None):
+        super().__init__()
+        self._reservoir = Reservoir(clock=clock)
+        self._snapshot = None
+        self._snapshot_key = None
+        self._snapshot_time = 0
 
     def update(self,value):
         """
@@ -630,29 +1540,1077 @@ class Histogram(object):
         """
         with self.lock:
             self._count += 1
-            self._reservoir.update(value)
+            # The snapshot changes only if the value is kept
+            if self._reservoir.update(value):
+                self._version += 1
+            if self.window is not None:
+                self.window.update(value)
+            self.version = next(self.versions)
+
+    def tick(self):
+        """
+        Rescale the values if the tick interval has elapsed. This is done automatically
+        when the histogram is used, unless it is registered in a :py:class:`Ticker`.
+        """
+        with self.lock:
+            self._tick_if_necessary()
+
+    def _tick_if_necessary(self):
+        reservoir = self._reservoir
+        last_tick = reservoir.last_tick
+        reservoir._tick_if_necessary()
+        if reservoir.last_tick!=last_tick:
+            self.version = next(self.versions)
 
     @property
-    def count(self):
+    def last_tick(self):
         """
-        Get the number of values recorded by this histogram.
+        The time of the last rescale of the values.
         """
-        return self._count
+        return self._reservoir.last_tick
 
     @property
     def snapshot(self):
         """
         Get a :py:class:`WeightedSnapshot` for this histogram. The snapshot will then give
         access to quantiles and to the distribution of values.
+
+        The last snapshot is returned while no value is recorded, or while it is younger than
+        :py:attr:`SNAPSHOT_MAX_AGE`.
         """
-        return self._reservoir.snapshot
+        with self.lock:
+            reservoir = self._reservoir
+            self._tick_if_necessary()
+            # A rescale moves last_tick
+            key = (self._version,reservoir.last_tick)
+            if key!=self._snapshot_key:
+                now = reservoir.clock.now()
+                if self._snapshot is None or now-self._snapshot_time>=self.SNAPSHOT_MAX_AGE*1e9:
+                    self._snapshot = WeightedSnapshot(reservoir._values,reservoir._weights)
+                    self._snapshot_key = key
+                    self._snapshot_time = now
+            return self._snapshot
 
-    def to_dict(self):
+#______________________________________________________________________________
+class BucketSnapshot(object):
+    """
+    A snapshot of a histogram storing counts of values in buckets, as returned by
+    :py:attr:`SketchHistogram.snapshot`. It offers the same interface as
+    :py:class:`WeightedSnapshot`.
+
+    *values*: the values representing the buckets, in ascending order
+
+    *counts*: the number of values recorded in each bucket
+
+    *min*, *max*, *mean*, *stddev*: the exact statistics of the recorded values
+
+    >>> snapshot = BucketSnapshot([1,2,3,4],[1,1,1,1],1,4,2.5,1.1)
+    >>> snapshot.get_value(0.5)
+    2
+    >>> snapshot.get_values([0.0,1.0])
+    [1, 4]
+    >>> snapshot.get_distribution(3)
+    [1, 1, 2]
+    >>> snapshot.get_cumulative([2,10])
+    [0.5, 1.0]
+    >>> snapshot.size
+    4
+    """
+    __slots__ = ('values','counts','cumulative','_min','_max','_mean','_stddev')
+
+    def __init__(self,values,counts,min=0,max=0,mean=0,stddev=0):
+        self.values = values
+        self.counts = array.array('q',counts)
+        self.cumulative = array.array('q',bytes(8*len(counts)))
+        total = 0
+        for i,count in enumerate(self.counts):
+            total += count
+            self.cumulative[i] = total
+        self._min = min
+        self._max = max
+        self._mean = mean
+        self._stddev = stddev
+
+    def get_value(self,quantile):
+        """
+        Access the value (the quantile) for a given percentile, with the precision of the buckets.
+
+        The percentile must be between 0 and 1.
+        """
+        if quantile < 0.0 or quantile > 1.0 or quantile is None:
+            raise Exception("argument %s is not in [0..1]" % quantile)
+
+        if self.size==0:
+            return 0.0
+
+        # The exact bounds are known
+        if quantile==0.0:
+            return self._min
+        if quantile==1.0:
+            return self._max
+        rank = quantile*(self.size-1)
+        value = self.values[bisect.bisect_right(self.cumulative,rank)]
+        if value<self._min:
+            return self._min
+        if value>self._max:
+            return self._max
+        return value
+
+    def get_values(self,quantiles):
+        """
+        Access the values for a list of percentiles.
+        Equivalent to ``[get_value(q) for q in quantiles]``.
+        """
+        return [self.get_value(quantile) for quantile in quantiles]
+
+    def get_cumulative(self,bounds):
+        """
+        Return for each of the *bounds* the fraction of the values lower or equal to the
+        bound, with the precision of the buckets.
+
+        .. versionadded:: 0.9
+        """
+        size = self.size
+        result = []
+        for bound in bounds:
+            index = bisect.bisect_right(self.values,bound)
+            result.append(self.cumulative[index-1]/size if index and size else 0.0)
+        return result
+
+    def get_distribution(self,range_value=10):
+        """
+        Return the distribution with the request resolution (i.e. number of values)
+        """
+        H = []
+        posy = 0
+        step = (float(self.max)-float(self.min))/float(range_value)
+        x = self.min + step
+        while x<self.max:
+            index = bisect.bisect_left(self.values,x)
+            nposy = self.cumulative[index-1] if index else 0
+            H.append(nposy-posy)
+            posy = nposy
+            x += step
+        H.append(self.size-posy)
+        return H
+
+    @property
+    def size(self):
+        """
+        Number of values in this snapshot.
+        """
+        return self.cumulative[-1] if self.cumulative else 0
+
+    @property
+    def max(self):
+        """
+        Maximum value in this snapshot.
+        """
+        return self._max
+
+    @property
+    def min(self):
+        """
+        Minimum value in this snapshot.
+        """
+        return self._min
+
+    @property
+    def mean(self):
+        """
+        Average of the values in this snapshot.
+        """
+        return self._mean
+
+    @property
+    def stddev(self):
+        """
+        Standard deviation of the values in this snapshot.
+        """
+        return self._stddev
+
+class _BucketStore(object):
+    # Contiguous counts of the buckets [offset..offset+len(counts)[. When more than
+    # max_buckets buckets would be needed, the lowest ones are collapsed together.
+    __slots__ = ('counts','offset','max_buckets')
+
+    def __init__(self,max_buckets):
+        self.counts = []
+        self.offset = 0
+        self.max_buckets = max_buckets
+
+    def add(self,key,n=1):
+        counts = self.counts
+        if not counts:
+            self.offset = key
+            counts.append(n)
+            return
+        offset = self.offset
+        if key<offset:
+            lowest = max(key,offset+len(counts)-self.max_buckets)
+            if lowest<offset:
+                counts[0:0] = [0]*(offset-lowest)
+                self.offset = offset = lowest
+            key = max(key,offset)
+        elif key>=offset+len(counts):
+            lowest = key-self.max_buckets+1
+            if lowest>offset:
+                cut = min(lowest-offset,len(counts))
+                collapsed = sum(counts[:cut])
+                del counts[:cut]
+                if counts:
+                    counts[0] += collapsed
+                else:
+                    counts.append(collapsed)
+                self.offset = offset = lowest
+            counts.extend([0]*(key-offset-len(counts)+1))
+        counts[key-offset] += n
+
+    def items(self):
+        # (key,count) of the non empty buckets, in ascending order of key
+        return [(self.offset+i,count) for i,count in enumerate(self.counts) if count]
+
+class SketchHistogram(BaseHistogram):
+    """
+    An histogram based on a relative-error quantile sketch (DDSketch). Values are counted in
+    logarithmic buckets, so that any quantile is estimated with a relative error lower than
+    *relative_accuracy*, whatever the number of values. Contrary to :py:class:`Histogram`,
+    values are not decayed: the histogram reports all the values recorded since its creation.
+
+    *clock*: not used, for compatibility with :py:class:`Histogram`
+
+    *relative_accuracy*: the maximum relative error of the quantiles. Default is 1%.
+
+    *max_buckets*: the maximum number of buckets for the positive values (and for the negative
+    values). When more buckets are needed, the lowest ones are collapsed, degrading only the
+    accuracy of the lowest quantiles. With the defaults, 2048 buckets cover values from 1 to 1e18.
+
+    Recording a value is O(1) and the memory is bounded.
+
+    >>> his = SketchHistogram()
+    >>> for i in range(1000):
+    ...    his.update(i+1)
+    >>> his.count
+    1000
+    >>> his.snapshot.min,his.snapshot.max,his.snapshot.mean
+    (1, 1000, 500.5)
+    >>> abs(his.snapshot.get_value(0.999)-999)<=999*0.01
+    True
+
+    Two sketches with the same parameters can be merged, for example to aggregate the
+    histograms of several processes:
+
+    >>> other = SketchHistogram()
+    >>> for i in range(1000):
+    ...    other.update(i+1001)
+    >>> his.merge(other)
+    >>> his.count,his.snapshot.max
+    (2000, 2000)
+    >>> abs(his.snapshot.get_value(0.5)-1000)<=1000*0.01
+    True
+
+    .. versionadded:: 0.9
+    """
+
+    __slots__ = ('_snapshot','_snapshot_version','relative_accuracy','max_buckets','gamma','_log_gamma',
+                 '_positives','_negatives','_zeros','_min','_max','_mean','_m2')
+
+    def __init__(self,clock=None,relative_accuracy=0.01,max_buckets=2048):
+        if not 0<relative_accuracy<1:
+            raise ValueError("relative_accuracy must be in ]0..1[")
+        super().__init__()
+        self._snapshot = None
+        self._snapshot_version = None
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1+relative_accuracy)/(1-relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self._positives = _BucketStore(max_buckets)
+        self._negatives = _BucketStore(max_buckets)
+        self._zeros = 0
+        self._min = 0
+        self._max = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def _key(self,value):
+        return math.ceil(math.log(value)/self._log_gamma)
+
+    def _value(self,key):
+        # Value of the bucket ]gamma^(key-1),gamma^key] with a relative error below relative_accuracy
+        return 2*self.gamma**key/(self.gamma+1)
+
+    def update(self,value):
+        """
+        Register a new value in the histogram.
+        """
+        with self.lock:
+            if value>0:
+                self._positives.add(self._key(value))
+            elif value<0:
+                self._negatives.add(self._key(-value))
+            else:
+                self._zeros += 1
+            self._count += 1
+            self._version += 1
+            self.version = next(self.versions)
+            if self._count==1:
+                self._min = self._max = value
+            elif value<self._min:
+                self._min = value
+            elif value>self._max:
+                self._max = value
+            delta = value-self._mean
+            self._mean += delta/self._count
+            self._m2 += delta*(value-self._mean)
+            if self.window is not None:
+                self.window.update(value)
+
+    def merge(self,other):
+        """
+        Add the values recorded by the :py:class:`SketchHistogram` *other* to this histogram.
+        Both histograms must have the same *relative_accuracy*.
+        """
+        if not isinstance(other,SketchHistogram) or other.gamma!=self.gamma:
+            raise ValueError("only a SketchHistogram with the same relative_accuracy can be merged")
+        with other.lock:
+            positives = other._positives.items()
+            negatives = other._negatives.items()
+            zeros,count,min_,max_,mean,m2 = other._zeros,other._count,other._min,other._max,other._mean,other._m2
+        if count==0:
+            return
+        with self.lock:
+            for key,n in positives:
+                self._positives.add(key,n)
+            for key,n in negatives:
+                self._negatives.add(key,n)
+            self._zeros += zeros
+            if self._count==0:
+                self._min,self._max = min_,max_
+            else:
+                self._min = min(self._min,min_)
+                self._max = max(self._max,max_)
+            # Parallel algorithm of Chan et al. for the mean and the variance
+            total = self._count+count
+            delta = mean-self._mean
+            self._mean += delta*count/total
+            self._m2 += m2+delta*delta*self._count*count/total
+            self._count = total
+            self._version += 1
+            self.version = next(self.versions)
+
+    @property
+    def snapshot(self):
+        """
+        Get a :py:class:`BucketSnapshot` for this histogram. The snapshot is built again only
+        when values are recorded.
+        """
+        with self.lock:
+            if self._snapshot_version!=self._version:
+                values = [-self._value(key) for key,n in reversed(self._negatives.items())]
+                counts = [n for key,n in reversed(self._negatives.items())]
+                if self._zeros:
+                    values.append(0)
+                    counts.append(self._zeros)
+                for key,n in self._positives.items():
+                    values.append(self._value(key))
+                    counts.append(n)
+                stddev = math.sqrt(self._m2/self._count) if self._count>1 else 0
+                self._snapshot = BucketSnapshot(values,counts,self._min,self._max,self._mean,stddev)
+                self._snapshot_version = self._version
+            return self._snapshot
+
+class HdrHistogram(BaseHistogram):
+    """
+    An histogram counting values in log-linear buckets, like HdrHistogram. Each bucket covers a
+    range of values narrower than 10^-*significant_digits* of its values, so that the counts are
+    exact at this precision. Recording a value only computes the index of its bucket in a
+    preallocated array of integers. As for :py:class:`SketchHistogram`, values are not decayed.
+
+    *clock*: not used, for compatibility with :py:class:`Histogram`
+
+    *lowest*: the lowest value that can be discerned, i.e. the unit of the buckets.
+    Default is 1e-6 (1 microsecond for timers).
+
+    *highest*: the highest value that can be recorded. Higher values are recorded as *highest*,
+    lower values as 0. Default is 3600 (1 hour for timers).
+
+    *significant_digits*: the number of significant decimal digits of the values. Default is 2.
+
+    >>> his = HdrHistogram()
+    >>> for i in range(1000):
+    ...    his.update((i+1)/1000)
+    >>> his.count,his.snapshot.min,his.snapshot.max
+    (1000, 0.001, 1.0)
+    >>> abs(his.snapshot.get_value(0.99)-0.99)<=0.99*0.01
+    True
+
+    The snapshot gives the cumulative counts of the buckets:
+
+    >>> snapshot = his.snapshot
+    >>> snapshot.cumulative[-1]==his.count
+    True
+
+    It can measure the processing time of :py:meth:`livemetrics.LiveMetrics.timer`, with
+    ``factory=HdrHistogram``, or ``factory=functools.partial(HdrHistogram,highest=60)`` to
+    customize the range.
+
+    .. versionadded:: 0.9
+    """
+
+    __slots__ = ('_snapshot','_snapshot_version','lowest','highest','significant_digits','_highest',
+                 '_half_magnitude','_half_count','_mask','counts','_min','_max')
+
+    def __init__(self,clock=None,lowest=1e-6,highest=3600.0,significant_digits=2):
+        if not 1<=significant_digits<=5:
+            raise ValueError("significant_digits must be in [1..5]")
+        if not 0<lowest<highest:
+            raise ValueError("lowest must be positive and lower than highest")
+        super().__init__()
+        self._snapshot = None
+        self._snapshot_version = None
+        self.lowest = lowest
+        self.highest = highest
+        self.significant_digits = significant_digits
+
+        # The values are recorded as integers, in units of lowest
+        self._highest = int(highest/lowest)
+        sub_bucket_count = 1<<math.ceil(math.log2(2*10**significant_digits))
+        self._half_magnitude = sub_bucket_count.bit_length()-2
+        self._half_count = sub_bucket_count//2
+        self._mask = sub_bucket_count-1
+        buckets = 1
+        smallest_untrackable = sub_bucket_count
+        while smallest_untrackable<=self._highest:
+            smallest_untrackable <<= 1
+            buckets += 1
+        self.counts = array.array('q',bytes(8*(buckets+1)*self._half_count))
+        self._min = 0
+        self._max = 0
+
+    def _index(self,value):
+        bucket = (value|self._mask).bit_length()-self._half_magnitude-1
+        return ((bucket+1)<<self._half_magnitude)+(value>>bucket)-self._half_count
+
+    def _value(self,index):
+        # Middle of the bucket of the index
+        bucket = (index>>self._half_magnitude)-1
+        sub_bucket = (index&(self._half_count-1))+self._half_count
+        if bucket<0:
+            sub_bucket -= self._half_count
+            bucket = 0
+        return ((sub_bucket<<bucket)+((1<<bucket)>>1))*self.lowest
+
+    def update(self,value):
+        """
+        Register a new value in the histogram.
+        """
+        v = int(value/self.lowest)
+        if v<0:
+            v = 0
+        elif v>self._highest:
+            v = self._highest
+        index = self._index(v)
+        with self.lock:
+            self.counts[index] += 1
+            self._count += 1
+            self._version += 1
+            self.version = next(self.versions)
+            if self._count==1:
+                self._min = self._max = value
+            elif value<self._min:
+                self._min = value
+            elif value>self._max:
+                self._max = value
+            if self.window is not None:
+                self.window.update(value)
+
+    def merge(self,other):
+        """
+        Add the values recorded by the :py:class:`HdrHistogram` *other* to this histogram.
+        Both histograms must have the same parameters.
+        """
+        if not isinstance(other,HdrHistogram) or (other.lowest,other.highest,other.significant_digits)!=(self.lowest,self.highest,self.significant_digits):
+            raise ValueError("only a HdrHistogram with the same parameters can be merged")
+        with other.lock:
+            counts = array.array('q',other.counts)
+            count,min_,max_ = other._count,other._min,other._max
+        if count==0:
+            return
+        with self.lock:
+            for index,n in enumerate(counts):
+                if n:
+                    self.counts[index] += n
+            if self._count==0:
+                self._min,self._max = min_,max_
+            else:
+                self._min = min(self._min,min_)
+                self._max = max(self._max,max_)
+            self._count += count
+            self._version += 1
+            self.version = next(self.versions)
+
+    @property
+    def snapshot(self):
+        """
+        Get a :py:class:`BucketSnapshot` for this histogram, with the non empty buckets.
+        The mean and the standard deviation are computed from the buckets.
+        The snapshot is built again only when values are recorded.
+        """
+        with self.lock:
+            if self._snapshot_version!=self._version:
+                values = []
+                counts = []
+                total = 0
+                mean = 0.0
+                m2 = 0.0
+                for index,n in enumerate(self.counts):
+                    if n:
+                        value = self._value(index)
+                        values.append(value)
+                        counts.append(n)
+                        total += n
+                        delta = value-mean
+                        mean += delta*n/total
+                        m2 += n*delta*(value-mean)
+                stddev = math.sqrt(m2/total) if total>1 else 0
+                self._snapshot = BucketSnapshot(values,counts,self._min,self._max,mean,stddev)
+                self._snapshot_version = self._version
+            return self._snapshot
+
+#______________________________________________________________________________
+class MeterWindow(object):
+    """
+    The exact number of events marked during the last *window* seconds, counted in a ring of
+    *buckets* buckets. The bucket of the current time is reset when it is reused, so rotating
+    costs nothing and the count only sums the buckets of the window. The count covers between
+    *window* seconds minus the duration of a bucket and *window* seconds.
+
+    A window is attached to a :py:class:`Meter` with its attribute ``window``, for example by
+    :py:class:`livemetrics.LiveMetrics` with *window*.
+
+    >>> clock = ManualClock()
+    >>> w = MeterWindow(60,12,clock)
+    >>> w.mark(10)
+    >>> clock.advance(30)
+    >>> w.mark(5)
+    >>> w.count,w.rate
+    (15, 0.25)
+    >>> clock.advance(35)
+    >>> w.count
+    5
+
+    .. versionadded:: 0.9
+    """
+    __slots__ = ('clock','window','_interval','_epochs','_counts')
+
+    def __init__(self,window=60.0,buckets=12,clock=None):
+        self.clock = clock or CLOCK
+        self.window = window
+        self._interval = int(window*1e9)//buckets
+        self._epochs = [-1]*buckets
+        self._counts = [0]*buckets
+
+    def mark(self,n=1):
+        """
+        Count *n* events at the current time. The caller holds the lock of the meter.
+        """
+        epoch = self.clock.now()//self._interval
+        slot = epoch%len(self._epochs)
+        if self._epochs[slot]!=epoch:
+            self._epochs[slot] = epoch
+            self._counts[slot] = n
+        else:
+            self._counts[slot] += n
+
+    @property
+    def count(self):
+        """
+        Number of events marked during the window.
+        """
+        oldest = self.clock.now()//self._interval-len(self._epochs)+1
+        return sum([count for epoch,count in zip(self._epochs,self._counts) if epoch>=oldest])
+
+    @property
+    def rate(self):
+        """
+        Average number of events per second during the window.
+        """
+        return self.count/self.window
+
+class HistogramWindow(object):
+    """
+    The values recorded during the last *window* seconds, in a ring of *buckets* mergeable
+    histograms created by *factory*, :py:class:`SketchHistogram` by default.
+    The histogram of the current time is replaced when its bucket is reused. The live
+    histograms are merged when the window is read.
+
+    *factory*: a callable creating a histogram from the clock. The histograms must have a
+    method ``merge``, as :py:class:`SketchHistogram` and :py:class:`HdrHistogram`: a
+    :py:class:`TypeError` is raised otherwise, for example with :py:class:`Histogram`,
+    whose samples cannot be merged.
+
+    *lock*: the lock of the histogram owning the window, also used by the histograms of
+    the window. Default is a lock of :py:data:`LOCKS`.
+
+    A window is attached to an histogram with its attribute ``window``, for example by
+    :py:class:`livemetrics.LiveMetrics` with *window*.
+
+    >>> clock = ManualClock()
+    >>> w = HistogramWindow(60,12,clock)
+    >>> for i in range(100):
+    ...     w.update(i+1)
+    >>> clock.advance(30)
+    >>> w.update(1000)
+    >>> w.count,w.snapshot.max
+    (101, 1000)
+    >>> clock.advance(35)
+    >>> w.count,w.snapshot.min
+    (1, 1000)
+    >>> HistogramWindow(60,12,clock,Histogram)
+    Traceback (most recent call last):
+    ...
+    TypeError: the histograms of a window must be mergeable: Histogram has no merge
+
+    .. versionadded:: 0.9
+    """
+    __slots__ = ('clock','window','factory','lock','_interval','_epochs','_histograms')
+
+    def __init__(self,window=60.0,buckets=12,clock=None,factory=None,lock=None):
+        self.clock = clock or CLOCK
+        self.window = window
+        self.factory = factory or SketchHistogram
+        # A factory which is not a class is checked on a histogram it creates
+        histogram = self.factory if isinstance(self.factory,type) else self.factory(self.clock)
+        if not callable(getattr(histogram,'merge',None)):
+            name = histogram.__name__ if isinstance(histogram,type) else type(histogram).__name__
+            raise TypeError("the histograms of a window must be mergeable: {} has no merge".format(name))
+        self.lock = lock or LOCKS.get()
+        self._interval = int(window*1e9)//buckets
+        self._epochs = [-1]*buckets
+        self._histograms = [None]*buckets
+
+    def update(self,value):
+        """
+        Record *value* at the current time. The caller holds the lock of the histogram.
+        """
+        epoch = self.clock.now()//self._interval
+        slot = epoch%len(self._epochs)
+        if self._epochs[slot]!=epoch:
+            self._epochs[slot] = epoch
+            self._histograms[slot] = self._new()
+        self._histograms[slot].update(value)
+
+    def _new(self):
+        # The histograms of the window never take another lock than the one of the window
+        histogram = self.factory(self.clock)
+        histogram.lock = self.lock
+        return histogram
+
+    def _live(self):
+        oldest = self.clock.now()//self._interval-len(self._epochs)+1
+        return [h for epoch,h in zip(self._epochs,self._histograms) if epoch>=oldest and h is not None]
+
+    @property
+    def count(self):
+        """
+        Number of values recorded during the window.
+        """
+        return sum([h.count for h in self._live()])
+
+    @property
+    def snapshot(self):
+        """
+        Snapshot of the values recorded during the window.
+        """
+        with self.lock:
+            merged = self._new()
+            for h in self._live():
+                merged.merge(h)
+            return merged.snapshot
+
+    def to_dict(self,percentiles=[0.05, 0.25, 0.50, 0.75, 0.95]):
+        """
+        Return the statistics of the window, with the quantiles of *percentiles*.
+        """
         snapshot = self.snapshot
         return dict(
-            count=self.count,
+            window=self.window,
+            count=snapshot.size,
             min=snapshot.min,
             max=snapshot.max,
             mean=snapshot.mean,
             stddev=snapshot.stddev,
+            quantiles=dict(zip(percentiles,snapshot.get_values(percentiles))),
         )
+
+#______________________________________________________________________________
+class LabelIndex(object):
+    """
+    Metrics indexed by their labels, with a secondary index per label name, so that the
+    metrics having some labels are found without scanning all the metrics.
+
+    The labels of a metric are stored as a sorted tuple of ``(name,value)``, shared by the
+    registry and the indexes. Each metric also has a reference, its key in the registry.
+
+    >>> index = LabelIndex()
+    >>> index.add(LabelIndex.key(event='request',tenant='A',route='/a'),'m1',('request','a'))
+    >>> index.add(LabelIndex.key(event='request',tenant='B',route='/a'),'m2',('request','b'))
+    >>> index.add(LabelIndex.key(event='login',tenant='A'),'m3',('login','a'))
+    >>> sorted(index.select(tenant='A').values())
+    ['m1', 'm3']
+    >>> list(index.select(tenant='A',route='/a').values())
+    ['m1']
+    >>> index.select(tenant='C')
+    {}
+    >>> index.remove(('request','a'))
+    >>> list(index.select(tenant='A').values())
+    ['m3']
+
+    The name of a labelled metric in the registry is built with :py:meth:`format`:
+
+    >>> LabelIndex.format('ok',{'tenant':'A','route':'/a'})
+    'ok{route="/a",tenant="A"}'
+
+    .. versionadded:: 0.9
+    """
+    __slots__ = ('metrics','index','refs','keys')
+
+    def __init__(self):
+        # labels -> metric
+        self.metrics = {}
+        # label name -> label value -> set of labels
+        self.index = {}
+        # reference -> labels, and labels -> reference
+        self.refs = {}
+        self.keys = {}
+
+    @staticmethod
+    def key(**labels):
+        """
+        Return the tuple identifying *labels*.
+        """
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def format(name,labels):
+        """
+        Return the name of the metric *name* with *labels* in the registry.
+        """
+        return name+'{'+','.join('%s="%s"' % (k,v) for k,v in sorted(labels.items()))+'}'
+
+    def add(self,key,metric,ref):
+        """
+        Index *metric* with the labels *key*, and the reference *ref*.
+        """
+        self.metrics[key] = metric
+        self.refs[ref] = key
+        self.keys[key] = ref
+        for name,value in key:
+            self.index.setdefault(name,{}).setdefault(value,set()).add(key)
+
+    def remove(self,ref):
+        """
+        Remove the metric of the reference *ref* from the indexes.
+        """
+        key = self.refs.pop(ref,None)
+        if key is None:
+            return
+        del self.metrics[key]
+        del self.keys[key]
+        for name,value in key:
+            values = self.index[name]
+            keys = values[value]
+            keys.discard(key)
+            if not keys:
+                del values[value]
+                if not values:
+                    del self.index[name]
+
+    def select(self,**labels):
+        """
+        Return the metrics having all the *labels*, as a dictionary indexed by their references.
+        """
+        candidates = []
+        for name,value in labels.items():
+            keys = self.index.get(name,{}).get(value)
+            if not keys:
+                return {}
+            candidates.append(keys)
+        if not candidates:
+            keys = list(self.metrics)
+        else:
+            candidates.sort(key=len)
+            keys = candidates[0].intersection(*candidates[1:])
+        return {self.keys[key]:self.metrics[key] for key in keys}
+
+#______________________________________________________________________________
+class Ticker(object):
+    """
+    Tick meters and rescale histograms on schedule, from a background thread or an
+    :py:mod:`asyncio` task. The metrics registered in a ticker do not check the time anymore
+    when they record an event: the recording path is a plain counter increment.
+
+    A ticker can be shared by several :py:class:`livemetrics.LiveMetrics` objects.
+
+    *interval*: the period of the ticker, in seconds. Default is the tick interval of
+    :py:class:`Meter`, limited to 1 second.
+
+    >>> clock = ManualClock()
+    >>> ticker = Ticker()
+    >>> mtr = ticker.register(Meter(clock))
+    >>> mtr.mark(50)
+    >>> clock.advance(Meter.TICK_INTERVAL*1.5)
+    >>> mtr.mark()
+
+    The meter did not tick when marked, the ticker does it:
+
+    >>> mtr.ewma1.rate
+    0.0
+    >>> ticker.tick()
+    >>> round(mtr.ewma1.rate*Meter.TICK_INTERVAL)
+    51
+
+    The ticker runs in a background thread with :py:meth:`start`, or as a task of the running
+    event loop with :py:meth:`start_async`. In both cases, it is stopped with :py:meth:`stop`,
+    or with a ``with`` statement:
+
+    >>> with Ticker(0.01) as ticker:
+    ...     his = ticker.register(Histogram())
+    >>> ticker.running
+    False
+    """
+
+    def __init__(self,interval=None):
+        if interval is None:
+            interval = min(1.0,Meter.TICK_INTERVAL)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._metrics = weakref.WeakSet()
+        self._stop = threading.Event()
+        self._thread = None
+        self._task = None
+
+    def register(self,metric):
+        """
+        Register a :py:class:`Meter` or a :py:class:`Histogram` to be ticked by this object,
+        and return it.
+        """
+        metric.auto_tick = False
+        with self._lock:
+            self._metrics.add(metric)
+        return metric
+
+    def unregister(self,metric):
+        """
+        Stop ticking *metric*: it checks the time again when it records an event.
+        """
+        with self._lock:
+            self._metrics.discard(metric)
+        metric.auto_tick = True
+
+    def tick(self):
+        """
+        Tick all the registered metrics.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            metric.tick()
+
+    @property
+    def running(self):
+        return self._thread is not None or self._task is not None
+
+    def start(self):
+        """
+        Start ticking the metrics in a background thread.
+        """
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,name='livemetrics-ticker',daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.tick()
+
+    def start_async(self):
+        """
+        Start ticking the metrics in a task of the running event loop.
+        """
+        with self._lock:
+            if self.running:
+                return
+            self._task = asyncio.get_running_loop().create_task(self._run_async())
+
+    async def _run_async(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.tick()
+
+    def stop(self):
+        """
+        Stop the thread or the task ticking the metrics.
+        """
+        with self._lock:
+            thread,self._thread = self._thread,None
+            task,self._task = self._task,None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        if task is not None:
+            task.cancel()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*args):
+        self.stop()
+
+#______________________________________________________________________________
+class IngestQueue(object):
+    """
+    Record the events from the calling thread with a single append to a queue, and apply
+    them later, in batches, from a background thread or an :py:mod:`asyncio` task.
+
+    An item is a tuple: a function and its arguments. The queue is a
+    :py:class:`collections.deque`, appended and popped without lock by the threads.
+
+    *maxsize*: the maximum number of items waiting in the queue. The next items are not
+    queued, they are counted in :py:attr:`dropped`. Default is 100000.
+
+    *interval*: the period of the background thread or task, in seconds. Default is 0.1 second.
+
+    >>> mtr = Meter()
+    >>> queue = IngestQueue(maxsize=2)
+    >>> queue.put((mtr.mark,1)),queue.put((mtr.mark,2)),queue.put((mtr.mark,3))
+    (True, True, False)
+    >>> mtr.count,queue.dropped
+    (0, 1)
+
+    The items are applied by :py:meth:`flush`, called by the background thread or task, and
+    by :py:class:`livemetrics.LiveMetrics` before reading the metrics:
+
+    >>> queue.flush()
+    2
+    >>> mtr.count
+    3
+
+    The queue is started and stopped like a :py:class:`Ticker`:
+
+    >>> with IngestQueue(interval=0.01) as queue:
+    ...     queue.put((mtr.mark,1))
+    True
+    >>> mtr.count
+    4
+
+    An exception raised by an item is not propagated: the item is counted in :py:attr:`errors`.
+    """
+
+    def __init__(self,maxsize=100000,interval=0.1):
+        self.maxsize = maxsize
+        self.interval = interval
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        # Held while a batch is applied, so that flush returns once the items popped
+        # by the background thread are applied too
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._task = None
+        self.dropped = 0
+        self.errors = 0
+
+    def put(self,item):
+        """
+        Queue *item*, a tuple ``(function,*args)``. Return False if the queue is full
+        and the item is dropped.
+        """
+        if len(self._items)>=self.maxsize:
+            with self._lock:
+                self.dropped += 1
+            return False
+        self._items.append(item)
+        return True
+
+    def __len__(self):
+        return len(self._items)
+
+    def flush(self):
+        """
+        Apply all the queued items, and return their number.
+        """
+        items = self._items
+        popleft = items.popleft
+        n = 0
+        errors = 0
+        with self._flush_lock:
+            while items:
+                item = popleft()
+                try:
+                    item[0](*item[1:])
+                except Exception:
+                    errors += 1
+                n += 1
+        if errors:
+            with self._lock:
+                self.errors += errors
+        return n
+
+    @property
+    def running(self):
+        return self._thread is not None or self._task is not None
+
+    def start(self):
+        """
+        Start applying the items in a background thread.
+        """
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,name='livemetrics-ingest',daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def start_async(self):
+        """
+        Start applying the items in a task of the running event loop.
+        """
+        with self._lock:
+            if self.running:
+                return
+            self._task = asyncio.get_running_loop().create_task(self._run_async())
+
+    async def _run_async(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    def stop(self):
+        """
+        Stop the thread or the task, and apply the remaining items.
+        """
+        with self._lock:
+            thread,self._thread = self._thread,None
+            task,self._task = self._task,None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        if task is not None:
+            task.cancel()
+        self.flush()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*args):
+        self.stop()
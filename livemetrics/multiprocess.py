@@ -0,0 +1,521 @@
+
+"""
+This module stores the metrics of a :py:class:`livemetrics.LiveMetrics` object in a memory-mapped
+file, so that the metrics of all the worker processes of a pre-fork server (``gunicorn``, ``uwsgi``)
+can be read by any of them.
+
+Each process writes its meters, gauges and histograms in its own file, named with its pid, in a
+directory shared by all the workers. A process reads the files of all the processes and aggregates
+them, without any communication with the other processes. The files of the processes that are
+not alive anymore are removed when the metrics are read.
+
+It is activated with the parameter *multiprocess* of :py:class:`livemetrics.LiveMetrics`:
+
+.. code-block:: python
+
+    LM = livemetrics.LiveMetrics(version,about,is_healthy,multiprocess='/run/myapp/metrics')
+
+The directory must exist and be empty when the server starts. The object can be created before
+the workers are forked: each worker then writes its own metrics in its own file.
+
+In this mode:
+
+- the meters report the sum of the counts and of the rates of all the processes
+- the gauges report the sum of the values of all the processes, and the minimum and maximum
+  over all the processes. A gauge with a callable is updated in the file when it is read
+  in its own process.
+- the histograms are :py:class:`livemetrics.metrics.HdrHistogram` objects, merged on read
+- the metrics have no sliding window, and the meters are not *striped* or *columnar*
+
+Multiprocess mode is only available on Linux.
+
+.. versionadded:: 0.9
+"""
+
+import os
+import re
+import json
+import mmap
+import struct
+import array
+import threading
+import weakref
+
+from livemetrics.metrics import Meter, Gauge, HdrHistogram
+
+# Header of a file: magic, version, size of the used part of the file
+_MAGIC = b'LMMP'
+_HEADER = struct.Struct('4sIq')
+# Header of an entry: number of 8 bytes slots (negative once removed), size of the key
+_ENTRY = struct.Struct('ii')
+
+#______________________________________________________________________________
+class MmapStore(object):
+    """
+    The memory-mapped file of the current process, in *directory*.
+
+    The file is a sequence of entries. An entry is the JSON key of a metric followed by
+    slots of 8 bytes holding its state. The entries removed are reused by the new entries of
+    the same size, the other entries are appended. The size of the used part of the file is
+    updated once an entry is complete, so that other processes can read the file at any time.
+
+    *size*: the initial size of the file in bytes. When it is full, the file grows by a new
+    segment mapped at its end, doubling its size. The file is sparse: only the used part takes
+    space on disk. Default is 16 MiB.
+
+    *max_size*: the maximum size of the file in bytes. Once reached, the slots of the new
+    entries are allocated in the memory of the process: these metrics are not shared with the
+    other processes, and they are counted in :py:attr:`dropped`. Default is 1 GiB.
+
+    >>> import tempfile
+    >>> store = MmapStore(tempfile.mkdtemp())
+    >>> slots = store.allocate('["test"]',2).cast('q')
+    >>> slots[0] = 42
+    >>> [(key,array.array('q',data).tolist()) for key,data in store.collect()]
+    [(['test'], [42, 0])]
+    >>> store.free('["test"]')
+    >>> store.allocate('["TEST"]',2).cast('q').tolist()
+    [0, 0]
+    >>> [key for key,data in store.collect()]
+    [['TEST']]
+    """
+    FILENAME = 'livemetrics_{}.db'
+    _PATTERN = re.compile(r'^livemetrics_(\d+)\.db$')
+
+    def __init__(self,directory,size=16*1024*1024,max_size=1024*1024*1024):
+        self.directory = directory
+        # The segments are mapped at offsets multiple of the allocation granularity
+        self.size = _round(size)
+        self.max_size = max_size
+        #: Number of entries allocated in the memory of the process, the file being full
+        self.dropped = 0
+        self._metrics = weakref.WeakSet()
+        self._open()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _open(self):
+        self.lock = threading.RLock()
+        # Offset of the entry of each key
+        self._offsets = {}
+        # Offsets of the entries removed, by size of the entry
+        self._free = {}
+        self.pid = os.getpid()
+        self.path = os.path.join(self.directory,self.FILENAME.format(self.pid))
+        fd = os.open(self.path,os.O_RDWR|os.O_CREAT|os.O_TRUNC,0o644)
+        os.close(fd)
+        # List of (offset,mmap) of the segments of the file
+        self._segments = []
+        self._mapped = 0
+        self._map(self.size)
+        self._mmap = self._segments[0][1]
+        self._used = _HEADER.size
+        _HEADER.pack_into(self._mmap,0,_MAGIC,1,self._used)
+
+    def _map(self,size):
+        # Extend the file by a segment of size bytes
+        fd = os.open(self.path,os.O_RDWR)
+        try:
+            os.ftruncate(fd,self._mapped+size)
+            segment = mmap.mmap(fd,size,offset=self._mapped)
+        finally:
+            os.close(fd)
+        self._segments.append((self._mapped,segment))
+        self._mapped += size
+
+    def _segment(self,offset):
+        # Segment containing offset, and the position of offset in the segment
+        for start,segment in reversed(self._segments):
+            if offset>=start:
+                return segment,offset-start
+
+    def _after_fork(self):
+        # The child process writes its own metrics in its own file, from zero
+        self._open()
+        for metric in list(self._metrics):
+            metric._attach(reset=True)
+
+    def bind(self,metric):
+        """
+        Store *metric* in the file. It is stored again, from zero, in the file of a forked process.
+        """
+        self._metrics.add(metric)
+        metric._attach(reset=False)
+
+    def unbind(self,metric):
+        """
+        Remove the entry of *metric* from the file, to be reused by other metrics. The metric
+        keeps its state in the memory of the process, so that it can still be used without
+        being shared with the other processes.
+        """
+        with metric.lock:
+            metric.store = None
+            metric._attach(reset=False)
+        self._metrics.discard(metric)
+        self.free(metric.key)
+
+    def allocate(self,key,nb_slots):
+        """
+        Return the memory view of *nb_slots* slots of 8 bytes set to 0 for *key*, in an entry
+        removed of the same size, or in an entry appended to the file. A previous entry of
+        *key* is removed. If the file cannot grow anymore, the slots are allocated in the memory
+        of the process and counted in :py:attr:`dropped`.
+        """
+        data = key.encode('utf-8')
+        start = _ENTRY.size+(len(data)+7)//8*8
+        size = start+8*nb_slots
+        with self.lock:
+            if key in self._offsets:
+                self.free(key)
+            offsets = self._free.get(size)
+            if offsets:
+                offset = offsets.pop()
+                segment,position = self._segment(offset)
+                # The entry is written while the other processes still skip it as removed
+                _ENTRY.pack_into(segment,position,-nb_slots,len(data))
+                segment[position+_ENTRY.size:position+start] = data.ljust(start-_ENTRY.size,b'\0')
+                segment[position+start:position+size] = bytes(8*nb_slots)
+                _ENTRY.pack_into(segment,position,nb_slots,len(data))
+            else:
+                offset = self._append(size)
+                if offset is None:
+                    self.dropped += 1
+                    return _private(nb_slots)
+                segment,position = self._segment(offset)
+                _ENTRY.pack_into(segment,position,nb_slots,len(data))
+                segment[position+_ENTRY.size:position+_ENTRY.size+len(data)] = data
+                self._used = offset+size
+                # The entry becomes visible to the other processes
+                _HEADER.pack_into(self._mmap,0,_MAGIC,1,self._used)
+            self._offsets[key] = offset
+        return memoryview(segment)[position+start:position+size]
+
+    def _append(self,size):
+        # Offset of a new entry of size bytes at the end of the used part of the file, None
+        # if the file cannot grow anymore
+        offset = self._used
+        start,segment = self._segments[-1]
+        end = start+len(segment)
+        if offset+size<=end:
+            return offset
+        # Doubling the size of the file, or only what the entry needs near the maximum size
+        grow = max(self._mapped,_round(size))
+        if self._mapped+grow>self.max_size:
+            grow = _round(size)
+            if self._mapped+grow>self.max_size:
+                return None
+        try:
+            self._map(grow)
+        except OSError:
+            return None
+        # An entry never spans two segments: the end of the last segment is a removed entry
+        if offset<end:
+            _ENTRY.pack_into(segment,offset-start,-((end-offset-_ENTRY.size)//8),0)
+            self._free.setdefault(end-offset,[]).append(offset)
+        return end
+
+    def free(self,key):
+        """
+        Mark the entry of *key* as removed, to be reused by a new entry of the same size.
+        """
+        with self.lock:
+            offset = self._offsets.pop(key,None)
+            if offset is not None:
+                segment,position = self._segment(offset)
+                nb_slots,size = _ENTRY.unpack_from(segment,position)
+                _ENTRY.pack_into(segment,position,-nb_slots,size)
+                self._free.setdefault(_ENTRY.size+(size+7)//8*8+8*nb_slots,[]).append(offset)
+
+    @staticmethod
+    def read(path):
+        """
+        Return the list of ``(key,bytes)`` of the entries of the file *path*.
+        """
+        entries = []
+        with open(path,'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header)<_HEADER.size:
+                return entries
+            magic,version,used = _HEADER.unpack(header)
+            if magic!=_MAGIC:
+                return entries
+            data = header+f.read(used-_HEADER.size)
+        offset = _HEADER.size
+        while offset<used:
+            nb_slots,size = _ENTRY.unpack_from(data,offset)
+            start = offset+_ENTRY.size+(size+7)//8*8
+            end = start+8*abs(nb_slots)
+            if nb_slots>0:
+                key = json.loads(data[offset+_ENTRY.size:offset+_ENTRY.size+size].decode('utf-8'))
+                entries.append((key,data[start:end]))
+            offset = end
+        return entries
+
+    def collect(self):
+        """
+        Return the entries of the files of all the processes alive, and remove the files
+        of the processes that are dead.
+        """
+        entries = []
+        for name in sorted(os.listdir(self.directory)):
+            match = self._PATTERN.match(name)
+            if not match:
+                continue
+            path = os.path.join(self.directory,name)
+            pid = int(match.group(1))
+            if pid!=self.pid and not _alive(pid):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                entries.extend(self.read(path))
+            except FileNotFoundError:
+                pass
+        return entries
+
+def _round(size):
+    # Size rounded up to the allocation granularity of the memory-mapped files
+    return -(-size//mmap.ALLOCATIONGRANULARITY)*mmap.ALLOCATIONGRANULARITY
+
+def _private(nb_slots):
+    # Slots in the memory of the process, not shared with the other processes
+    return memoryview(bytearray(8*nb_slots))
+
+def _allocate(store,key,nb_slots):
+    # Slots of a metric: in the store, or in the memory of the process once unbound
+    if store is None:
+        return _private(nb_slots)
+    return store.allocate(key,nb_slots)
+
+def _alive(pid):
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+#______________________________________________________________________________
+class MmapMeter(Meter):
+    """
+    A :py:class:`livemetrics.metrics.Meter` saving its state in a :py:class:`MmapStore`:
+    the count at each event, the moving averages at each tick.
+    """
+    __slots__ = ('store','key','_ints','_floats')
+
+    def __init__(self,store,event,result,clock=None):
+        super().__init__(clock)
+        self.store = store
+        self.key = json.dumps(['meter',event,result])
+        store.bind(self)
+
+    def _attach(self,reset):
+        if reset:
+            Meter.__init__(self,self.clock)
+        slots = _allocate(self.store,self.key,8)
+        self._ints = slots.cast('q')
+        self._floats = slots.cast('d')
+        self._save()
+
+    def _save(self):
+        ints = self._ints
+        floats = self._floats
+        ints[0] = self._count
+        ints[1] = self._merged
+        ints[2] = self.start
+        ints[3] = self.last_tick
+        floats[4] = self.ewma1._rate
+        floats[5] = self.ewma5._rate
+        floats[6] = self.ewma15._rate
+        ints[7] = int(self.ewma1.initialized)
+
+    def mark(self,n=1):
+        """
+        Indicate an event has just occurred. *n* specifies the number of events.
+        """
+        with self.lock:
+            super().mark(n)
+            self._ints[0] = self._count
+
+    def _tick_if_necessary(self):
+        last_tick = self.last_tick
+        super()._tick_if_necessary()
+        if self.last_tick!=last_tick:
+            self._save()
+
+class MmapGauge(Gauge):
+    """
+    A :py:class:`livemetrics.metrics.Gauge` saving its value, minimum and maximum
+    in a :py:class:`MmapStore`.
+    """
+    __slots__ = ('store','key','_floats','__weakref__')
+
+    def __init__(self,store,name,value=None):
+        super().__init__(value)
+        self.store = store
+        self.key = json.dumps(['gauge',name])
+        store.bind(self)
+
+    def _attach(self,reset):
+        # A gauge keeps its value in a forked process
+        self._floats = _allocate(self.store,self.key,4).cast('d')
+        self._save()
+
+    def _save(self):
+        floats = self._floats
+        floats[0] = _float(self._value)
+        floats[1] = _float(self._min)
+        floats[2] = _float(self._max)
+        floats[3] = 0.0 if self._value is None else 1.0
+
+    def mark(self,value):
+        """
+        Register a new value in the gauge and update the statistics.
+        """
+        super().mark(value)
+        with self.lock:
+            self._save()
+
+class MmapHistogram(HdrHistogram):
+    """
+    A :py:class:`livemetrics.metrics.HdrHistogram` whose buckets are stored
+    in a :py:class:`MmapStore`.
+    """
+    __slots__ = ('store','key','_ints','_floats')
+
+    def __init__(self,store,name,clock=None,lowest=1e-6,highest=3600.0,significant_digits=2):
+        super().__init__(clock,lowest,highest,significant_digits)
+        self.store = store
+        self.key = json.dumps(['histogram',name,lowest,highest,significant_digits])
+        store.bind(self)
+
+    def _attach(self,reset):
+        with self.lock:
+            counts = self.counts
+            slots = _allocate(self.store,self.key,3+len(counts))
+            self._ints = slots.cast('q')
+            self._floats = slots.cast('d')
+            if reset:
+                self._count = 0
+                self._min = 0
+                self._max = 0
+                self._version += 1
+            else:
+                self._ints[3:] = array.array('q',counts)
+            self.counts = self._ints[3:]
+            self._save()
+
+    def _save(self):
+        self._ints[0] = self._count
+        self._floats[1] = self._min
+        self._floats[2] = self._max
+
+    def update(self,value):
+        """
+        Register a new value in the histogram.
+        """
+        super().update(value)
+        with self.lock:
+            self._save()
+
+    def merge(self,other):
+        """
+        Add the values recorded by the :py:class:`livemetrics.metrics.HdrHistogram` *other* to this histogram.
+        """
+        super().merge(other)
+        with self.lock:
+            self._save()
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError,ValueError):
+        return float('nan')
+
+#______________________________________________________________________________
+class Aggregate(dict):
+    """
+    The metrics of a meter or a gauge aggregated over all the processes:
+    a dictionary whose items can also be read as attributes, like the metric itself.
+
+    >>> a = Aggregate(count=3,mean=0.5)
+    >>> a.count,a.to_dict()
+    (3, {'count': 3, 'mean': 0.5})
+    """
+
+    def __getattr__(self,name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def to_dict(self):
+        return dict(self)
+
+def aggregate(entries,clock=None):
+    """
+    Aggregate the *entries* returned by :py:meth:`MmapStore.collect`, and return a tuple:
+
+    - the :py:class:`Aggregate` of the meters, indexed by event and result
+    - the :py:class:`Aggregate` of the gauges, indexed by name
+    - a dictionary of the merged :py:class:`livemetrics.metrics.HdrHistogram`, indexed by their name
+    """
+    meters = {}
+    gauges = {}
+    histograms = {}
+    for key,data in entries:
+        kind = key[0]
+        if kind=='meter':
+            event,result = key[1:]
+            metrics = _meter_data(data,clock)
+            results = meters.setdefault(event,{})
+            if result in results:
+                for k,v in metrics.items():
+                    results[result][k] += v
+            else:
+                results[result] = Aggregate(metrics)
+        elif kind=='gauge':
+            value,min_,max_,is_set = array.array('d',data)
+            if not is_set:
+                continue
+            gauge = gauges.get(key[1])
+            if gauge is None:
+                gauges[key[1]] = Aggregate(min=min_,max=max_,count=value)
+            else:
+                gauge['min'] = min(gauge['min'],min_)
+                gauge['max'] = max(gauge['max'],max_)
+                gauge['count'] += value
+        elif kind=='histogram':
+            name,lowest,highest,significant_digits = key[1:]
+            his = histograms.get(name)
+            if his is None:
+                his = histograms[name] = HdrHistogram(clock,lowest,highest,significant_digits)
+            other = HdrHistogram(clock,lowest,highest,significant_digits)
+            ints = array.array('q',data)
+            floats = array.array('d',data)
+            other.counts = ints[3:]
+            other._count = ints[0]
+            other._min = floats[1]
+            other._max = floats[2]
+            try:
+                his.merge(other)
+            except ValueError:
+                # Same name with other parameters: keep the first ones
+                pass
+    return meters,gauges,histograms
+
+def _meter_data(data,clock):
+    # Restore the meter as it was at its last tick: reading it decays the rates up to now
+    ints = array.array('q',data)
+    floats = array.array('d',data)
+    meter = Meter(clock)
+    meter._count = ints[0]
+    meter._merged = ints[1]
+    meter.start = ints[2]
+    meter.last_tick = ints[3]
+    for i,ewma in enumerate((meter.ewma1,meter.ewma5,meter.ewma15)):
+        ewma._rate = floats[4+i]
+        ewma.initialized = bool(ints[7])
+    return meter.to_dict()
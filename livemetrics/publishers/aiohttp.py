@@ -28,14 +28,19 @@ A minimal application would be:
 
 """
 
-import json
 
 import asyncio
 from aiohttp import web
 
+from livemetrics.publishers.cache import parse_since
+from livemetrics.publishers.encoding import respond
+from livemetrics.publishers.prometheus import CONTENT_TYPE, parse_query, render
+
 class Handler:
-    def __init__(self,LM):
+    def __init__(self,LM,cache=None,encoder=None):
         self.LM = LM
+        self.cache = cache
+        self.encoder = encoder
 
     async def about(self,request):
         data = self.LM.about
@@ -76,75 +81,54 @@ class Handler:
             headers={"Access-Control-Allow-Origin": "*"},
             body=data)
 
+    async def prometheus(self,request):
+        try:
+            params = parse_query({k:request.query.getall(k) for k in request.query.keys()})
+        except ValueError as exc:
+            return web.Response(status=400,body=str(exc))
+        resp = web.StreamResponse(status=200,
+            headers={"Content-Type": CONTENT_TYPE, "Access-Control-Allow-Origin": "*"})
+        await resp.prepare(request)
+        for chunk in render(self.LM,params):
+            await resp.write(chunk)
+        await resp.write_eof()
+        return resp
+
     async def get_meters3(self,request):
         event = request.match_info['event']
         result = request.match_info['result']
         metric = request.match_info['metric']
-        data = self.LM.get_metrics(event,result,metric)
-        data = json.dumps(data)
-        return web.Response(status=200,
-            content_type='application/json',
-            headers={"Content-Length": str(len(data)), "Access-Control-Allow-Origin": "*"},
-            body=data)
+        return self._respond(request,'meters',(result,metric),(event,result),lambda encoder,since: encoder.dumps(self.LM,'meters',event,result,metric,since=since))
 
     async def get_meters2(self,request):
         event = request.match_info['event']
         result = request.match_info['result']
-        data = self.LM.get_metrics(event,result)
-        data = json.dumps(data)
-        return web.Response(status=200,
-            content_type='application/json',
-            headers={"Content-Length": str(len(data)), "Access-Control-Allow-Origin": "*"},
-            body=data)
+        return self._respond(request,'meters',(result,),(event,result),lambda encoder,since: encoder.dumps(self.LM,'meters',event,result,since=since))
 
     async def get_meters1(self,request):
         event = request.match_info['event']
-        data = self.LM.get_metrics(event)
-        data = json.dumps(data)
-        return web.Response(status=200,
-            content_type='application/json',
-            headers={"Content-Length": str(len(data)), "Access-Control-Allow-Origin": "*"},
-            body=data)
+        return self._respond(request,'meters',(),(event,),lambda encoder,since: encoder.dumps(self.LM,'meters',event,since=since))
 
     async def get_meters0(self,request):
-        data = self.LM.get_metrics()
-        data = json.dumps(data)
-        return web.Response(status=200,
-            content_type='application/json',
-            headers={"Content-Length": str(len(data)), "Access-Control-Allow-Origin": "*"},
-            body=data)
+        return self._respond(request,'meters',(),(),lambda encoder,since: encoder.dumps(self.LM,'meters',since=since))
 
     async def get_gauges2(self,request):
         object = request.match_info['object']
         metric = request.match_info['metric']
-        data = self.LM.get_gauges(object,metric)
-        data = json.dumps(data)
-        return web.Response(status=200,
-            content_type='application/json',
-            headers={"Content-Length": str(len(data)), "Access-Control-Allow-Origin": "*"},
-            body=data)
+        return self._respond(request,'gauges',(object,metric),(object,),lambda encoder,since: encoder.dumps(self.LM,'gauges',object,metric,since=since))
 
     async def get_gauges1(self,request):
         object = request.match_info['object']
-        data = self.LM.get_gauges(object)
-        data = json.dumps(data)
-        return web.Response(status=200,
-            content_type='application/json',
-            headers={"Content-Length": str(len(data)), "Access-Control-Allow-Origin": "*"},
-            body=data)
+        return self._respond(request,'gauges',(object,),(object,),lambda encoder,since: encoder.dumps(self.LM,'gauges',object,since=since))
 
     async def get_gauges0(self,request):
-        data = self.LM.get_gauges()
-        data = json.dumps(data)
-        return web.Response(status=200,
-            content_type='application/json',
-            headers={"Content-Length": str(len(data)), "Access-Control-Allow-Origin": "*"},
-            body=data)
+        return self._respond(request,'gauges',(),(),lambda encoder,since: encoder.dumps(self.LM,'gauges',since=since))
 
     def _get_histograms(self,request,event,metric):
         msg = None
         params = {}
         params.update(request.query)
+        params.pop('since',None)
         if not isinstance(params.setdefault('percentiles',[0.05, 0.25, 0.5, 0.75, 0.95]),list):
             params['percentiles'] = [params['percentiles']]
         if not isinstance(params.setdefault('scale',[10]),list):
@@ -153,7 +137,7 @@ class Handler:
         if len(params)!=2:
             keys = ", ".join(sorted(list(set(params.keys()) - {'percentiles', 'scale'})))
             msg="Invalid query parameters: " + keys
-        if not metric in [None,'count','min','max','mean','stddev','quantiles','distribution']:
+        if not metric in [None,'count','min','max','mean','stddev','quantiles','distribution','window']:
             msg = "Unknown metric " + metric
         if msg:
             return web.Response(status=400,body=msg)
@@ -162,16 +146,30 @@ class Handler:
         params['percentiles'] = [float(x) for x in params['percentiles']]
         params['scale'] = int(params['scale'][0])
 
+        return self._respond(request,'histograms',(event,metric),(event,),lambda encoder,since: encoder.dumps(self.LM,'histograms',event,metric,since=since,**params))
+
+    def _respond(self,request,kind,path,names,compute):
+        # Response of the metrics of kind, or 304 if the client already has it.
+        # The query parameter since is only accepted if the elements of path are None.
+        # The ETag is the version of the metric of names
         try:
-            data = self.LM.get_histograms(event,metric,**params)
+            since = parse_since(request.query.get('since'),*path)
+        except ValueError as exc:
+            return web.Response(status=400,body=str(exc))
+        try:
+            # The event loop must not wait for a response computed by another thread
+            status,body,headers = respond(self.encoder,self.cache,self.LM,kind,request.path_qs,request.headers,lambda encoder: compute(encoder,since),wait=False,names=names)
         except Exception as exc:
             msg = str(exc)
             return web.Response(status=500,body=msg)
-        data = json.dumps(data)
+        headers["Access-Control-Allow-Origin"] = "*"
+        if status!=200:
+            return web.Response(status=status,headers=headers)
+        headers["Content-Length"] = str(len(body))
         return web.Response(status=200,
             content_type='application/json',
-            headers={"Content-Length": str(len(data)), "Access-Control-Allow-Origin": "*"},
-            body=data)
+            headers=headers,
+            body=body)
 
     async def get_histograms2(self,request):
         event = request.match_info['event']
@@ -185,18 +183,49 @@ class Handler:
     async def get_histograms0(self,request):
         return self._get_histograms(request,None,None)
 
-def routes(LM):
+def ticker_context(ticker):
+    """
+    Return a cleanup context running a :py:class:`livemetrics.metrics.Ticker` as a task of
+    the :py:mod:`aiohttp` application, and stopping it when the application is shut down.
+
+    *ticker*: a :py:class:`livemetrics.metrics.Ticker` object, as given to
+    :py:class:`livemetrics.LiveMetrics`. The *queue* of :py:class:`livemetrics.LiveMetrics`
+    (a :py:class:`livemetrics.metrics.IngestQueue`) is run in the same way.
+
+    .. code-block:: python
+
+        app.cleanup_ctx.append(livemetrics.publishers.aiohttp.ticker_context(ticker))
+    """
+    async def _ctx(app):
+        ticker.start_async()
+        yield
+        ticker.stop()
+    return _ctx
+
+def routes(LM,cache=None,encoder=None):
     """
     Return a list of routes to be registered in the :py:mod:`aiohttp` application.
 
     *LM*: a :py:class:`livemetrics.LiveMetrics` object
+
+    *cache*: an optional :py:class:`livemetrics.publishers.cache.ResponseCache` for the
+    responses of the metrics. The requests are not coalesced with the requests of other
+    threads, which would block the event loop: only the responses kept during the time to
+    live are shared.
+
+    *encoder*: an optional :py:class:`livemetrics.publishers.encoding.Encoder` encoding and
+    compressing the responses of the metrics
+
+    .. versionadded:: 0.9
+        *cache*, *encoder*
     """
-    handler = Handler(LM)
+    handler = Handler(LM,cache,encoder)
     return [
         web.get('/monitoring/v1/about', handler.about),
         web.get('/monitoring/v1/is_healthy', handler.is_healthy),
         web.get('/monitoring/v1/is_ready', handler.is_ready),
         web.get('/monitoring/v1/version', handler.version),
+        web.get('/monitoring/v1/prometheus', handler.prometheus),
 
         web.get('/monitoring/v1/metrics/meters/{event}/{result}/{metric}', handler.get_meters3),
         web.get('/monitoring/v1/metrics/meters/{event}/{result}', handler.get_meters2),
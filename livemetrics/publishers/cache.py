@@ -0,0 +1,230 @@
+"""
+This module provides the cache of the responses of the publishers, shared by all the publishers.
+
+The responses of the metrics (``/monitoring/v1/metrics/...``) are kept during a time to live,
+indexed by their path and query. Identical requests received at the same time are coalesced:
+only one of them reads the metrics and encodes the response, the others wait for its result.
+So the cost of the publication does not grow with the number of dashboards, scrapers and probes
+polling the application. The :py:mod:`aiohttp` publisher does not wait for a response computed
+by another thread, which would block its event loop: it only gets the responses kept during the
+time to live.
+
+A cache is given to the publisher with its parameter *cache*:
+
+.. code-block:: python
+
+    cache = livemetrics.publishers.cache.ResponseCache(ttl=1.0)
+    app.register_blueprint(livemetrics.publishers.flask.blueprint(LM,cache=cache))
+
+The responses of the metrics have an ``ETag``, the version of the metrics read
+(see :py:meth:`livemetrics.LiveMetrics.get_version`): the version of the metric for the path
+of a single metric, or of all the metrics of its kind for a list. A request with this ``ETag`` in its header
+``If-None-Match`` gets a ``304 Not Modified`` response if none of these metrics changed.
+With a cache, the version is also kept during the time to live.
+
+.. versionadded:: 0.9
+"""
+
+import threading
+
+from livemetrics.metrics import CLOCK
+
+#______________________________________________________________________________
+class _Pending(object):
+    # A response being computed, waited for by the identical requests
+    __slots__ = ('event','value','error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+class ResponseCache(object):
+    """
+    A cache of responses, indexed by a key (the path and the query of the request).
+
+    *ttl*: the time to live of a response, in seconds. With 0, the responses are not kept,
+    only the identical requests received at the same time are coalesced. Default is 1 second.
+
+    *max_entries*: the maximum number of responses kept. Default is 1024.
+
+    *clock*: the :py:class:`livemetrics.metrics.Clock` giving the time.
+    Default is :py:data:`livemetrics.metrics.CLOCK`.
+
+    >>> from livemetrics.metrics import ManualClock
+    >>> clock = ManualClock()
+    >>> cache = ResponseCache(ttl=1.0,clock=clock)
+    >>> cache.get('/metrics',lambda: 'A')
+    'A'
+    >>> cache.get('/metrics',lambda: 'B')
+    'A'
+    >>> clock.advance(1.5)
+    >>> cache.get('/metrics',lambda: 'B')
+    'B'
+    >>> cache.hits,cache.misses,cache.coalesced
+    (1, 2, 0)
+    """
+
+    def __init__(self,ttl=1.0,max_entries=1024,clock=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock or CLOCK
+        self._lock = threading.Lock()
+        # key -> (expiration time, response), from the oldest
+        self._entries = {}
+        # key -> _Pending
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self,key,compute,wait=True):
+        """
+        Return the response of *key*, computed with the callable *compute* if it is not
+        in the cache or expired. If another thread is computing it, wait for its result.
+        An exception raised by *compute* is raised in all the waiting threads, and
+        nothing is cached.
+
+        *wait*: if False, the response being computed by another thread is computed again
+        instead of waiting for it, as in an event loop of :py:mod:`asyncio`, which must not
+        block. Default is True.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]>self.clock.now():
+                self.hits += 1
+                return entry[1]
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = _Pending()
+                self.misses += 1
+                owner = True
+            elif not wait:
+                self.misses += 1
+                pending = None
+                owner = False
+            else:
+                self.coalesced += 1
+                owner = False
+        if pending is None:
+            value = compute()
+            if self.ttl>0:
+                self._put(key,value)
+            return value
+        if not owner:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+        try:
+            pending.value = compute()
+        except BaseException as exc:
+            pending.error = exc
+            raise
+        else:
+            if self.ttl>0:
+                self._put(key,pending.value)
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.event.set()
+        return pending.value
+
+    def _put(self,key,value):
+        with self._lock:
+            now = self.clock.now()
+            entries = self._entries
+            entries.pop(key,None)
+            if len(entries)>=self.max_entries:
+                # Remove the expired responses, and the oldest ones if still full
+                for k in [k for k,(expiration,v) in entries.items() if expiration<=now]:
+                    del entries[k]
+                while len(entries)>=self.max_entries:
+                    del entries[next(iter(entries))]
+            entries[key] = (now+int(self.ttl*1e9),value)
+
+    def clear(self):
+        """
+        Remove all the responses.
+        """
+        with self._lock:
+            self._entries.clear()
+
+def cached(cache,key,compute,wait=True):
+    """
+    Return ``compute()``, through *cache* if it is not None (see :py:meth:`ResponseCache.get`
+    for *wait*).
+    """
+    if cache is None:
+        return compute()
+    return cache.get(key,compute,wait)
+
+def etag(version):
+    """
+    Return the ``ETag`` of a response of the metrics at *version*.
+
+    >>> etag(12)
+    '"12"'
+    """
+    return '"%d"' % version
+
+def not_modified(if_none_match,tag):
+    """
+    Return True if the header ``If-None-Match`` of a request (None if missing) matches the
+    ``ETag`` *tag*: the client already has the response.
+
+    >>> not_modified('"11", W/"12"',etag(12))
+    True
+    >>> not_modified(None,etag(12))
+    False
+    """
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or tag in tags or 'W/'+tag in tags
+
+def conditional(cache,LM,kind,key,if_none_match,compute,wait=True,names=()):
+    """
+    Return a tuple with the ``ETag`` of the metrics of *kind* (``meters``, ``gauges`` or
+    ``histograms``) of *LM*, and the response of *key* computed with *compute*, through
+    *cache* if it is not None (see :py:meth:`ResponseCache.get` for *wait*). The response is
+    None if the header ``If-None-Match`` of the request matches the ``ETag``: a
+    ``304 Not Modified`` must be returned.
+
+    *names*: the names of the metric read, as the parameters *name* and *result* of
+    :py:meth:`livemetrics.LiveMetrics.get_version`, empty or None for all the metrics of *kind*.
+    """
+    names = tuple(names)
+    tag = etag(cached(cache,('version',kind)+names,lambda: LM.get_version(kind,*names),wait))
+    if not_modified(if_none_match,tag):
+        return tag,None
+    # The response is kept with its version
+    return tag,cached(cache,(key,tag),compute,wait)
+
+def parse_since(since,*path):
+    """
+    Return the version of the query parameter ``since`` of a request (None if missing), for
+    a list of metrics whose elements of *path* are None. Raise a :py:class:`ValueError` with
+    the message of the response 400 if the version is not an integer, or if *path* is the
+    path of a single metric.
+
+    >>> parse_since('12',None,None)
+    12
+    >>> parse_since('abc',None,None)
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid version since=abc
+    >>> parse_since('12','ok',None)
+    Traceback (most recent call last):
+    ...
+    ValueError: since is only accepted by the lists of metrics
+    """
+    if since is None:
+        return None
+    try:
+        version = int(since)
+    except ValueError:
+        raise ValueError("Invalid version since=" + since) from None
+    if any(p is not None for p in path):
+        raise ValueError("since is only accepted by the lists of metrics")
+    return version
@@ -33,12 +33,15 @@ In your :file:`urls.py`, register your views with:
 
 """
 
-import json
 
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.views import View
 from django.urls import path
 
+from livemetrics.publishers.cache import parse_since
+from livemetrics.publishers.encoding import respond
+from livemetrics.publishers.prometheus import CONTENT_TYPE, parse_query, render
+
 class About(View):
     LM = None
     def get(self,request):
@@ -77,73 +80,93 @@ class Version(View):
         resp["Access-Control-Allow-Origin"] = "*"
         return resp
 
+class Prometheus(View):
+    LM = None
+    def get(self,request):
+        try:
+            params = parse_query(dict(request.GET.lists()))
+        except ValueError as exc:
+            return HttpResponse(str(exc), status=400)
+        resp = StreamingHttpResponse(render(self.LM,params),content_type=CONTENT_TYPE)
+        resp["Access-Control-Allow-Origin"] = "*"
+        return resp
+
+def _respond(LM,cache,encoder,request,kind,path,names,compute):
+    # Response of the metrics of kind, or 304 if the client already has it.
+    # The query parameter since is only accepted if the elements of path are None.
+    # The ETag is the version of the metric of names
+    try:
+        since = parse_since(request.GET.get('since'),*path)
+    except ValueError as exc:
+        return HttpResponse(str(exc), status=400)
+    try:
+        status,body,headers = respond(encoder,cache,LM,kind,request.get_full_path(),request.headers,lambda encoder: compute(encoder,since),names=names)
+    except Exception as exc:
+        msg = str(exc)
+        return HttpResponse(msg, status=500)
+    if status!=200:
+        resp = HttpResponse(status=status)
+    else:
+        resp = HttpResponse(body,content_type='application/json')
+    for name,value in headers.items():
+        resp[name] = value
+    resp["Access-Control-Allow-Origin"] = "*"
+    return resp
+
 class Meters3(View):
     LM =  None
+    cache = None
+    encoder = None
     def get(self,request,event,result,metric):
-        data = self.LM.get_metrics(event,result,metric)
-        data = json.dumps(data)
-        resp = HttpResponse(data,content_type='application/json')
-        resp["Access-Control-Allow-Origin"] = "*"
-        return resp
+        return _respond(self.LM,self.cache,self.encoder,request,'meters',(result,metric),(event,result),lambda encoder,since: encoder.dumps(self.LM,'meters',event,result,metric,since=since))
 
 class Meters2(View):
     LM =  None
+    cache = None
+    encoder = None
     def get(self,request,event,result):
-        data = self.LM.get_metrics(event,result)
-        data = json.dumps(data)
-        resp = HttpResponse(data,content_type='application/json')
-        resp["Access-Control-Allow-Origin"] = "*"
-        return resp
+        return _respond(self.LM,self.cache,self.encoder,request,'meters',(result,),(event,result),lambda encoder,since: encoder.dumps(self.LM,'meters',event,result,since=since))
 
 class Meters1(View):
     LM =  None
+    cache = None
+    encoder = None
     def get(self,request,event):
-        data = self.LM.get_metrics(event)
-        data = json.dumps(data)
-        resp = HttpResponse(data,content_type='application/json')
-        resp["Access-Control-Allow-Origin"] = "*"
-        return resp
+        return _respond(self.LM,self.cache,self.encoder,request,'meters',(),(event,),lambda encoder,since: encoder.dumps(self.LM,'meters',event,since=since))
 
 class Meters0(View):
     LM =  None
+    cache = None
+    encoder = None
     def get(self,request):
-        data = self.LM.get_metrics()
-        data = json.dumps(data)
-        resp = HttpResponse(data,content_type='application/json')
-        resp["Access-Control-Allow-Origin"] = "*"
-        return resp
+        return _respond(self.LM,self.cache,self.encoder,request,'meters',(),(),lambda encoder,since: encoder.dumps(self.LM,'meters',since=since))
 
 class Gauges2(View):
     LM =  None
+    cache = None
+    encoder = None
     def get(self,request,object,metric):
-        data = self.LM.get_gauges(object,metric)
-        data = json.dumps(data)
-        resp = HttpResponse(data,content_type='application/json')
-        resp["Access-Control-Allow-Origin"] = "*"
-        return resp
+        return _respond(self.LM,self.cache,self.encoder,request,'gauges',(object,metric),(object,),lambda encoder,since: encoder.dumps(self.LM,'gauges',object,metric,since=since))
 
 class Gauges1(View):
     LM =  None
+    cache = None
+    encoder = None
     def get(self,request,object):
-        data = self.LM.get_gauges(object)
-        data = json.dumps(data)
-        resp = HttpResponse(data,content_type='application/json')
-        resp["Access-Control-Allow-Origin"] = "*"
-        return resp
+        return _respond(self.LM,self.cache,self.encoder,request,'gauges',(object,),(object,),lambda encoder,since: encoder.dumps(self.LM,'gauges',object,since=since))
 
 class Gauges0(View):
     LM =  None
+    cache = None
+    encoder = None
     def get(self,request):
-        data = self.LM.get_gauges()
-        data = json.dumps(data)
-        resp = HttpResponse(data,content_type='application/json')
-        resp["Access-Control-Allow-Origin"] = "*"
-        return resp
+        return _respond(self.LM,self.cache,self.encoder,request,'gauges',(),(),lambda encoder,since: encoder.dumps(self.LM,'gauges',since=since))
 
-def _get_histograms(LM,request,event,metric):
+def _get_histograms(LM,cache,encoder,request,event,metric):
     msg = None
     params = {}
     params.update(request.GET)
+    params.pop('since',None)
     if not isinstance(params.setdefault('percentiles',[0.05, 0.25, 0.5, 0.75, 0.95]),list):
         params['percentiles'] = [params['percentiles']]
     if not isinstance(params.setdefault('scale',[10]),list):
@@ -151,7 +174,7 @@ def _get_histograms(LM,request,event,metric):
     if len(params)!=2:
         keys = ", ".join(sorted(list(set(params.keys()) - {'percentiles', 'scale'})))
         msg="Invalid query parameters: " + keys
-    if not metric in [None,'count','min','max','mean','stddev','quantiles','distribution']:
+    if not metric in [None,'count','min','max','mean','stddev','quantiles','distribution','window']:
         msg = "Unknown metric " + metric
     if msg:
         return HttpResponse(msg, status=400)
@@ -160,54 +183,62 @@ def _get_histograms(LM,request,event,metric):
     params['percentiles'] = [float(x) for x in params['percentiles']]
     params['scale'] = int(params['scale'][0])
 
-    try:
-        data = LM.get_histograms(event,metric,**params)
-    except Exception as exc:
-        msg = str(exc)
-        return HttpResponse(msg, status=500)
-    data = json.dumps(data)
-    resp = HttpResponse(data,content_type='application/json')
-    resp["Access-Control-Allow-Origin"] = "*"
-    return resp
+    return _respond(LM,cache,encoder,request,'histograms',(event,metric),(event,),lambda encoder,since: encoder.dumps(LM,'histograms',event,metric,since=since,**params))
 
 class Histograms2(View):
     LM =  None
+    cache = None
+    encoder = None
     def get(self,request,event,metric):
-        return _get_histograms(self.LM,request,event,metric)
+        return _get_histograms(self.LM,self.cache,self.encoder,request,event,metric)
 
 class Histograms1(View):
     LM =  None
+    cache = None
+    encoder = None
     def get(self,request,event):
-        return _get_histograms(self.LM,request,event,None)
+        return _get_histograms(self.LM,self.cache,self.encoder,request,event,None)
 
 class Histograms0(View):
     LM =  None
+    cache = None
+    encoder = None
     def get(self,request):
-        return _get_histograms(self.LM,request,None,None)
+        return _get_histograms(self.LM,self.cache,self.encoder,request,None,None)
 
-def urlpatterns(LM):
+def urlpatterns(LM,cache=None,encoder=None):
     """
     Return a list of Django paths to be registered in the application.
 
     *LM*: a :py:class:`livemetrics.LiveMetrics` object
+
+    *cache*: an optional :py:class:`livemetrics.publishers.cache.ResponseCache` for the
+    responses of the metrics
+
+    *encoder*: an optional :py:class:`livemetrics.publishers.encoding.Encoder` encoding and
+    compressing the responses of the metrics
+
+    .. versionadded:: 0.9
+        *cache*, *encoder*
     """
     urlpatterns = [
         path('monitoring/v1/about', About.as_view(LM=LM),name='monitoring-about'),
         path('monitoring/v1/is_healthy', IsHealthy.as_view(LM=LM),name='monitoring-is_healthy'),
         path('monitoring/v1/is_ready', IsReady.as_view(LM=LM),name='monitoring-is_ready'),
         path('monitoring/v1/version', Version.as_view(LM=LM),name='monitoring-version'),
+        path('monitoring/v1/prometheus', Prometheus.as_view(LM=LM),name='monitoring-prometheus'),
 
-        path('monitoring/v1/metrics/meters/<event>/<result>/<metric>', Meters3.as_view(LM=LM),name='monitoring-meters3'),
-        path('monitoring/v1/metrics/meters/<event>/<result>', Meters2.as_view(LM=LM),name='monitoring-meters2'),
-        path('monitoring/v1/metrics/meters/<event>', Meters1.as_view(LM=LM),name='monitoring-meters1'),
-        path('monitoring/v1/metrics/meters', Meters0.as_view(LM=LM),name='monitoring-meters0'),
+        path('monitoring/v1/metrics/meters/<event>/<result>/<metric>', Meters3.as_view(LM=LM,cache=cache,encoder=encoder),name='monitoring-meters3'),
+        path('monitoring/v1/metrics/meters/<event>/<result>', Meters2.as_view(LM=LM,cache=cache,encoder=encoder),name='monitoring-meters2'),
+        path('monitoring/v1/metrics/meters/<event>', Meters1.as_view(LM=LM,cache=cache,encoder=encoder),name='monitoring-meters1'),
+        path('monitoring/v1/metrics/meters', Meters0.as_view(LM=LM,cache=cache,encoder=encoder),name='monitoring-meters0'),
 
-        path('monitoring/v1/metrics/gauges/<object>/<metric>', Gauges2.as_view(LM=LM),name='monitoring-gauges2'),
-        path('monitoring/v1/metrics/gauges/<object>', Gauges1.as_view(LM=LM),name='monitoring-gauges1'),
-        path('monitoring/v1/metrics/gauges', Gauges0.as_view(LM=LM),name='monitoring-gauges0'),
+        path('monitoring/v1/metrics/gauges/<object>/<metric>', Gauges2.as_view(LM=LM,cache=cache,encoder=encoder),name='monitoring-gauges2'),
+        path('monitoring/v1/metrics/gauges/<object>', Gauges1.as_view(LM=LM,cache=cache,encoder=encoder),name='monitoring-gauges1'),
+        path('monitoring/v1/metrics/gauges', Gauges0.as_view(LM=LM,cache=cache,encoder=encoder),name='monitoring-gauges0'),
 
-        path('monitoring/v1/metrics/histograms/<event>/<metric>', Histograms2.as_view(LM=LM),name='monitoring-histograms2'),
-        path('monitoring/v1/metrics/histograms/<event>', Histograms1.as_view(LM=LM),name='monitoring-histograms1'),
-        path('monitoring/v1/metrics/histograms', Histograms0.as_view(LM=LM),name='monitoring-histograms0'),
+        path('monitoring/v1/metrics/histograms/<event>/<metric>', Histograms2.as_view(LM=LM,cache=cache,encoder=encoder),name='monitoring-histograms2'),
+        path('monitoring/v1/metrics/histograms/<event>', Histograms1.as_view(LM=LM,cache=cache,encoder=encoder),name='monitoring-histograms1'),
+        path('monitoring/v1/metrics/histograms', Histograms0.as_view(LM=LM,cache=cache,encoder=encoder),name='monitoring-histograms0'),
     ]
     return urlpatterns
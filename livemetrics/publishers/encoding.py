@@ -0,0 +1,175 @@
+"""
+This module provides the encoding of the responses of the publishers, shared by all the publishers:
+the JSON library producing the bytes of the responses, and their compression.
+
+By default, the responses are encoded with :py:mod:`json`, assembling the JSON kept for each
+metric (see :py:meth:`livemetrics.LiveMetrics.get_metrics_json`). :py:mod:`orjson` or
+:py:mod:`msgspec`, when installed, encode the metrics directly in bytes, but they encode all
+the metrics at each request: on large registries where few metrics change between two
+requests, :py:mod:`json` is faster (see :file:`benchmarks/bench_encoding.py`).
+
+The responses larger than a threshold are compressed with ``gzip``, or with ``br`` when
+:py:mod:`brotli` is installed, if the client accepts it in its header ``Accept-Encoding``.
+With a :py:class:`livemetrics.publishers.cache.ResponseCache`, the compressed responses are kept
+in the cache, together with the responses.
+
+An encoder is given to the publisher with its parameter *encoder*:
+
+.. code-block:: python
+
+    encoder = livemetrics.publishers.encoding.Encoder('auto',threshold=4096)
+    app.register_blueprint(livemetrics.publishers.flask.blueprint(LM,encoder=encoder))
+
+.. versionadded:: 0.9
+"""
+
+import gzip
+
+from livemetrics.publishers.cache import cached, conditional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Methods of LiveMetrics reading the metrics of a kind, and reading them in JSON
+_METHODS = dict(
+    meters=('get_metrics','get_metrics_json'),
+    gauges=('get_gauges','get_gauges_json'),
+    histograms=('get_histograms','get_histograms_json'),
+)
+
+#______________________________________________________________________________
+class Encoder(object):
+    """
+    The encoding of the responses of the metrics.
+
+    *json*: the JSON library, one of ``json`` (:py:mod:`json` of the standard library),
+    ``orjson``, ``msgspec``, or ``auto`` for the first one installed of :py:mod:`orjson` and
+    :py:mod:`msgspec`, :py:mod:`json` otherwise. Default is ``json``.
+
+    *threshold*: the minimum size in bytes of a response to compress. None to never compress
+    the responses. Default is 1024.
+
+    *gzip_level*: the level of compression of ``gzip``, from 1 (fast) to 9. Default is 6.
+
+    *brotli_quality*: the quality of compression of ``br``, from 0 (fast) to 11. Default is 4.
+
+    >>> encoder = Encoder(threshold=10)
+    >>> encoder.content_encoding('gzip, deflate',100)
+    'gzip'
+    >>> encoder.content_encoding('gzip;q=0',100), encoder.content_encoding('gzip',5)
+    (None, None)
+    >>> gzip.decompress(encoder.compress(b'{"count": 1}','gzip'))
+    b'{"count": 1}'
+    """
+
+    def __init__(self,json='json',threshold=1024,gzip_level=6,brotli_quality=4):
+        if json=='auto':
+            json = 'orjson' if orjson is not None else 'msgspec' if msgspec is not None else 'json'
+        if json=='orjson':
+            if orjson is None:
+                raise ImportError("orjson is not installed")
+            self._dumps = lambda data: orjson.dumps(data,option=orjson.OPT_NON_STR_KEYS)
+        elif json=='msgspec':
+            if msgspec is None:
+                raise ImportError("msgspec is not installed")
+            self._dumps = msgspec.json.Encoder().encode
+        elif json=='json':
+            self._dumps = None
+        else:
+            raise ValueError("Unknown JSON library " + json)
+        self.json = json
+        self.threshold = threshold
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def dumps(self,LM,kind,*args,**kw):
+        """
+        Return in JSON bytes the metrics of *kind* (``meters``, ``gauges`` or ``histograms``)
+        of *LM*, read with the parameters *args* and *kw* of :py:meth:`livemetrics.LiveMetrics.get_metrics`,
+        :py:meth:`livemetrics.LiveMetrics.get_gauges` or :py:meth:`livemetrics.LiveMetrics.get_histograms`.
+        """
+        get,get_json = _METHODS[kind]
+        if self._dumps is None:
+            return getattr(LM,get_json)(*args,**kw).encode('ascii')
+        return self._dumps(getattr(LM,get)(*args,**kw))
+
+    def content_encoding(self,accept_encoding,size):
+        """
+        Return the encoding of a response of *size* bytes, for a request with the header
+        ``Accept-Encoding`` *accept_encoding* (None if missing): ``br``, ``gzip``, or None
+        if the response is not compressed.
+        """
+        if self.threshold is None or size<self.threshold or not accept_encoding:
+            return None
+        accepted = set()
+        for coding in accept_encoding.split(','):
+            coding,_,params = coding.partition(';')
+            params = params.replace(' ','')
+            if params in ('q=0','q=0.0','q=0.00','q=0.000'):
+                continue
+            accepted.add(coding.strip().lower())
+        if brotli is not None and ('br' in accepted or '*' in accepted):
+            return 'br'
+        if 'gzip' in accepted or '*' in accepted:
+            return 'gzip'
+        return None
+
+    def compress(self,data,encoding):
+        """
+        Return the bytes *data* compressed with *encoding* (``br`` or ``gzip``).
+        """
+        if encoding=='br':
+            return brotli.compress(data,quality=self.brotli_quality)
+        return gzip.compress(data,self.gzip_level,mtime=0)
+
+#: The encoder of the publishers without *encoder*
+ENCODER = Encoder()
+
+def respond(encoder,cache,LM,kind,key,headers,compute,wait=True,names=()):
+    """
+    Return the response of the metrics of *kind* (``meters``, ``gauges`` or ``histograms``) of
+    *LM*, for a request with *headers*, as a tuple of the status (200, or 304 if the client
+    already has the response), the body in bytes, and a dictionary of the headers to add.
+
+    *encoder*: the :py:class:`Encoder`, :py:data:`ENCODER` if None
+
+    *cache*: the :py:class:`livemetrics.publishers.cache.ResponseCache`, or None
+
+    *key*: the key of the response, its path and its query
+
+    *compute*: a callable computing the response with an :py:class:`Encoder`,
+    like ``lambda encoder: encoder.dumps(LM,'meters')``
+
+    *wait*: if False, a response being computed by another thread is not waited for
+    (see :py:meth:`livemetrics.publishers.cache.ResponseCache.get`)
+
+    *names*: the names of the metric read, whose version is the ``ETag``, like
+    ``(event,result)`` for a meter. Empty for a list of metrics.
+
+    See :py:func:`livemetrics.publishers.cache.conditional`.
+    """
+    encoder = encoder or ENCODER
+    # Responses of the same metrics by other libraries may be in the cache
+    key = (key,encoder.json)
+    tag,data = conditional(cache,LM,kind,key,headers.get('If-None-Match'),lambda: compute(encoder),wait,names)
+    if data is None:
+        return 304,b'',{"ETag": tag}
+    encoding = encoder.content_encoding(headers.get('Accept-Encoding'),len(data))
+    if encoding is None:
+        return 200,data,{"ETag": tag, "Vary": "Accept-Encoding"}
+    # The compressed response is kept with the response. As another representation of the
+    # same metrics, its ETag is weak
+    body = cached(cache,(key,tag,encoding),lambda: encoder.compress(data,encoding),wait)
+    return 200,body,{"ETag": 'W/'+tag, "Vary": "Accept-Encoding", "Content-Encoding": encoding}
@@ -24,13 +24,18 @@ A minimal application would be:
 
 """
 
-import json
 
-from flask import Blueprint, make_response, request
+from flask import Blueprint, Response, make_response, request
+
+from livemetrics.publishers.cache import parse_since
+from livemetrics.publishers.encoding import respond
+from livemetrics.publishers.prometheus import CONTENT_TYPE, parse_query, render
 
 class Handler:
-    def __init__(self,LM):
+    def __init__(self,LM,cache=None,encoder=None):
         self.LM = LM
+        self.cache = cache
+        self.encoder = encoder
 
     def about(self):
         data = self.LM.about
@@ -67,73 +72,41 @@ class Handler:
         resp.headers['Access-Control-Allow-Origin'] = '*'
         return resp
 
-    def get_meters3(self,event,result,metric):
-        data = self.LM.get_metrics(event,result,metric)
-        data = json.dumps(data)
-        resp = make_response(data, 200)
-        resp.headers['Content-Length'] = str(len(data))
-        resp.headers['Content-Type'] = 'application/json'
+    def prometheus(self):
+        try:
+            params = parse_query(request.args.to_dict(flat=False))
+        except ValueError as exc:
+            return make_response(str(exc), 400)
+        resp = Response(render(self.LM,params),200,content_type=CONTENT_TYPE)
         resp.headers['Access-Control-Allow-Origin'] = '*'
         return resp
 
+    def get_meters3(self,event,result,metric):
+        return self._respond('meters',(result,metric),(event,result),lambda encoder,since: encoder.dumps(self.LM,'meters',event,result,metric,since=since))
+
     def get_meters2(self,event,result):
-        data = self.LM.get_metrics(event,result)
-        data = json.dumps(data)
-        resp = make_response(data, 200)
-        resp.headers['Content-Length'] = str(len(data))
-        resp.headers['Content-Type'] = 'application/json'
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        return resp
+        return self._respond('meters',(result,),(event,result),lambda encoder,since: encoder.dumps(self.LM,'meters',event,result,since=since))
 
     def get_meters1(self,event):
-        data = self.LM.get_metrics(event)
-        data = json.dumps(data)
-        resp = make_response(data, 200)
-        resp.headers['Content-Length'] = str(len(data))
-        resp.headers['Content-Type'] = 'application/json'
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        return resp
+        return self._respond('meters',(),(event,),lambda encoder,since: encoder.dumps(self.LM,'meters',event,since=since))
 
     def get_meters0(self):
-        data = self.LM.get_metrics()
-        data = json.dumps(data)
-        resp = make_response(data, 200)
-        resp.headers['Content-Length'] = str(len(data))
-        resp.headers['Content-Type'] = 'application/json'
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        return resp
+        return self._respond('meters',(),(),lambda encoder,since: encoder.dumps(self.LM,'meters',since=since))
 
     def get_gauges2(self,object,metric):
-        data = self.LM.get_gauges(object,metric)
-        data = json.dumps(data)
-        resp = make_response(data, 200)
-        resp.headers['Content-Length'] = str(len(data))
-        resp.headers['Content-Type'] = 'application/json'
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        return resp
+        return self._respond('gauges',(object,metric),(object,),lambda encoder,since: encoder.dumps(self.LM,'gauges',object,metric,since=since))
 
     def get_gauges1(self,object):
-        data = self.LM.get_gauges(object)
-        data = json.dumps(data)
-        resp = make_response(data, 200)
-        resp.headers['Content-Length'] = str(len(data))
-        resp.headers['Content-Type'] = 'application/json'
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        return resp
+        return self._respond('gauges',(object,),(object,),lambda encoder,since: encoder.dumps(self.LM,'gauges',object,since=since))
 
     def get_gauges0(self):
-        data = self.LM.get_gauges()
-        data = json.dumps(data)
-        resp = make_response(data, 200)
-        resp.headers['Content-Length'] = str(len(data))
-        resp.headers['Content-Type'] = 'application/json'
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        return resp
+        return self._respond('gauges',(),(),lambda encoder,since: encoder.dumps(self.LM,'gauges',since=since))
 
     def _get_histograms(self,event,metric):
         msg = None
         params = {}
         params.update(request.args)
+        params.pop('since',None)
         if not isinstance(params.setdefault('percentiles',[0.05, 0.25, 0.5, 0.75, 0.95]),list):
             params['percentiles'] = [params['percentiles']]
         if not isinstance(params.setdefault('scale',[10]),list):
@@ -142,7 +115,7 @@ class Handler:
         if len(params)!=2:
             keys = ", ".join(sorted(list(set(params.keys()) - {'percentiles', 'scale'})))
             msg="Invalid query parameters: " + keys
-        if not metric in [None,'count','min','max','mean','stddev','quantiles','distribution']:
+        if not metric in [None,'count','min','max','mean','stddev','quantiles','distribution','window']:
             msg = "Unknown metric " + metric
         if msg:
             return make_response(msg, 400)
@@ -151,15 +124,26 @@ class Handler:
         params['percentiles'] = [float(x) for x in params['percentiles']]
         params['scale'] = int(params['scale'][0])
 
+        return self._respond('histograms',(event,metric),(event,),lambda encoder,since: encoder.dumps(self.LM,'histograms',event,metric,since=since,**params))
+
+    def _respond(self,kind,path,names,compute):
+        # Response of the metrics of kind, or 304 if the client already has it.
+        # The query parameter since is only accepted if the elements of path are None.
+        # The ETag is the version of the metric of names
         try:
-            data = self.LM.get_histograms(event,metric,**params)
+            since = parse_since(request.args.get('since'),*path)
+        except ValueError as exc:
+            return make_response(str(exc), 400)
+        try:
+            status,body,headers = respond(self.encoder,self.cache,self.LM,kind,request.full_path,request.headers,lambda encoder: compute(encoder,since),names=names)
         except Exception as exc:
             msg = str(exc)
             return make_response(msg, 500)
-        data = json.dumps(data)
-        resp = make_response(data, 200)
-        resp.headers['Content-Length'] = str(len(data))
-        resp.headers['Content-Type'] = 'application/json'
+        resp = make_response(body, status)
+        if status==200:
+            resp.headers['Content-Length'] = str(len(body))
+            resp.headers['Content-Type'] = 'application/json'
+        resp.headers.update(headers)
         resp.headers['Access-Control-Allow-Origin'] = '*'
         return resp
 
@@ -172,18 +156,28 @@ class Handler:
     def get_histograms0(self):
         return self._get_histograms(None,None)
 
-def blueprint(LM):
+def blueprint(LM,cache=None,encoder=None):
     """
     Return a blueprint with the routes and view_func for the publication of the metrics.
 
     *LM*: a :py:class:`livemetrics.LiveMetrics` object
+
+    *cache*: an optional :py:class:`livemetrics.publishers.cache.ResponseCache` for the
+    responses of the metrics
+
+    *encoder*: an optional :py:class:`livemetrics.publishers.encoding.Encoder` encoding and
+    compressing the responses of the metrics
+
+    .. versionadded:: 0.9
+        *cache*, *encoder*
     """
-    handler = Handler(LM)
+    handler = Handler(LM,cache,encoder)
     blueprint = Blueprint('livemetrics', __name__)
     blueprint.add_url_rule('/monitoring/v1/about',view_func=handler.about)
     blueprint.add_url_rule('/monitoring/v1/is_healthy',view_func=handler.is_healthy)
     blueprint.add_url_rule('/monitoring/v1/is_ready',view_func=handler.is_ready)
     blueprint.add_url_rule('/monitoring/v1/version',view_func=handler.version)
+    blueprint.add_url_rule('/monitoring/v1/prometheus',view_func=handler.prometheus)
 
     blueprint.add_url_rule('/monitoring/v1/metrics/meters/<event>/<result>/<metric>',view_func=handler.get_meters3)
     blueprint.add_url_rule('/monitoring/v1/metrics/meters/<event>/<result>',view_func=handler.get_meters2)
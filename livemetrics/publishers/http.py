@@ -27,23 +27,49 @@ A minimal application would be:
     httpd = http.server.HTTPServer((host,port), lambda r,a,s: Sample(LM,r,a,s))
     httpd.serve_forever()
 
+A :py:class:`livemetrics.publishers.cache.ResponseCache` shared by the handlers, and a
+:py:class:`livemetrics.publishers.encoding.Encoder`, can be given as last parameters:
+``Sample(LM,r,a,s,cache,encoder)``.
+
+The lists of metrics accept the query parameter ``since``, a version of the metrics, to return
+only the metrics changed after it, with the current version
+(see :py:meth:`livemetrics.LiveMetrics.get_metrics`). A version which is not an integer, or
+``since`` on the path of a single metric, is answered with 400.
+
+The metrics are also exposed in the text format of Prometheus at ``/monitoring/v1/prometheus``
+(see :py:mod:`livemetrics.publishers.prometheus`).
+
 """
 
-import json
 import http.server
 import posixpath
 from urllib.parse import unquote
 from urllib.parse import urlparse,parse_qs
 
+from livemetrics.publishers.cache import parse_since
+from livemetrics.publishers.encoding import respond
+from livemetrics.publishers.prometheus import CONTENT_TYPE, parse_query, render
+
 #______________________________________________________________________________
 class HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
     """
     Subclass this class in your application to inherit the handling of GET requests
     exposing a :py:class:`livemetrics.LiveMetrics` object.
+
+    *cache*: an optional :py:class:`livemetrics.publishers.cache.ResponseCache` for the
+    responses of the metrics, shared by all the handlers.
+
+    *encoder*: an optional :py:class:`livemetrics.publishers.encoding.Encoder` encoding and
+    compressing the responses of the metrics.
+
+    .. versionadded:: 0.9
+        *cache*, *encoder*
     """
 
-    def __init__(self,LM,request,client_address,server):
+    def __init__(self,LM,request,client_address,server,cache=None,encoder=None):
         self.LM = LM
+        self.cache = cache
+        self.encoder = encoder
         return super().__init__(request,client_address,server)
 
     def do_GET(self):
@@ -99,32 +125,39 @@ class HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             self.send_header("Content-Length", str(len(data)))
             self.end_headers()
             self.wfile.write(data.encode('ascii'))
+        elif urlparse(self.path).path=='/monitoring/v1/prometheus':
+            try:
+                params = parse_query(parse_qs(urlparse(self.path).query))
+            except ValueError as exc:
+                msg = str(exc)
+                self.send_response(400)
+                self.send_header("Access-Control-Allow-Origin","*")
+                self.send_header("Content-Length", str(len(msg)))
+                self.end_headers()
+                self.wfile.write(msg.encode('ascii'))
+                return
+            # Without Content-Length, the end of the connection is the end of the response
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-Type",CONTENT_TYPE)
+            self.send_header("Access-Control-Allow-Origin","*")
+            self.end_headers()
+            for chunk in render(self.LM,params):
+                self.wfile.write(chunk)
         elif self.path.startswith('/monitoring/v1/metrics/meters'):
+            pr = urlparse(self.path)
             # Parse path {event}/{result}/{metric}
-            path = posixpath.normpath(unquote(self.path)).split('/')
+            path = posixpath.normpath(unquote(pr.path)).split('/')
             path.extend([None,None,None])
             event,result,metric = path[5:8]
-            self.send_response(200)
-            self.send_header("Content-Type","application/json")
-            self.send_header("Access-Control-Allow-Origin","*")
-            data = self.LM.get_metrics(event,result,metric)
-            data = json.dumps(data)
-            self.send_header("Content-Length", str(len(data)))
-            self.end_headers()
-            self.wfile.write(data.encode('ascii'))
+            self._send_metrics('meters',(result,metric),(event,result),lambda encoder,since: encoder.dumps(self.LM,'meters',event,result,metric,since=since))
         elif self.path.startswith('/monitoring/v1/metrics/gauges'):
+            pr = urlparse(self.path)
             # Parse path {object}/{metric}
-            path = posixpath.normpath(unquote(self.path)).split('/')
+            path = posixpath.normpath(unquote(pr.path)).split('/')
             path.extend([None,None])
             name,metric = path[5:7]
-            self.send_response(200)
-            self.send_header("Content-Type","application/json")
-            self.send_header("Access-Control-Allow-Origin","*")
-            data = self.LM.get_gauges(name,metric)
-            data = json.dumps(data)
-            self.send_header("Content-Length", str(len(data)))
-            self.end_headers()
-            self.wfile.write(data.encode('ascii'))
+            self._send_metrics('gauges',(name,metric),(name,),lambda encoder,since: encoder.dumps(self.LM,'gauges',name,metric,since=since))
         elif self.path.startswith('/monitoring/v1/metrics/histograms'):
             pr = urlparse(self.path)
             # Parse path {event}/{metric}
@@ -133,6 +166,7 @@ class HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             event,metric = path[5:7]
             # analyze query parameters
             params = parse_qs(pr.query)
+            params.pop('since',None)
             if 'percentiles' not in params:
                 # Define default value
                 params['percentiles'] = [0.05, 0.25, 0.5, 0.75, 0.95]
@@ -143,7 +177,7 @@ class HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             if len(params)!=2:
                 keys = ", ".join(sorted(list(set(params.keys()) - {'percentiles', 'scale'})))
                 msg="Invalid query parameters: " + keys
-            if not metric in [None,'count','min','max','mean','stddev','quantiles','distribution']:
+            if not metric in [None,'count','min','max','mean','stddev','quantiles','distribution','window']:
                 msg = "Unknown metric " + metric
             if msg:
                 self.send_response(400)
@@ -155,24 +189,47 @@ class HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             # Make sure the types are correct
             params['percentiles'] = [float(x) for x in params['percentiles']]
             params['scale'] = int(params['scale'][0])
-            try:
-                data = self.LM.get_histograms(event,metric,**params)
-            except Exception as exc:
-                msg = str(exc)
-                self.send_response(500)
-                self.send_header("Access-Control-Allow-Origin","*")
-                self.send_header("Content-Length", str(len(msg)))
-                self.end_headers()
-                self.wfile.write(msg.encode('ascii'))
-                return
-            data = json.dumps(data)
-            self.send_response(200)
-            self.send_header("Content-Type","application/json")
-            self.send_header("Access-Control-Allow-Origin","*")
-            self.send_header("Content-Length", str(len(data)))
-            self.end_headers()
-            self.wfile.write(data.encode('ascii'))
+            self._send_metrics('histograms',(event,metric),(event,),lambda encoder,since: encoder.dumps(self.LM,'histograms',event,metric,since=since,**params))
         else:
             self.send_response(404)
             self.send_header("Access-Control-Allow-Origin","*")
             self.end_headers()
+
+    def _send_metrics(self,kind,path,names,compute):
+        # Send the response of the metrics of kind, or 304 if the client already has it.
+        # The query parameter since is only accepted if the elements of path are None.
+        # The ETag is the version of the metric of names
+        try:
+            since = parse_since(_since(urlparse(self.path)),*path)
+        except ValueError as exc:
+            msg = str(exc)
+            self.send_response(400)
+            self.send_header("Access-Control-Allow-Origin","*")
+            self.send_header("Content-Length", str(len(msg)))
+            self.end_headers()
+            self.wfile.write(msg.encode('ascii'))
+            return
+        try:
+            status,body,headers = respond(self.encoder,self.cache,self.LM,kind,self.path,self.headers,lambda encoder: compute(encoder,since),names=names)
+        except Exception as exc:
+            msg = str(exc)
+            self.send_response(500)
+            self.send_header("Access-Control-Allow-Origin","*")
+            self.send_header("Content-Length", str(len(msg)))
+            self.end_headers()
+            self.wfile.write(msg.encode('ascii'))
+            return
+        self.send_response(status)
+        if status==200:
+            self.send_header("Content-Type","application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin","*")
+        for name,value in headers.items():
+            self.send_header(name,value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def _since(pr):
+    # Query parameter since, None if missing
+    since = parse_qs(pr.query).get('since')
+    return since[0] if since else None
@@ -0,0 +1,71 @@
+"""
+This module provides the exposition of the metrics in the text format of Prometheus, shared
+by all the publishers at the path ``/monitoring/v1/prometheus``
+(see :py:meth:`livemetrics.LiveMetrics.get_prometheus`).
+
+The query parameters are:
+
+- ``percentiles``: the quantiles of the summaries of the histograms, repeated for each quantile
+- ``buckets``: the upper bounds of the buckets, repeated for each bucket, to expose the
+  histograms as Prometheus histograms instead of summaries
+
+The response is sent in chunks while the lines are rendered, without ``Content-Length``.
+It is not kept by the :py:class:`livemetrics.publishers.cache.ResponseCache` of the publisher.
+
+A scrape configuration of Prometheus would be:
+
+.. code-block:: yaml
+
+    scrape_configs:
+      - job_name: application
+        metrics_path: /monitoring/v1/prometheus
+        static_configs:
+          - targets: ['host:port']
+
+.. versionadded:: 0.9
+"""
+
+#: The content type of the text format of Prometheus
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: The minimum size in bytes of the chunks of the responses
+CHUNK_SIZE = 65536
+
+def parse_query(query):
+    """
+    Return the parameters of :py:meth:`livemetrics.LiveMetrics.get_prometheus` from *query*,
+    a dictionary of the lists of values of the query parameters. Raise a :py:class:`ValueError`
+    with the message of the response 400 if a parameter is unknown or invalid.
+
+    >>> parse_query({'buckets':['0.1','1']})
+    {'buckets': [0.1, 1.0]}
+    >>> parse_query({'percentiles':['0.5'],'scale':['10']})
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid query parameters: scale
+    """
+    unknown = sorted(set(query.keys()) - {'percentiles','buckets'})
+    if unknown:
+        raise ValueError("Invalid query parameters: " + ", ".join(unknown))
+    params = { k:[float(x) for x in v] for k,v in query.items() }
+    for percentile in params.get('percentiles',[]):
+        if not 0.0<=percentile<=1.0:
+            raise ValueError("Invalid percentile %s" % percentile)
+    return params
+
+def render(LM,params):
+    """
+    Return an iterator on the response of the metrics of *LM* with *params*, in chunks of
+    bytes of about :py:data:`CHUNK_SIZE` bytes, rendered as the chunks are sent.
+    """
+    lines = []
+    size = 0
+    for line in LM.get_prometheus(**params):
+        lines.append(line)
+        size += len(line)
+        if size>=CHUNK_SIZE:
+            yield ''.join(lines).encode('utf-8')
+            lines = []
+            size = 0
+    if lines:
+        yield ''.join(lines).encode('utf-8')
@@ -4,6 +4,8 @@ import time
 import unittest
 import requests
 
+import livemetrics.publishers.encoding
+
 IP = '127.0.0.1'
 PORT = '8765'
 
@@ -89,6 +91,112 @@ class TestPublisher(unittest.TestCase):
         with requests.get('http://'+IP+':'+PORT+'/bad/path/v1/metrics/histograms/histo/bad_metric') as r:
             self.assertEqual(404,r.status_code)
 
+        # Responses kept by the cache
+        url = 'http://'+IP+':'+PORT+'/monitoring/v1/metrics/meters/test/ok/count'
+        self.cache.ttl = 60
+        try:
+            with requests.get(url) as r:
+                count = r.json()
+            requests.get('http://'+IP+':'+PORT+'/test')
+            with requests.get(url) as r:
+                self.assertEqual(count,r.json())
+            # Another path is another response
+            with requests.get(url[:-len('/count')]) as r:
+                self.assertEqual(count+1,r.json()['count'])
+        finally:
+            self.cache.ttl = 0
+            self.cache.clear()
+        with requests.get(url) as r:
+            self.assertEqual(count+1,r.json())
+
+        # Only the metrics changed since a version
+        url = 'http://'+IP+':'+PORT+'/monitoring/v1/metrics/meters'
+        with requests.get(url+'?since=0') as r:
+            version = r.json()['version']
+            self.assertEqual(count+1,r.json()['metrics']['test']['ok']['count'])
+        with requests.get(url+'?since=%d' % version) as r:
+            self.assertEqual({'version':version,'metrics':{}},r.json())
+        with requests.get('http://'+IP+':'+PORT+'/monitoring/v1/metrics/histograms?since=0') as r:
+            histograms_version = r.json()['version']
+        with requests.get('http://'+IP+':'+PORT+'/monitoring/v1/metrics/histograms?since=%d' % histograms_version) as r:
+            self.assertEqual({},r.json()['metrics'])
+        requests.get('http://'+IP+':'+PORT+'/test')
+        with requests.get(url+'?since=%d' % version) as r:
+            self.assertLess(version,r.json()['version'])
+            self.assertEqual(count+2,r.json()['metrics']['test']['ok']['count'])
+        with requests.get('http://'+IP+':'+PORT+'/monitoring/v1/metrics/histograms?since=%d' % histograms_version) as r:
+            self.assertEqual(count+2,r.json()['metrics']['histo']['count'])
+        with requests.get(url+'/test/ok?since=0') as r:
+            self.assertEqual(400,r.status_code)
+        with requests.get('http://'+IP+':'+PORT+'/monitoring/v1/metrics/gauges/fixed?since=0') as r:
+            self.assertEqual(400,r.status_code)
+        with requests.get(url+'?since=abc') as r:
+            self.assertEqual(400,r.status_code)
+            self.assertEqual(b"Invalid version since=abc",r.content)
+        with requests.get(url+'/test?since=%d' % version) as r:
+            self.assertEqual(200,r.status_code)
+
+        # Not modified
+        with requests.get(url+'/test/ok') as r:
+            etag = r.headers['ETag']
+        with requests.get(url+'/test/ok',headers={'If-None-Match':etag}) as r:
+            self.assertEqual(304,r.status_code)
+            self.assertEqual(etag,r.headers['ETag'])
+        fixed = 'http://'+IP+':'+PORT+'/monitoring/v1/metrics/gauges/fixed'
+        with requests.get(fixed) as r:
+            fixed_etag = r.headers['ETag']
+        with requests.get(url) as r:
+            list_etag = r.headers['ETag']
+        requests.get('http://'+IP+':'+PORT+'/test')
+        with requests.get(url+'/test/ok',headers={'If-None-Match':etag}) as r:
+            self.assertEqual(200,r.status_code)
+            self.assertEqual(count+3,r.json()['count'])
+        with requests.get(url,headers={'If-None-Match':list_etag}) as r:
+            self.assertEqual(200,r.status_code)
+        # The ETag of a single metric is its own version, not changed by the other metrics
+        with requests.get(fixed,headers={'If-None-Match':fixed_etag}) as r:
+            self.assertEqual(304,r.status_code)
+
+        # Compressed responses
+        encoder = livemetrics.publishers.encoding.ENCODER
+        encoder.threshold = 0
+        try:
+            with requests.get(url+'/test/ok',headers={'Accept-Encoding':'gzip'}) as r:
+                self.assertEqual('gzip',r.headers['Content-Encoding'])
+                self.assertEqual('Accept-Encoding',r.headers['Vary'])
+                self.assertEqual(count+3,r.json()['count'])
+                etag = r.headers['ETag']
+                self.assertTrue(etag.startswith('W/"'))
+            with requests.get(url+'/test/ok',headers={'Accept-Encoding':'gzip','If-None-Match':etag}) as r:
+                self.assertEqual(304,r.status_code)
+            with requests.get(url+'/test/ok',headers={'Accept-Encoding':'identity'}) as r:
+                self.assertNotIn('Content-Encoding',r.headers)
+                self.assertEqual(count+3,r.json()['count'])
+        finally:
+            encoder.threshold = 1024
+
+        # Text format of Prometheus
+        url = 'http://'+IP+':'+PORT+'/monitoring/v1/prometheus'
+        with requests.get(url) as r:
+            self.assertEqual(200,r.status_code)
+            self.assertTrue(r.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+            lines = r.text.splitlines()
+            self.assertIn('livemetrics_meter_total{event="test",result="ok"} %d' % (count+3),lines)
+            self.assertIn('livemetrics_gauge{name="fixed"} 10',lines)
+            self.assertIn('# TYPE livemetrics_histogram summary',lines)
+            self.assertIn('livemetrics_histogram_count{event="histo"} %d' % (count+3),lines)
+        with requests.get(url+'?buckets=10&buckets=20') as r:
+            lines = r.text.splitlines()
+            self.assertIn('# TYPE livemetrics_histogram histogram',lines)
+            self.assertIn('livemetrics_histogram_bucket{event="histo",le="+Inf"} %d' % (count+3),lines)
+        with requests.get(url+'?scale=10') as r:
+            self.assertEqual(400,r.status_code)
+            self.assertEqual(b"Invalid query parameters: scale",r.content)
+        with requests.get(url+'_other') as r:
+            self.assertEqual(404,r.status_code)
+        with requests.get(url+'/other') as r:
+            self.assertEqual(404,r.status_code)
+
         # Test with a bad status
         backup_ih = self.LM.is_healthy
         self.LM.is_healthy = lambda: False
@@ -117,6 +225,8 @@ class TestPublisher(unittest.TestCase):
             self.assertGreater(r.json(),2)
             self.assertLess(r.json(),15)
 
+        # The cpu may have been read by the previous requests: the first read computes it
+        time.sleep(0.5)
         with requests.get('http://'+IP+':'+PORT+'/monitoring/v1/metrics/gauges/cpu/count') as r:
             cpu = r.json()
         with requests.get('http://'+IP+':'+PORT+'/monitoring/v1/metrics/gauges/cpu/count') as r:
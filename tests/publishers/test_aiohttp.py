@@ -13,13 +13,18 @@ routes = web.RouteTableDef()
 
 import livemetrics
 import livemetrics.publishers.aiohttp
+import livemetrics.publishers.cache
 
 import tests.publishers
 
 async def is_healthy():
     return True
 
-LM = livemetrics.LiveMetrics('{"version":"1.0"}',"Test server",is_healthy, True)
+TICKER = livemetrics.metrics.Ticker()
+LM = livemetrics.LiveMetrics('{"version":"1.0"}',"Test server",is_healthy, True, ticker=TICKER)
+
+# Responses not kept by default, see TestPublisher
+CACHE = livemetrics.publishers.cache.ResponseCache(ttl=0)
 
 # Sample of gauges
 LM.gauge('fixed',10)
@@ -56,8 +61,9 @@ async def get(request):
 
 async def runner():
     app = web.Application()
-    app.add_routes(livemetrics.publishers.aiohttp.routes(LM))
+    app.add_routes(livemetrics.publishers.aiohttp.routes(LM,cache=CACHE))
     app.add_routes(routes)
+    app.cleanup_ctx.append(livemetrics.publishers.aiohttp.ticker_context(TICKER))
     runner = web.AppRunner(app)
     await runner.setup()
 
@@ -86,6 +92,7 @@ class TestAioHttp(tests.publishers.TestPublisher):
         self.t.start()
         time.sleep(1.0)
         self.LM = LM
+        self.cache = CACHE
 
     def tearDown(self):
         # Clean up to release the socket address for the other tests
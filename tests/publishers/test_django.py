@@ -1,6 +1,7 @@
 
 import threading
 import unittest
+import importlib
 import random
 import time
 
@@ -11,10 +12,14 @@ from django.core.management import call_command
 
 import livemetrics
 import livemetrics.publishers.django
+import livemetrics.publishers.cache
 
 import tests.publishers
 
 LM = livemetrics.LiveMetrics('{"version":"1.0"}',"Test server",True, True)
+
+# Responses not kept by default, see TestPublisher
+CACHE = livemetrics.publishers.cache.ResponseCache(ttl=0)
 # Sample of gauges
 LM.gauge('fixed',10)
 LM.gauge('test',10)
@@ -64,7 +69,7 @@ urlpatterns = [
     path('switch', switchview, name='switch'),
 ]
 
-urlpatterns += livemetrics.publishers.django.urlpatterns(LM)
+urlpatterns += livemetrics.publishers.django.urlpatterns(LM,cache=CACHE)
 
 def _serve():
     from django.conf import settings
@@ -106,6 +111,8 @@ class TestDjango(tests.publishers.TestPublisher):
         self.t.start()
         time.sleep(1.0)
         self.LM = LM
+        # The urls are loaded by django from their own instance of this module
+        self.cache = importlib.import_module('tests.publishers.test_django').CACHE
 
 # ______________________________________________________________________________
 if __name__=='__main__':
@@ -8,6 +8,7 @@ import requests
 
 import livemetrics
 import livemetrics.publishers.flask
+import livemetrics.publishers.cache
 
 from flask import Flask
 from flask import request
@@ -18,6 +19,9 @@ import tests.publishers
 
 LM = livemetrics.LiveMetrics('{"version":"1.0"}',"Test server",True, True)
 
+# Responses not kept by default, see TestPublisher
+CACHE = livemetrics.publishers.cache.ResponseCache(ttl=0)
+
 # Sample of gauges
 LM.gauge('fixed',10)
 LM.gauge('test',10)
@@ -66,7 +70,7 @@ def _serve():
     global LM
     tests.publishers.PORT = '8767'
     global app
-    app.register_blueprint(livemetrics.publishers.flask.blueprint(LM))
+    app.register_blueprint(livemetrics.publishers.flask.blueprint(LM,cache=CACHE))
     app.run(host=tests.publishers.IP, port=int(tests.publishers.PORT))
 
 #_______________________________________________________________________________
@@ -77,6 +81,7 @@ class TestFlask(tests.publishers.TestPublisher):
         self.t.start()
         time.sleep(1.0)
         self.LM = LM
+        self.cache = CACHE
 
     def tearDown(self):
         # Clean up to release the socket address for the other tests
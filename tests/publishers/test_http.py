@@ -9,11 +9,15 @@ import http.server
 
 import livemetrics
 import livemetrics.publishers.http
+import livemetrics.publishers.cache
 
 import tests.publishers
 
 LM = livemetrics.LiveMetrics('{"version":"1.0"}',"Test server",True, True)
 
+# Responses not kept by default, see TestPublisher
+CACHE = livemetrics.publishers.cache.ResponseCache(ttl=0)
+
 # Sample of gauges
 LM.gauge('fixed',10)
 LM.gauge('test',10)
@@ -69,7 +73,7 @@ def _serve():
     global LM
     tests.publishers.PORT = '8765'
     server_address = (tests.publishers.IP, int(tests.publishers.PORT))
-    httpd = http.server.HTTPServer(server_address, lambda r,a,s: TestHTTPRequestHandler(LM,r,a,s))
+    httpd = http.server.HTTPServer(server_address, lambda r,a,s: TestHTTPRequestHandler(LM,r,a,s,CACHE))
     global HTTPD
     HTTPD = httpd
     httpd.allow_reuse_address = True
@@ -83,6 +87,7 @@ class TestHttp(tests.publishers.TestPublisher):
         t.start()
         time.sleep(1.0)
         self.LM = LM
+        self.cache = CACHE
 
     def tearDown(self):
         # Clean up to release the socket address for the other tests
@@ -2,10 +2,18 @@
 import unittest
 import doctest
 import livemetrics.metrics
+import livemetrics.multiprocess
+import livemetrics.publishers.cache
+import livemetrics.publishers.encoding
+import livemetrics.publishers.prometheus
 
 # Used by: python setup.py test
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(livemetrics.metrics))
+    tests.addTests(doctest.DocTestSuite(livemetrics.multiprocess))
+    tests.addTests(doctest.DocTestSuite(livemetrics.publishers.cache))
+    tests.addTests(doctest.DocTestSuite(livemetrics.publishers.encoding))
+    tests.addTests(doctest.DocTestSuite(livemetrics.publishers.prometheus))
     return tests
 
 load_tests.__test__ = False
@@ -13,3 +21,7 @@ load_tests.__test__ = False
 # ______________________________________________________________________________
 if __name__=='__main__':
     doctest.testmod(livemetrics.metrics)
+    doctest.testmod(livemetrics.multiprocess)
+    doctest.testmod(livemetrics.publishers.cache)
+    doctest.testmod(livemetrics.publishers.encoding)
+    doctest.testmod(livemetrics.publishers.prometheus)
@@ -4,7 +4,21 @@ import requests
 import json
 import math
 import statistics
+import random
+import threading
+import tracemalloc
+import os
+import tempfile
+import multiprocessing
+import gzip
+import re
+import array
+import weakref
 
+import livemetrics
+import livemetrics.multiprocess
+import livemetrics.publishers.cache
+import livemetrics.publishers.encoding
 from livemetrics.metrics import *
 
 #_______________________________________________________________________________
@@ -57,6 +71,1066 @@ class TestMetrics(unittest.TestCase):
         self.assertEqualFloat(35.93,his.snapshot.stddev)
         self.assertEqualQuantile(61.5,round(his.snapshot.get_value(0.5),1))
 
+    def test_striped_meter(self):
+        backup = Meter.TICK_INTERVAL
+        Meter.TICK_INTERVAL = 0.1
+        try:
+            mtr = Meter()
+            striped = StripedMeter()
+            def run():
+                for i in range(1000):
+                    mtr.mark()
+                    striped.mark()
+            threads = [threading.Thread(target=run) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            time.sleep(0.15)
+            self.assertEqual(8000,mtr.count)
+            self.assertEqual(8000,striped.count)
+            self.assertEqualFloat(mtr.rate1,striped.rate1)
+            self.assertEqualFloat(mtr.rate15,striped.rate15)
+        finally:
+            Meter.TICK_INTERVAL = backup
+
+    def test_striped_meter_threads(self):
+        # The cells of the threads which ended are folded into the first cell
+        striped = StripedMeter()
+        def run():
+            for i in range(10):
+                striped.mark()
+        for n in range(50):
+            threads = [threading.Thread(target=run) for i in range(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertLessEqual(len(striped._cells),11)
+        self.assertEqual(5000,striped.count)
+        self.assertEqual(1,len(striped._cells))
+        # A meter deleted before its threads end
+        striped = StripedMeter()
+        marked = threading.Event()
+        event = threading.Event()
+        def wait():
+            striped.mark()
+            marked.set()
+            event.wait()
+        t = threading.Thread(target=wait)
+        t.start()
+        marked.wait()
+        ref = weakref.ref(striped)
+        del striped
+        self.assertIsNone(ref())
+        event.set()
+        t.join()
+
+    def test_bulk_mark(self):
+        # mark(n) gives the same count and rates as n calls to mark()
+        for factory in [Meter,StripedMeter,lambda clock: MeterTable(clock).meter('event','ok')]:
+            clock = ManualClock()
+            bulk = factory(clock)
+            single = factory(clock)
+            for n in [1,10,1000,5]:
+                bulk.mark(n)
+                for i in range(n):
+                    single.mark()
+                self.assertEqual(single.count,bulk.count)
+                clock.advance(Meter.TICK_INTERVAL*1.5)
+                self.assertEqual(single.rates,bulk.rates)
+                self.assertLess(0.0,bulk.rate1)
+
+        # The moving averages only count the events until the next tick
+        e = EWMA(1)
+        state = {name:getattr(e,name) for name in EWMA.__slots__ if name!='uncounted'}
+        for i in range(10000):
+            e.update()
+        e.update(10000)
+        self.assertFalse(hasattr(e,'__dict__'))
+        self.assertEqual(20000,e.uncounted)
+        self.assertEqual(state,{name:getattr(e,name) for name in EWMA.__slots__ if name!='uncounted'})
+
+    def test_idle_catch_up(self):
+        # Ticking k times at once gives the same rate as k individual ticks
+        e1 = EWMA(1)
+        e2 = EWMA(1)
+        e1.update(500)
+        e2.update(500)
+        e1._tick(1000)
+        e2._tick()
+        for i in range(999):
+            e2._tick()
+        self.assertEqualFloat(e2.rate,e1.rate)
+
+        # A meter idle for a day catches up in one step
+        clock = ManualClock()
+        mtr = Meter(clock)
+        mtr.mark(1000)
+        clock.advance(24*60*60)
+        S = time.perf_counter()
+        rate = mtr.rate1
+        self.assertLess(time.perf_counter()-S,0.01)
+        self.assertLess(rate,1e-10)
+        self.assertLessEqual(clock.now()-mtr.last_tick,Meter.TICK_INTERVAL*1e9)
+
+        # A reservoir idle for days drops all its samples in one step
+        his = Histogram(clock)
+        for i in range(100):
+            his.update(i)
+        clock.advance(3*24*60*60)
+        self.assertEqual(0,his.snapshot.size)
+        self.assertEqual(100,his.count)
+
+    def test_clock(self):
+        # Rates and decay only depend on the clock of the metrics
+        clock = ManualClock()
+        mtr = Meter(clock)
+        clock.advance(0.001)
+        for i in range(10):
+            mtr.mark(int(10*Meter.TICK_INTERVAL))
+            clock.advance(Meter.TICK_INTERVAL)
+        self.assertEqualFloat(10.0,mtr.rate1)
+        self.assertEqualFloat(10.0,mtr.mean)
+
+        # The missing metrics read use the clock of the registry
+        class CountingClock(ManualClock):
+            calls = 0
+            def now(self):
+                self.calls += 1
+                return super().now()
+        clock = CountingClock()
+        lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False,clock=clock)
+        lm.get_metrics('missing','ok')
+        self.assertLess(0,clock.calls)
+        calls = clock.calls
+        lm.get_histograms('missing')
+        self.assertLess(calls,clock.calls)
+
+    def test_ticker(self):
+        clock = ManualClock()
+        ticker = Ticker()
+        lm1 = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False,clock=clock,ticker=ticker)
+        lm2 = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False,clock=clock,ticker=ticker,striped=True)
+        for lm in (lm1,lm2):
+            lm.mark('event','ok',int(10*Meter.TICK_INTERVAL))
+            lm.histogram('histo',1.0)
+        clock.advance(Meter.TICK_INTERVAL*1.5)
+        # Recording does not tick the metrics anymore
+        for lm in (lm1,lm2):
+            lm.mark('event','ok')
+            self.assertEqual(0.0,lm._meters['event']['ok'].ewma1.rate)
+        ticker.tick()
+        for lm in (lm1,lm2):
+            self.assertEqualFloat(10.0+1/Meter.TICK_INTERVAL,lm._meters['event']['ok'].ewma1.rate)
+            self.assertEqual(int(10*Meter.TICK_INTERVAL)+1,lm.get_metrics('event','ok','count'))
+
+        # Background thread
+        ticker.interval = 0.01
+        rate = lm1._meters['event']['ok'].ewma1.rate
+        with ticker:
+            self.assertTrue(ticker.running)
+            clock.advance(Meter.TICK_INTERVAL)
+            time.sleep(0.1)
+            self.assertLess(lm1._meters['event']['ok'].ewma1.rate,rate)
+        self.assertFalse(ticker.running)
+
+        # The histograms are rescaled by the ticker
+        clock.advance(3*24*60*60)
+        self.assertEqual(1,lm1._histograms['histo']._reservoir.count)
+        ticker.tick()
+        self.assertEqual(0,lm1._histograms['histo']._reservoir.count)
+    def test_handles_allocations(self):
+        clock = ManualClock()
+        lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False,clock=clock)
+        meter = lm.meter('event','ok')
+        his = lm.histogram_handle('histo')
+        gauge = lm.gauge_handle('gauge')
+        self.assertIs(meter,lm.meter('event','ok'))
+        self.assertIs(his,lm.histogram_handle('histo'))
+        self.assertIs(gauge,lm.gauge_handle('gauge'))
+        # Fill the reservoir: from now on, values replace older ones
+        for i in range(2000):
+            meter.mark()
+            his.update(1.5)
+            gauge.mark(i)
+
+        # Only count the blocks allocated from this test (other tests may run servers in threads)
+        filters = [tracemalloc.Filter(True,__file__,all_frames=True),
+                   tracemalloc.Filter(False,tracemalloc.__file__,all_frames=True),
+                   tracemalloc.Filter(False,'<frozen *>',all_frames=True)]
+        def record(n):
+            for i in range(n):
+                meter.mark()
+                his.update(1.5)
+                gauge.mark(i%100)
+        tracemalloc.start(10)
+        try:
+            # The first events and snapshots traced allocate the blocks of the current counts
+            # and versions, replaced by the next ones, and fill the free lists of the interpreter
+            record(1000)
+            tracemalloc.take_snapshot()
+            # The interpreter may keep a block once, a block kept for each event is in all
+            # the measures
+            blocks = []
+            for i in range(3):
+                before = tracemalloc.take_snapshot().filter_traces(filters)
+                record(10000)
+                after = tracemalloc.take_snapshot().filter_traces(filters)
+                blocks.append(sum(stat.count_diff for stat in after.compare_to(before,'filename')))
+        finally:
+            tracemalloc.stop()
+        # No new block is kept for the recorded events
+        self.assertEqual(0,min(blocks))
+        self.assertEqual(33000,meter.count)
+        self.assertEqual(33000,his.count)
+    def test_snapshot_cache(self):
+        clock = ManualClock()
+        his = Histogram(clock)
+        for i in range(100):
+            his.update(i)
+        snapshot = his.snapshot
+        self.assertIs(snapshot,his.snapshot)
+        his.update(100)
+        self.assertIsNot(snapshot,his.snapshot)
+        self.assertEqual(101,his.snapshot.size)
+
+        # A rescale invalidates the snapshot
+        snapshot = his.snapshot
+        clock.advance(Reservoir.TICK_INTERVAL*1.5)
+        self.assertIsNot(snapshot,his.snapshot)
+
+        # Within the staleness bound, the snapshot is kept even if values are recorded
+        backup = Histogram.SNAPSHOT_MAX_AGE
+        Histogram.SNAPSHOT_MAX_AGE = 1.0
+        try:
+            snapshot = his.snapshot
+            his.update(1000)
+            self.assertIs(snapshot,his.snapshot)
+            clock.advance(1.0)
+            self.assertIsNot(snapshot,his.snapshot)
+            self.assertEqual(1000,his.snapshot.max)
+        finally:
+            Histogram.SNAPSHOT_MAX_AGE = backup
+    def test_snapshot_statistics(self):
+        values = [random.gauss(100,20) for i in range(1000)]
+        weights = [random.random() for i in range(1000)]
+        percentiles = [0.99,0.05,0.5,0.0,1.0,0.25,0.999]
+        backup = WeightedSnapshot.NUMPY_THRESHOLD
+        try:
+            # Pure Python, and NumPy if installed
+            WeightedSnapshot.NUMPY_THRESHOLD = len(values)+1
+            snapshot = WeightedSnapshot(values,weights)
+            WeightedSnapshot.NUMPY_THRESHOLD = 1
+            other = WeightedSnapshot(values,weights)
+        finally:
+            WeightedSnapshot.NUMPY_THRESHOLD = backup
+
+        total = sum(weights)
+        mean = sum(v*w/total for v,w in zip(values,weights))
+        stddev = math.sqrt(sum(w/total*(v-mean)**2 for v,w in zip(values,weights)))
+        for s in (snapshot,other):
+            self.assertEqualFloat(mean,s.mean)
+            self.assertEqualFloat(stddev,s.stddev)
+            self.assertEqual(min(values),s.min)
+            self.assertEqual(max(values),s.max)
+            self.assertEqual([s.get_value(p) for p in percentiles],s.get_values(percentiles))
+        self.assertEqual(snapshot.get_values(percentiles),other.get_values(percentiles))
+        self.assertEqual(snapshot.get_distribution(20),other.get_distribution(20))
+
+    def test_sketch_histogram(self):
+        values = [random.lognormvariate(0,2) for i in range(20000)]
+        his = SketchHistogram(relative_accuracy=0.01)
+        first = SketchHistogram(relative_accuracy=0.01)
+        second = SketchHistogram(relative_accuracy=0.01)
+        for i,v in enumerate(values):
+            his.update(v)
+            (first if i%2 else second).update(v)
+        first.merge(second)
+        values.sort()
+        for his in (his,first):
+            snapshot = his.snapshot
+            self.assertEqual(len(values),snapshot.size)
+            self.assertEqual(values[0],snapshot.min)
+            self.assertEqual(values[-1],snapshot.max)
+            self.assertEqualFloat(statistics.mean(values),snapshot.mean)
+            self.assertEqualFloat(statistics.pstdev(values),snapshot.stddev)
+            for q in [0.0,0.05,0.5,0.95,0.99,0.999,1.0]:
+                exact = values[int(q*(len(values)-1))]
+                self.assertLessEqual(abs(snapshot.get_value(q)-exact),exact*0.01)
+            self.assertEqual(len(values),sum(snapshot.get_distribution(20)))
+        self.assertEqual(his.snapshot.get_values([0.5,0.99]),first.snapshot.get_values([0.5,0.99]))
+        self.assertRaises(ValueError,his.merge,SketchHistogram(relative_accuracy=0.02))
+
+        # Bounded memory
+        his = SketchHistogram(max_buckets=100)
+        for i in range(-1000,100000,7):
+            his.update(i*1.1)
+        self.assertLessEqual(len(his._positives.counts),100)
+        self.assertLessEqual(len(his._negatives.counts),100)
+        self.assertEqualFloat(99999*1.1,his.snapshot.get_value(1.0))
+
+        lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False)
+        @lm.timer('sketch','ok','error',factory=SketchHistogram)
+        def f():
+            pass
+        for i in range(10):
+            f()
+        self.assertIsInstance(lm.histogram_handle('sketch'),SketchHistogram)
+        data = lm.get_histograms('sketch')
+        self.assertEqual(10,data['count'])
+        self.assertEqual(['count','distribution','max','mean','min','quantiles','stddev'],sorted(data))
+
+    def test_hdr_histogram(self):
+        values = [random.lognormvariate(-5,1.5) for i in range(20000)]
+        his = HdrHistogram(significant_digits=2)
+        first = HdrHistogram(significant_digits=2)
+        second = HdrHistogram(significant_digits=2)
+        for i,v in enumerate(values):
+            his.update(v)
+            (first if i%2 else second).update(v)
+        first.merge(second)
+        self.assertEqual(list(his.counts),list(first.counts))
+        values.sort()
+        snapshot = his.snapshot
+        self.assertEqual(len(values),snapshot.size)
+        self.assertEqual(values[0],snapshot.min)
+        self.assertEqual(values[-1],snapshot.max)
+        self.assertEqualFloat(statistics.mean(values),snapshot.mean)
+        self.assertEqualFloat(statistics.pstdev(values),snapshot.stddev)
+        for q in [0.0,0.05,0.5,0.95,0.99,0.999,1.0]:
+            exact = values[int(q*(len(values)-1))]
+            self.assertLessEqual(abs(snapshot.get_value(q)-exact),exact*0.01+his.lowest)
+        self.assertEqual(len(values),sum(snapshot.get_distribution(20)))
+        self.assertEqual(len(values),snapshot.cumulative[-1])
+        self.assertRaises(ValueError,his.merge,HdrHistogram(significant_digits=3))
+
+        # Values out of range are clamped
+        his = HdrHistogram(lowest=1,highest=1000,significant_digits=3)
+        size = len(his.counts)
+        for v in [-5,0,1,999,1000,10**6]:
+            his.update(v)
+        self.assertEqual(size,len(his.counts))
+        self.assertEqual(6,his.snapshot.size)
+        self.assertEqual(10**6,his.snapshot.max)
+        # 1000 and 10**6 are in the last bucket
+        self.assertEqual(2,his.snapshot.counts[-1])
+        self.assertEqual(2,his.snapshot.counts[0])
+
+        lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False)
+        @lm.timer('hdr','ok','error',factory=HdrHistogram)
+        def f():
+            pass
+        for i in range(10):
+            f()
+        self.assertIsInstance(lm.histogram_handle('hdr'),HdrHistogram)
+        self.assertEqual(10,lm.get_histograms('hdr','count'))
+
+    def test_histogram_interface(self):
+        # All the histograms implement the interface they share, and set its attributes
+        clock = ManualClock()
+        self.assertEqual({'update','snapshot'},set(BaseHistogram.__abstractmethods__))
+        for factory in [Histogram,SketchHistogram,HdrHistogram]:
+            self.assertEqual(frozenset(),factory.__abstractmethods__)
+            his = factory(clock)
+            self.assertIsInstance(his,BaseHistogram)
+            for slot in BaseHistogram.__slots__:
+                if slot!='__weakref__':
+                    getattr(his,slot)
+            for i in range(10):
+                his.update(i+1)
+            his.tick()
+            self.assertEqual(10,his.count)
+            self.assertEqual(10,his.to_dict()['max'])
+            self.assertIsInstance(his.last_tick,int)
+            self.assertIsInstance(his.snapshot.get_values([0.5]),list)
+
+    def test_sliding_window(self):
+        clock = ManualClock(10**12)
+        lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock,window=60)
+        for second in range(120):
+            lm.mark('event','ok',second)
+            lm.histogram('latency',second)
+            clock.advance(1)
+        # The window covers 55 to 60 seconds with buckets of 5 seconds: the current bucket
+        # has just started, so the window holds the values of the last 55 seconds
+        data = lm.get_metrics('event','ok')
+        self.assertEqual(sum(range(120)),data['count'])
+        self.assertEqual(sum(range(65,120)),data['window_count'])
+        self.assertEqual(sum(range(65,120))/60,lm.get_metrics('event','ok','window_rate'))
+
+        window = lm.get_histograms('latency','window')
+        self.assertEqual(window,lm.get_histograms('latency')['window'])
+        self.assertEqual(55,window['count'])
+        self.assertEqual((65,119),(window['min'],window['max']))
+        self.assertEqualFloat(statistics.mean(range(65,120)),window['mean'])
+        self.assertLessEqual(abs(window['quantiles'][0.5]-92),1)
+        self.assertEqual(120,lm.get_histograms('latency','count'))
+
+        clock.advance(30)
+        self.assertEqual(sum(range(95,120)),lm.get_metrics('event','ok','window_count'))
+        self.assertEqual(25,lm.get_histograms('latency','window')['count'])
+        clock.advance(60)
+        self.assertEqual(0,lm.get_metrics('event','ok','window_count'))
+        self.assertEqual(0,lm.get_histograms('latency','window')['count'])
+
+        # Without window
+        lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False)
+        lm.mark('event','ok')
+        lm.histogram('latency',1)
+        self.assertNotIn('window_count',lm.get_metrics('event','ok'))
+        self.assertNotIn('window',lm.get_histograms('latency'))
+        self.assertIsNone(lm.get_histograms('latency','window'))
+
+    def test_meter_table(self):
+        backup = MeterTable.NUMPY_THRESHOLD
+        try:
+            for threshold in (10**9,1):
+                MeterTable.NUMPY_THRESHOLD = threshold
+                clock = ManualClock(10**12)
+                lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock)
+                table = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock,columnar=True)
+                # The meters of a table tick together: create them at the same time
+                for i in range(6):
+                    for m in (lm,table):
+                        m.meter('event%d' % (i%3),'ok' if i%2 else 'error')
+                for second in range(200):
+                    for i in range(second%7):
+                        for m in (lm,table):
+                            m.mark('event%d' % (i%3),'ok' if i%2 else 'error',i)
+                    if second==100:
+                        # Idle period
+                        clock.advance(300)
+                    clock.advance(1)
+                expected = lm.get_metrics()
+                data = table.get_metrics()
+                self.assertEqual(sorted(expected),sorted(data))
+                for event in expected:
+                    self.assertEqual(sorted(expected[event]),sorted(data[event]))
+                    self.assertEqual(expected[event],table.get_metrics(event))
+                    for result in expected[event]:
+                        for metric,value in expected[event][result].items():
+                            self.assertAlmostEqual(value,data[event][result][metric])
+                        self.assertEqual(expected[event][result]['rate5'],table.get_metrics(event,result,'rate5'))
+                self.assertIs(table.meter('event1','ok'),table.meter('event1','ok'))
+        finally:
+            MeterTable.NUMPY_THRESHOLD = backup
+
+    def test_compact_metrics(self):
+        metrics = [Gauge(1),EWMA(),Meter(),StripedMeter(),WeightedSample(1,1),Reservoir(),
+                   Histogram(),SketchHistogram(),HdrHistogram(),MeterWindow(),HistogramWindow()]
+        for metric in metrics:
+            self.assertFalse(hasattr(metric,'__dict__'),type(metric).__name__)
+        # The histograms of a window are merged
+        HistogramWindow(factory=HdrHistogram)
+        HistogramWindow(factory=lambda clock: SketchHistogram(clock))
+        with self.assertRaises(TypeError):
+            HistogramWindow(factory=Histogram)
+        with self.assertRaises(TypeError):
+            HistogramWindow(factory=lambda clock: Histogram(clock))
+        # The locks are shared
+        locks = {id(Meter().lock) for i in range(1000)}
+        self.assertLessEqual(len(locks),len(LOCKS.locks))
+
+        # A histogram and its window share their lock, whatever the other metrics
+        lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,window=60)
+        histograms = [lm.histogram_handle('h%d' % i) for i in range(2*len(LOCKS.locks))]
+        for his in histograms:
+            self.assertIs(his.lock,his.window.lock)
+        def run():
+            for i in range(20):
+                for his in histograms:
+                    his.update(i)
+                lm.get_histograms()
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+            self.assertFalse(t.is_alive())
+        self.assertEqual(80,lm.get_histograms('h0','window')['count'])
+
+    def test_cardinality_limits(self):
+        lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,max_results=3,max_metrics=10)
+        for i in range(10):
+            lm.mark('event','error%d' % i)
+        self.assertEqual(['__other__','error0','error1','error2'],sorted(lm.get_metrics('event')))
+        self.assertEqual(7,lm.get_metrics('event','__other__','count'))
+        for i in range(10):
+            lm.mark('event%d' % i,'ok')
+            lm.histogram('his%d' % i,i)
+        # 4 meters for 'event', 3 meters and 3 histograms, and the overflows
+        self.assertEqual(['__other__','event','event0','event1','event2'],sorted(lm.get_metrics()))
+        self.assertEqual(7,lm.get_metrics('__other__','__other__','count'))
+        self.assertEqual(['__other__','his0','his1','his2'],sorted(lm.get_histograms()))
+        self.assertEqual(7,lm.get_histograms('__other__','count'))
+        # Reading a metric does not create it
+        lm.get_metrics('event','unknown')
+        self.assertNotIn('unknown',lm.get_metrics('event'))
+
+        # The next lookups of the keys rejected do not take the lock
+        class NoLock(object):
+            def __enter__(self):
+                raise AssertionError("lock taken")
+        lock = lm._lock
+        lm._lock = NoLock()
+        try:
+            lm.mark('event','error9')
+            lm.mark('event9','ok')
+            lm.histogram('his9',9)
+            self.assertIs(lm.meter('__other__','__other__'),lm.meter('event8','ok'))
+        finally:
+            lm._lock = lock
+        self.assertEqual(8,lm.get_metrics('event','__other__','count'))
+        self.assertEqual(8,lm.get_metrics('__other__','__other__','count'))
+        self.assertEqual(8,lm.get_histograms('__other__','count'))
+        # Only the last keys rejected are kept
+        lm.MAX_OVERFLOW = 5
+        for i in range(10):
+            lm.mark('new%d' % i,'ok')
+        self.assertEqual(['new%d' % i for i in range(5,10)],[k[0] for k in lm._overflow['meters']])
+        self.assertEqual(18,lm.get_metrics('__other__','__other__','count'))
+
+        # A key rejected is accepted once a metric is removed
+        clock = ManualClock(10**12)
+        lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock,ttl=60,max_metrics=1)
+        lm.mark('a','ok')
+        lm.mark('b','ok')
+        self.assertEqual(['__other__','a'],sorted(lm.get_metrics()))
+        clock.advance(61)
+        lm.get_metrics()
+        clock.advance(61)
+        lm.get_metrics()
+        lm.mark('b','ok')
+        self.assertEqual(['b'],sorted(lm.get_metrics()))
+
+    def test_idle_eviction(self):
+        clock = ManualClock(10**12)
+        lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock,ttl=60)
+        @lm.timer('timer','ok','error')
+        def f():
+            pass
+        f()
+        for i in range(100):
+            lm.mark('event','result%d' % i)
+            lm.histogram('his%d' % i,i)
+        # The metrics are checked after 60 seconds: they were used since they were created
+        clock.advance(61)
+        self.assertEqual(100,len(lm.get_metrics('event')))
+        clock.advance(30)
+        f()
+        lm.mark('event','result0')
+        lm.histogram('his0',1)
+        clock.advance(31)
+        # Only the metrics used in the last 60 seconds remain
+        self.assertEqual({'event':['result0'],'timer':['ok']},{k:list(v) for k,v in lm.get_metrics().items()})
+        self.assertEqual(['his0','timer'],sorted(lm.get_histograms()))
+        self.assertEqual(2,lm.get_histograms('his0','count'))
+        self.assertEqual(4,lm._nb_metrics)
+        self.assertEqual(4,len(lm._idle))
+
+        # The timer binds its metrics again once removed
+        clock.advance(120)
+        self.assertEqual({},lm.get_metrics())
+        f()
+        self.assertEqual(1,lm.get_metrics('timer','ok','count'))
+        self.assertEqual(1,lm.get_histograms('timer','count'))
+
+    def test_labels(self):
+        clock = ManualClock(10**12)
+        lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock,ttl=60)
+        for tenant in ['A','B','C']:
+            for route in ['/a','/b']:
+                lm.mark('request','ok',tenant=tenant,route=route)
+                lm.histogram('latency',0.1,tenant=tenant,route=route)
+                lm.gauge('sessions',10,tenant=tenant)
+        lm.mark('request','error',n=2,tenant='A',route='/a')
+        lm.mark('request','ok')
+        lm.histogram('latency',0.2)
+        self.assertIs(lm.meter('request','ok',route='/a',tenant='A'),lm.meter('request','ok',tenant='A',route='/a'))
+
+        # The existing paths see the labelled metrics as results of the event
+        self.assertEqual(1,lm.get_metrics('request','ok{route="/a",tenant="A"}','count'))
+        self.assertEqual(1,lm.get_metrics('request','ok','count'))
+        self.assertEqual(8,len(lm.get_metrics('request')))
+        self.assertEqual(7,len(lm.get_histograms()))
+
+        data = lm.get_metrics(labels={'tenant':'A'})
+        self.assertEqual(['error{route="/a",tenant="A"}','ok{route="/a",tenant="A"}','ok{route="/b",tenant="A"}'],sorted(data['request']))
+        self.assertEqual({'request':{'ok{route="/b",tenant="A"}':1}},lm.get_metrics(result='ok',metric='count',labels={'tenant':'A','route':'/b'}))
+        self.assertEqual(['ok'],[r for e,r in lm.select('meters',event='request',result='ok') if '{' not in r])
+        self.assertEqual(3,len(lm.get_histograms(metric='count',labels={'route':'/a'})))
+        self.assertEqual({'sessions{tenant="B"}':10},lm.get_gauges(metric='count',labels={'tenant':'B'}))
+        self.assertEqual({},lm.get_metrics(labels={'tenant':'D'}))
+
+        # The indexes follow the eviction of the metrics
+        clock.advance(61)
+        lm.get_metrics()
+        lm.mark('request','ok',tenant='A',route='/a')
+        clock.advance(61)
+        lm.evict()
+        self.assertEqual([('request','ok{route="/a",tenant="A"}')],list(lm.select('meters',tenant='A')))
+        self.assertEqual({},lm.get_histograms(labels={'tenant':'A'}))
+
+    @unittest.skipUnless(os.name=='posix','fork is needed')
+    def test_multiprocess(self):
+        directory = tempfile.mkdtemp()
+        lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False,multiprocess=directory)
+        lm.mark('request','ok')
+        lm.histogram('latency',0.5)
+        lm.gauge('size',10)
+
+        ctx = multiprocessing.get_context('fork')
+        ready = ctx.Barrier(4)
+        done = ctx.Event()
+        def worker(i):
+            lm.mark('request','ok',i+1)
+            lm.mark('request','error')
+            for v in range(100):
+                lm.histogram('latency',i+v/100)
+            lm.gauge('size',20+i)
+            ready.wait()
+            done.wait()
+        workers = [ctx.Process(target=worker,args=(i,)) for i in range(3)]
+        for w in workers:
+            w.start()
+        try:
+            ready.wait()
+            # The metrics of the 4 processes are aggregated
+            self.assertEqual(1+1+2+3,lm.get_metrics('request','ok','count'))
+            self.assertEqual(3,lm.get_metrics('request','error','count'))
+            self.assertEqual(301,lm.get_histograms('latency','count'))
+            self.assertAlmostEqual(0.0,lm.get_histograms('latency','min'))
+            self.assertAlmostEqual(2.99,lm.get_histograms('latency','max'))
+            self.assertEqual(dict(min=10,max=22,count=10+20+21+22),lm.get_gauges('size'))
+            self.assertEqual(4,len(os.listdir(directory)))
+        finally:
+            done.set()
+            for w in workers:
+                w.join()
+
+        # The files of the dead processes are removed
+        self.assertEqual(1,lm.get_metrics('request','ok','count'))
+        self.assertEqual(0,lm.get_metrics('request','error','count'))
+        self.assertEqual(1,lm.get_histograms('latency','count'))
+        self.assertEqual(['livemetrics_{}.db'.format(os.getpid())],os.listdir(directory))
+
+        # The versions compare the metrics written by all the processes
+        version = lm.get_version('meters')
+        error = lm.get_version('meters','request','error')
+        self.assertEqual(version,lm.get_version('meters'))
+        lm.mark('request','ok')
+        self.assertLess(version,lm.get_version('meters'))
+        self.assertEqual(error,lm.get_version('meters','request','error'))
+        self.assertLess(error,lm.get_version('meters','request','ok'))
+
+    @unittest.skipUnless(os.name=='posix','mmap with offsets is needed')
+    def test_mmap_store(self):
+        store = livemetrics.multiprocess.MmapStore(tempfile.mkdtemp(),size=4096,max_size=8*4096)
+        # The file grows by segments, the entries never span two segments
+        for i in range(100):
+            store.allocate(json.dumps(['meter',i]),8).cast('q')[0] = i
+        self.assertEqual(4*4096,os.path.getsize(store.path))
+        self.assertEqual([(['meter',i],i) for i in range(100)],
+            [(key,array.array('q',data)[0]) for key,data in store.collect()])
+        # The entries removed are reused by the entries of the same size
+        used = store._used
+        for i in range(50):
+            store.free(json.dumps(['meter',i]))
+        for i in range(50):
+            self.assertEqual([0]*8,store.allocate(json.dumps(['meter',i+100]),8).cast('q').tolist())
+        self.assertEqual(used,store._used)
+        self.assertEqual(list(range(50,150)),sorted(key[1] for key,data in store.collect()))
+        # Once the file is full, the slots are in the memory of the process
+        for i in range(500):
+            store.allocate(json.dumps(['meter',i+150]),8).cast('q')[0] = 1
+        self.assertEqual(8*4096,os.path.getsize(store.path))
+        self.assertLess(0,store.dropped)
+        self.assertEqual(600-store.dropped,len(store.collect()))
+
+        # A metric removed from the registry does not write in the entry reused
+        directory = tempfile.mkdtemp()
+        clock = ManualClock(10**12)
+        lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False,clock=clock,ttl=60,multiprocess=directory)
+        handle = lm.meter('request','a')
+        handle.mark()
+        clock.advance(61)
+        lm.get_metrics()
+        clock.advance(61)
+        lm.mark('request','b')
+        lm.get_metrics()
+        self.assertEqual({'b'},set(lm.get_metrics('request')))
+        handle.mark(10)
+        self.assertEqual(11,handle.count)
+        self.assertEqual(1,lm.get_metrics('request','b','count'))
+        self.assertEqual(0,lm.get_gauges('multiprocess_dropped','count'))
+
+    def test_ingest_queue(self):
+        queue = IngestQueue(maxsize=2000)
+        lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False,queue=queue)
+        for i in range(500):
+            lm.mark('request','ok')
+            lm.mark('request','ok',tenant='A')
+            self.assertIsNone(lm.histogram('latency',i))
+        # Nothing is applied until the metrics are read
+        self.assertEqual(1500,len(queue))
+        self.assertEqual({},lm._meters)
+        self.assertEqual(500,lm.get_metrics('request','ok','count'))
+        self.assertEqual(500,lm.get_metrics('request','ok{tenant="A"}','count'))
+        self.assertEqual(500,lm.get_histograms('latency','count'))
+        self.assertEqual(0,len(queue))
+
+        # The timed calls are queued as well
+        @lm.timer('t','ok','error')
+        def timed(fail):
+            if fail:
+                raise ValueError()
+        timed(False)
+        self.assertRaises(ValueError,timed,True)
+        self.assertEqual(4,len(queue))
+        self.assertNotIn('t',lm._meters)
+        self.assertNotIn('t',lm._histograms)
+        self.assertEqual(1,lm.get_metrics('t','ok','count'))
+        self.assertEqual(1,lm.get_metrics('t','error','count'))
+        self.assertEqual(2,lm.get_histograms('t','count'))
+        self.assertEqual(0,len(queue))
+
+        # The memory is bounded, the events over the limit are dropped and counted
+        for i in range(2200):
+            lm.mark('request','ok')
+        self.assertEqual(200,lm.get_gauges('queue_dropped','count'))
+        self.assertEqual(2500,lm.get_metrics('request','ok','count'))
+
+        # Many threads record the events, applied by the background thread
+        queue = IngestQueue(maxsize=1000000,interval=0.01)
+        lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False,queue=queue)
+        def run():
+            for i in range(10000):
+                lm.mark('request','ok')
+                lm.histogram('latency',i)
+        with queue:
+            threads = [threading.Thread(target=run) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(80000,lm.get_metrics('request','ok','count'))
+            self.assertEqual(80000,lm.get_histograms('latency','count'))
+        self.assertEqual(0,queue.dropped)
+        self.assertEqual(0,queue.errors)
+
+    def test_reservoir_skip(self):
+        # Reference: a priority drawn for every value
+        class DrawAll(Reservoir):
+            def update(self,value):
+                self.count += 1
+                now = self.clock.now()
+                item_weight = math.exp(self.alpha*(now-self.start)/1e9)
+                priority = item_weight/(1.0-random.random())
+                if len(self._priorities)<self._size:
+                    self._priorities.append(priority)
+                    self._values.append(value)
+                    self._weights.append(item_weight)
+                    if len(self._priorities)>=self._size:
+                        self._heapify()
+                elif self._priorities[0]<priority:
+                    self._replace_first(priority,value,item_weight)
+
+        def run(reservoir_class,seed):
+            random.seed(seed)
+            clock = ManualClock()
+            r = reservoir_class(200,clock)
+            for i in range(60000):
+                r.update(i)
+                clock.advance(0.001)
+            self.assertEqual(60000,r.count)
+            self.assertEqual(200,len(r._priorities))
+            self.assertTrue(all(r._priorities[0]<=p for p in r._priorities))
+            snapshot = r.snapshot
+            return [snapshot.mean]+snapshot.get_values([0.25,0.5,0.75])
+
+        skip = [run(Reservoir,seed) for seed in range(10)]
+        draw = [run(DrawAll,seed) for seed in range(10)]
+        for a,b in zip(zip(*skip),zip(*draw)):
+            self.assertLess(abs(statistics.mean(a)-statistics.mean(b)),2000)
+        random.seed()
+
+    def test_reservoir_skip_idle(self):
+        # Burst, long idle, burst: the skip drawn at the end of the first burst is drawn again
+        # with the weight of the values of the second burst, much higher after the idle period
+        for seed in range(10):
+            random.seed(seed)
+            clock = ManualClock()
+            r = Reservoir(100,clock)
+            for i in range(100000):
+                r.update(1)
+            self.assertLess(0,r._skip)
+            clock.advance(600)
+            self.assertTrue(all(r.update(2) for i in range(50)))
+            self.assertEqual(50,r._values.count(2))
+        random.seed()
+
+    def test_versions(self):
+        for options in [dict(),dict(columnar=True)]:
+            clock = ManualClock(10**12)
+            lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock,ttl=60,**options)
+            for i in range(100):
+                lm.mark('event','result%d' % i)
+                lm.histogram('his%d' % i,i)
+                lm.gauge('gauge%d' % i,i)
+            versions = {kind:lm.get_version(kind) for kind in ('meters','gauges','histograms')}
+            # Nothing changed
+            for kind,version in versions.items():
+                self.assertEqual(version,lm.get_version(kind))
+            self.assertEqual(dict(version=versions['meters'],metrics={}),lm.get_metrics(since=versions['meters']))
+            self.assertEqual(dict(version=versions['gauges'],metrics={}),lm.get_gauges(since=versions['gauges']))
+            # Only the metrics changed are returned
+            lm.mark('event','result1')
+            lm.mark('event','new')
+            lm.mark('labelled','ok',tenant='A')
+            lm.histogram('his2',2)
+            lm.gauge('gauge3',30)
+            data = lm.get_metrics(since=versions['meters'])
+            self.assertLess(versions['meters'],data['version'])
+            self.assertEqual(['labelled','event'],sorted(data['metrics'],reverse=True))
+            self.assertEqual(['new','result1'],sorted(data['metrics']['event']))
+            self.assertEqual(2,data['metrics']['event']['result1']['count'])
+            self.assertEqual(['new','result1'],sorted(lm.get_metrics('event',since=versions['meters'])['metrics']))
+            self.assertEqual(['ok{tenant="A"}'],list(lm.get_metrics(labels={'tenant':'A'},since=0)['metrics']['labelled']))
+            self.assertEqual(['gauge3'],list(lm.get_gauges(since=versions['gauges'])['metrics']))
+            data = lm.get_histograms(since=versions['histograms'])
+            self.assertEqual(['his2'],list(data['metrics']))
+            self.assertEqual(2,data['metrics']['his2']['count'])
+            # Since the version returned
+            self.assertEqual({},lm.get_histograms(since=data['version'])['metrics'])
+            self.assertEqual(101,len(lm.get_metrics(since=0)['metrics']['event']))
+            with self.assertRaises(SyntaxError):
+                lm.get_metrics('event','new',since=0)
+
+            # A removal changes the version
+            if not options:
+                clock.advance(61)
+                lm.get_histograms()
+                clock.advance(30)
+                lm.histogram('his2',2)
+                version = lm.get_version('histograms')
+                clock.advance(31)
+                self.assertLess(version,lm.get_version('histograms'))
+                self.assertEqual(['his2'],list(lm.get_histograms()))
+
+    def test_versions_decay(self):
+        for options in [dict(),dict(columnar=True)]:
+            clock = ManualClock(10**12)
+            lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock,**options)
+            lm.mark('event','ok')
+            lm.histogram('his',1)
+            versions = {kind:lm.get_version(kind) for kind in ('meters','histograms')}
+            # The decay of the rates and of the values changes the version
+            clock.advance(Meter.TICK_INTERVAL*2)
+            self.assertLess(versions['meters'],lm.get_version('meters'))
+            self.assertEqual(['ok'],list(lm.get_metrics(since=versions['meters'])['metrics']['event']))
+            self.assertEqual(versions['histograms'],lm.get_version('histograms'))
+            clock.advance(Reservoir.TICK_INTERVAL)
+            self.assertLess(versions['histograms'],lm.get_version('histograms'))
+
+            # A meter ticked is not reported as not modified
+            respond = livemetrics.publishers.encoding.respond
+            compute = lambda encoder: encoder.dumps(lm,'meters','event','ok')
+            status,body,headers = respond(None,None,lm,'meters','/meters/event/ok',{},compute)
+            etag = headers['ETag']
+            self.assertEqual(304,respond(None,None,lm,'meters','/meters/event/ok',{'If-None-Match':etag},compute)[0])
+            clock.advance(Meter.TICK_INTERVAL*2)
+            status,body,headers = respond(None,None,lm,'meters','/meters/event/ok',{'If-None-Match':etag},compute)
+            self.assertEqual(200,status)
+            self.assertNotEqual(etag,headers['ETag'])
+
+    def test_versions_activity(self):
+        # Reading the version does not depend on the number of metrics
+        class CountingClock(ManualClock):
+            calls = 0
+            def now(self):
+                self.calls += 1
+                return super().now()
+        for options in [dict(),dict(striped=True),dict(columnar=True),dict(window=60)]:
+            clock = CountingClock(10**12)
+            lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock,**options)
+            for i in range(1000):
+                lm.mark('event','result%d' % i)
+                lm.histogram('his%d' % i,i)
+            versions = {kind:lm.get_version(kind) for kind in ('meters','histograms')}
+            calls = clock.calls
+            for i in range(10):
+                for kind,version in versions.items():
+                    self.assertEqual(version,lm.get_version(kind))
+            self.assertGreater(50,clock.calls-calls)
+
+            # The version of a single metric changes only with the metric
+            ok = lm.get_version('meters','event','result1')
+            his = lm.get_version('histograms','his1')
+            lm.mark('event','result2')
+            lm.histogram('his2',2)
+            self.assertEqual(ok,lm.get_version('meters','event','result1'))
+            self.assertEqual(his,lm.get_version('histograms','his1'))
+            self.assertLess(ok,lm.get_version('meters','event','result2'))
+            self.assertLess(his,lm.get_version('histograms','his2'))
+            self.assertEqual(lm.get_version('meters','event','result2'),lm.get_version('meters','event'))
+            self.assertLess(versions['meters'],lm.get_version('meters'))
+            self.assertEqual(0,lm.get_version('meters','missing'))
+            self.assertEqual(0,lm.get_version('histograms','missing'))
+
+        # The gauges change with their value, read from the callables
+        lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False)
+        value = [1]
+        lm.gauge('fixed',1)
+        lm.gauge('callable',lambda: value[0])
+        version = lm.get_version('gauges')
+        fixed = lm.get_version('gauges','fixed')
+        lm.gauge('fixed',1)
+        self.assertEqual(version,lm.get_version('gauges'))
+        value[0] = 2
+        self.assertLess(version,lm.get_version('gauges'))
+        self.assertEqual(fixed,lm.get_version('gauges','fixed'))
+        self.assertEqual(['callable'],list(lm.get_gauges(since=version)['metrics']))
+
+    def test_json_fragments(self):
+        for options in [dict(),dict(striped=True),dict(columnar=True),dict(window=60)]:
+            clock = ManualClock(10**12)
+            lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock,**options)
+            def check():
+                self.assertEqual(json.dumps(lm.get_metrics()),lm.get_metrics_json())
+                self.assertEqual(json.dumps(lm.get_metrics('event')),lm.get_metrics_json('event'))
+                self.assertEqual(json.dumps(lm.get_metrics('missing')),lm.get_metrics_json('missing'))
+                self.assertEqual(json.dumps(lm.get_gauges()),lm.get_gauges_json())
+                self.assertEqual(json.dumps(lm.get_histograms()),lm.get_histograms_json())
+                self.assertEqual(json.dumps(lm.get_histograms(percentiles=[0.5],scale=2)),lm.get_histograms_json(percentiles=[0.5],scale=2))
+            for i in range(100):
+                lm.mark('event',i%10)
+                lm.mark('event-%d' % i,'ok',tenant='A')
+                lm.histogram('his%d' % (i%10),i)
+                lm.gauge('gauge%d' % (i%10),i)
+            lm.gauge('callable',lambda: 5)
+            check()
+            # Some metrics change, the rates tick
+            for i in range(10):
+                lm.mark('event',i)
+                lm.histogram('his1',i)
+                lm.gauge('gauge2',i)
+                clock.advance(1)
+                check()
+            clock.advance(60)
+            check()
+            # Only the metrics changed
+            version = lm.get_version('meters')
+            lm.mark('event',3)
+            self.assertEqual(json.dumps(lm.get_metrics(since=version)),lm.get_metrics_json(since=version))
+            self.assertEqual(json.dumps(lm.get_metrics('event',since=version)),lm.get_metrics_json('event',since=version))
+            self.assertEqual(json.dumps(lm.get_gauges(since=0)),lm.get_gauges_json(since=0))
+            self.assertEqual(json.dumps(lm.get_histograms(since=0)),lm.get_histograms_json(since=0))
+            # Other requests are encoded with json.dumps
+            self.assertEqual(json.dumps(lm.get_metrics('event',3,'count')),lm.get_metrics_json('event',3,'count'))
+            self.assertEqual(json.dumps(lm.get_metrics(labels={'tenant':'A'})),lm.get_metrics_json(labels={'tenant':'A'}))
+            if 'window' not in options:
+                # The JSON of the meters not changed is not encoded again
+                lm.get_metrics_json()
+                fragment = lm._fragments['meters'][('event',1)]
+                lm.mark('event',2)
+                lm.get_metrics_json()
+                self.assertIs(fragment,lm._fragments['meters'][('event',1)])
+
+    def test_encoder(self):
+        lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False)
+        for i in range(100):
+            lm.mark('event',i%10)
+            lm.histogram('his%d' % (i%10),i)
+            lm.gauge('gauge%d' % (i%10),i)
+        names = ['json'] + [name for name in ('orjson','msgspec') if getattr(livemetrics.publishers.encoding,name) is not None]
+        for name in names:
+            encoder = livemetrics.publishers.encoding.Encoder(name)
+            for kind,get in [('meters',lm.get_metrics),('gauges',lm.get_gauges),('histograms',lm.get_histograms)]:
+                data = encoder.dumps(lm,kind)
+                self.assertIsInstance(data,bytes)
+                self.assertEqual(json.loads(json.dumps(get())),json.loads(data))
+            self.assertEqual(json.loads(json.dumps(lm.get_metrics('event',3))),json.loads(encoder.dumps(lm,'meters','event',3)))
+        self.assertRaises(ValueError,livemetrics.publishers.encoding.Encoder,'yaml')
+
+        # Negotiation of the compression
+        encoder = livemetrics.publishers.encoding.Encoder(threshold=100)
+        self.assertEqual('gzip',encoder.content_encoding('gzip, deflate',1000))
+        self.assertIn(encoder.content_encoding('*',1000),('gzip','br'))
+        self.assertEqual(None,encoder.content_encoding('deflate, gzip;q=0',1000))
+        self.assertEqual(None,encoder.content_encoding('gzip',10))
+        self.assertEqual(None,encoder.content_encoding(None,1000))
+        self.assertEqual(None,livemetrics.publishers.encoding.Encoder(threshold=None).content_encoding('gzip',1000))
+
+        # The compressed response is kept with the response in the cache
+        cache = livemetrics.publishers.cache.ResponseCache(ttl=60)
+        compute = lambda encoder: encoder.dumps(lm,'meters')
+        status,body,headers = livemetrics.publishers.encoding.respond(encoder,cache,lm,'meters','/meters',{'Accept-Encoding':'gzip'},compute)
+        self.assertEqual(200,status)
+        self.assertEqual('gzip',headers['Content-Encoding'])
+        self.assertEqual(encoder.dumps(lm,'meters'),gzip.decompress(body))
+        self.assertIs(body,livemetrics.publishers.encoding.respond(encoder,cache,lm,'meters','/meters',{'Accept-Encoding':'gzip'},compute)[1])
+        status,body,headers = livemetrics.publishers.encoding.respond(encoder,cache,lm,'meters','/meters',{},compute)
+        self.assertEqual(encoder.dumps(lm,'meters'),body)
+        self.assertNotIn('Content-Encoding',headers)
+        etag = headers['ETag']
+        self.assertEqual(304,livemetrics.publishers.encoding.respond(encoder,cache,lm,'meters','/meters',{'If-None-Match':'W/'+etag},compute)[0])
+
+    def test_prometheus(self):
+        line = re.compile(r'^([a-z_]+)\{((?:[a-z_]+="(?:[^"\\]|\\.)*",?)+)\} (\S+)$')
+        def parse(lines):
+            # Samples by name and labels, checking the families are not interleaved
+            samples = {}
+            families = []
+            text = ''.join(lines)
+            self.assertTrue(text.endswith('\n'))
+            for l in text.splitlines():
+                if l.startswith('# TYPE '):
+                    self.assertNotIn(l.split()[2],families)
+                    families.append(l.split()[2])
+                    continue
+                if l.startswith('#'):
+                    continue
+                m = line.match(l)
+                self.assertIsNotNone(m,l)
+                name = m.group(1)
+                self.assertTrue(name.startswith(families[-1]))
+                samples[(name,m.group(2))] = float(m.group(3))
+            return samples
+        for options in [dict(),dict(striped=True),dict(columnar=True),dict(window=60)]:
+            clock = ManualClock(10**12)
+            lm = livemetrics.LiveMetrics("1.0","about",True,memory_and_cpu=False,clock=clock,**options)
+            for i in range(100):
+                lm.mark('event',i%10)
+                lm.mark('request','ok',route='/a"b\\%')
+                lm.histogram('his',i)
+                lm.histogram('sketch',i,SketchHistogram)
+            lm.gauge('gauge',10)
+            lm.gauge('none',None)
+            clock.advance(10)
+            samples = parse(lm.get_prometheus(percentiles=[0.5]))
+            self.assertEqual(10,samples[('livemetrics_meter_total','event="event",result="3"')])
+            self.assertEqual(100,samples[('livemetrics_meter_total','event="request",result="ok",route="/a\\"b\\\\%"')])
+            self.assertIn(('livemetrics_meter_rate','event="request",result="ok",route="/a\\"b\\\\%",window="5m"'),samples)
+            self.assertEqualFloat(lm.get_metrics('event',3,'rate1'),samples[('livemetrics_meter_rate','event="event",result="3",window="1m"')])
+            self.assertEqual(10,samples[('livemetrics_gauge_max','name="gauge"')])
+            self.assertNotIn(('livemetrics_gauge','name="none"'),samples)
+            self.assertEqual(lm.get_histograms('his','quantiles',[0.5])[0.5],samples[('livemetrics_histogram','event="his",quantile="0.5"')])
+            self.assertEqual(100,samples[('livemetrics_histogram_count','event="sketch"')])
+
+            # Cumulative buckets
+            samples = parse(lm.get_prometheus(buckets=[49.5,10**6,-1]))
+            for name in ['his','sketch']:
+                buckets = [samples[('livemetrics_histogram_bucket','event="%s",le="%s"' % (name,le))] for le in ['-1.0','49.5','1000000.0','+Inf']]
+                self.assertEqual(0,buckets[0])
+                self.assertAlmostEqual(50,buckets[1],delta=2)
+                self.assertEqual([100,100],buckets[2:])
+
+            # The text of the lines is kept for each metric
+            prefix = lm._exposition['meters'][('event',3)][0]
+            lm.mark('event',3)
+            ''.join(lm.get_prometheus())
+            self.assertIs(prefix,lm._exposition['meters'][('event',3)][0])
 
 # ______________________________________________________________________________
 if __name__=='__main__':
@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import unittest
+import threading
+
+import livemetrics
+import livemetrics.publishers.cache
+from livemetrics.metrics import *
+
+THREADS = 8
+
+def run_threads(target,nb_threads=THREADS):
+    # Start all the threads at the same time, to maximize the contention
+    barrier = threading.Barrier(nb_threads)
+    def run(i):
+        barrier.wait()
+        target(i)
+    threads = [threading.Thread(target=run,args=(i,)) for i in range(nb_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def free_threaded():
+    return not getattr(sys,'_is_gil_enabled',lambda: True)()
+
+#_______________________________________________________________________________
+class TestThreads(unittest.TestCase):
+    """
+    The metrics and the registry used by many threads at the same time. With the GIL, these
+    tests check the logic; on a free-threaded interpreter (3.13t, 3.14t), they also check
+    that no update is lost without the GIL.
+    """
+
+    def test_metrics(self):
+        clock = ManualClock()
+        metrics = [Meter(clock),StripedMeter(clock),Histogram(clock),SketchHistogram(clock),HdrHistogram(clock)]
+        table = MeterTable(clock)
+        gauge = Gauge()
+        ewma = EWMA()
+        def run(i):
+            for j in range(5000):
+                metrics[0].mark()
+                metrics[1].mark()
+                for his in metrics[2:]:
+                    his.update(j)
+                table.meter('event',j%10).mark()
+                gauge.mark(i*5000+j+1)
+                ewma.update()
+                if j%100==0:
+                    clock.advance(1)
+                    ewma._tick()
+        run_threads(run)
+        for metric in metrics:
+            self.assertEqual(THREADS*5000,metric.count)
+        self.assertEqual(THREADS*5000,sum(m['count'] for m in table.to_dict()['event'].values()))
+        self.assertEqual(1,gauge.min)
+        self.assertEqual(THREADS*5000,gauge.max)
+        ewma._tick()
+        self.assertEqual(0,ewma.uncounted)
+
+    def test_registry(self):
+        for options in [dict(),dict(striped=True),dict(columnar=True),dict(max_results=50)]:
+            lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False,**options)
+            handles = [[] for i in range(THREADS)]
+            def run(i):
+                # All the threads create the same metrics at the same time
+                for j in range(100):
+                    handles[i].append(lm.meter('event',j))
+                    lm.mark('event',j)
+                    lm.mark('labelled','ok',thread=i)
+                    lm.histogram('his',j)
+                    lm.gauge('gauge',j)
+            run_threads(run)
+            # A single meter per result, shared by all the threads
+            for j in range(50):
+                self.assertEqual(1,len(set(id(h[j]) for h in handles)))
+            data = lm.get_metrics('event')
+            self.assertEqual(THREADS*100,sum(d['count'] for d in data.values()))
+            self.assertEqual(THREADS*100,lm.get_histograms('his','count'))
+            for i in range(THREADS):
+                self.assertEqual(100,lm.get_metrics('labelled','ok{thread="%d"}' % i,'count'))
+
+    def test_read_while_writing(self):
+        clock = ManualClock()
+        lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=True,clock=clock,ttl=10)
+        errors = []
+        def run(i):
+            try:
+                for j in range(300):
+                    if i%2:
+                        # New metrics are created, and the idle ones are removed
+                        lm.mark('event-%d' % i,j)
+                        lm.histogram('his-%d-%d' % (i,j),j)
+                        lm.gauge('gauge-%d-%d' % (i,j),j)
+                        clock.advance(0.1)
+                    else:
+                        lm.get_metrics()
+                        lm.get_histograms()
+                        lm.get_gauges()
+                        lm.get_metrics(labels={'event':'event-1'})
+            except Exception as exc:
+                errors.append(exc)
+        run_threads(run)
+        self.assertEqual([],errors)
+
+    def test_response_cache(self):
+        # Identical requests at the same time compute a single response
+        cache = livemetrics.publishers.cache.ResponseCache(ttl=0)
+        computed = []
+        def compute():
+            computed.append(1)
+            time.sleep(0.2)
+            return 'response'
+        responses = []
+        run_threads(lambda i: responses.append(cache.get('/metrics',compute)))
+        self.assertEqual(1,len(computed))
+        self.assertEqual(['response']*THREADS,responses)
+        self.assertEqual(THREADS-1,cache.coalesced)
+        # Nothing kept with a ttl of 0
+        cache.get('/metrics',compute)
+        self.assertEqual(2,len(computed))
+
+        # An error is raised in all the waiting threads
+        def fail():
+            time.sleep(0.2)
+            raise ValueError("failed")
+        errors = []
+        def run(i):
+            try:
+                cache.get('/fail',fail)
+            except ValueError as exc:
+                errors.append(exc)
+        run_threads(run)
+        self.assertEqual(THREADS,len(errors))
+
+        # Without wait, as in an event loop, a response being computed is computed again
+        started = threading.Event()
+        def slow():
+            started.set()
+            time.sleep(0.2)
+            return 'slow'
+        t = threading.Thread(target=cache.get,args=('/wait',slow))
+        t.start()
+        started.wait()
+        S = time.perf_counter()
+        self.assertEqual('fast',cache.get('/wait',lambda: 'fast',wait=False))
+        self.assertLess(time.perf_counter()-S,0.1)
+        t.join()
+
+    @unittest.skipUnless(free_threaded() and (os.cpu_count() or 1)>=4,"needs a free-threaded interpreter and 4 cores")
+    def test_scaling(self):
+        # Threads marking their own meters do not serialize on a shared lock
+        lm = livemetrics.LiveMetrics("version","about",True,memory_and_cpu=False)
+        marks = 200000
+        def run(i):
+            m = lm.meter('event',i)
+            for j in range(marks):
+                m.mark()
+        S = time.perf_counter()
+        run_threads(run,1)
+        one = time.perf_counter()-S
+        S = time.perf_counter()
+        run_threads(run,4)
+        four = time.perf_counter()-S
+        # 4 times more work in less than 2.5 times the time
+        self.assertLess(four,2.5*one)
+
+# ______________________________________________________________________________
+if __name__=='__main__':
+    unittest.main(argv=['-v'])